@@ -3,75 +3,697 @@ from torchvision import transforms
 from PIL import Image, ImageOps
 from flask import Flask, request, jsonify
 from flask_cors import CORS
+from flask_sock import Sock
+from simple_websocket import ConnectionClosed
 import io
+import gzip
+import hashlib
+import hmac
 import timm
+import brotli
 import os
 import numpy as np
 import base64
 import cv2
-import gc
+import json
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from buffers import BufferPool
+from embeddings import EmbeddingIndex
+from memory import MemoryGovernor, container_memory_limit
+from pipeline import Pipeline, PreparedImage
+from pruning import build_pruned_model
+from registry import ModelRegistry
+from threads import apply_config as apply_thread_config, load_config as load_thread_config
+from tiling import stitch, tile_grid
+from tta import BatchTTA, MAX_VIEWS as TTA_MAX_VIEWS
 
 app = Flask(__name__)
 # Enable CORS for all routes
-CORS(app)
+CORS(app, expose_headers=['ETag'])
+sock = Sock(app)
 
 # Global variables for model and hooks
 model = None
 device = None
-gradients = None
-activations = None
-enable_gradcam = False  # Flag to control Grad-CAM hook behavior
-
-def save_gradient(grad):
-    global gradients
-    # Detach to avoid keeping any autograd references around accidentally
-    gradients = grad.detach()
-
-def forward_hook(module, input, output):
-    global activations, enable_gradcam
-    # IMPORTANT:
-    # - Only keep activations when Grad-CAM is requested, otherwise we retain a large tensor
-    #   for no reason.
-    # - Store activations *detached* so we don't keep the autograd graph alive between requests
-    #   (this can lead to memory growth / OOM on Cloud Run).
-    if enable_gradcam:
-        activations = output.detach()
-        if output.requires_grad:
-            output.register_hook(save_gradient)
-    else:
-        activations = None
 
-def load_model(model_path, device):
-    # Initialize EfficientNet model
-    model = timm.create_model('efficientnet_b5', pretrained=False, num_classes=8)
-    model.to(device)
-    
+def load_model(model_path, device, arch='efficientnet_b5'):
     # Load the trained weights
     state_dict = torch.load(model_path, map_location=device)
+    if 'channels' in state_dict:
+        # Channel-pruned checkpoint from prune_model.py: rebuild the smaller architecture
+        model = build_pruned_model(state_dict['arch'], state_dict['channels'], num_classes=8)
+        state_dict = state_dict['state_dict']
+    else:
+        # Initialize EfficientNet model
+        model = timm.create_model(arch, pretrained=False, num_classes=8)
+    model.to(device)
+    
     # If the state dict was saved with DataParallel, remove the 'module.' prefix
     if list(state_dict.keys())[0].startswith('module.'):
         state_dict = {k[7:]: v for k, v in state_dict.items()}
     model.load_state_dict(state_dict)
     model.eval()
-    
-    # Register hook on the last convolutional layer for Grad-CAM
-    # For EfficientNet-B5, the last conv layer is in conv_head
-    target_layer = model.conv_head
-    target_layer.register_forward_hook(forward_hook)
-    
     return model
 
+def file_stamp(path):
+    stat = os.stat(path)
+    return [path, stat.st_size, stat.st_mtime]
+
+class ServingModel:
+    """One loaded version of the main model and everything derived from it.
+
+    A request takes the active instance once and uses it to the end, so a hot
+    swap never changes the model under a request in flight; the old instance
+    is freed when its last request finishes.
+    """
+
+    def __init__(self, version, path, arch, input_size, reference_index_path=None):
+        self.version = version
+        self.arch = arch
+        self.input_size = input_size
+        self.net = load_model(path, device, arch)
+        self.reference_index = EmbeddingIndex.load(reference_index_path) if reference_index_path else None
+        # Part of the ETag of /predict responses: similar cases change when the index is rebuilt
+        self.reference_index_stamp = file_stamp(reference_index_path) if reference_index_path else None
+
+    def prepare(self, warmup_runs):
+        with torch.inference_mode():
+            x = torch.zeros(1, 3, self.input_size, self.input_size, device=device)
+            for _ in range(warmup_runs):
+                self.net(x)
+        return self
+
+def file_version(path):
+    """Version name of an unregistered checkpoint: a short hash of its contents."""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return 'sha256-' + h.hexdigest()[:12]
+
+# Which network to serve. The defaults are the EfficientNet-B5 teacher; a distilled
+# student from train.py --teacher_checkpoint is served with e.g.
+# MODEL_PATH=student.pth MODEL_ARCH=efficientnet_b0 MODEL_INPUT_SIZE=224.
+# With MODEL_REGISTRY_DIR set, the registry's ACTIVE version (see registry.py) is served
+# instead, and POST /admin/models/activate (ADMIN_TOKEN) hot-swaps versions at runtime.
+MODEL_PATH = os.environ.get("MODEL_PATH", "model.pth")
+MODEL_ARCH = os.environ.get("MODEL_ARCH", "efficientnet_b5")
+MODEL_INPUT_SIZE = int(os.environ.get("MODEL_INPUT_SIZE", "456"))
+MODEL_VERSION = os.environ.get("MODEL_VERSION", "")
+MODEL_REGISTRY_DIR = os.environ.get("MODEL_REGISTRY_DIR", "")
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")
+WARMUP_RUNS = int(os.environ.get("WARMUP_RUNS", "2"))
+
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-model_path = "model.pth"
-model = load_model(model_path, device)
+registry = ModelRegistry(MODEL_REGISTRY_DIR) if MODEL_REGISTRY_DIR else None
+
+# CPU threads (threads.py): THREAD_CONFIG_PATH is the configuration tune_threads.py saved for
+# this host: PyTorch intra-/inter-op and OpenCV thread counts, and defaults for
+# PREPROCESS_WORKERS and TILE_BATCH. It is applied here, before any model runs; without one,
+# PyTorch gets one thread per CPU the process may use (affinity mask, container CPU quota).
+THREAD_CONFIG_PATH = os.environ.get("THREAD_CONFIG_PATH", "thread_config.json")
+thread_config = load_thread_config(THREAD_CONFIG_PATH)
+thread_settings = apply_thread_config(thread_config)
+
+# Pipelined /predict (pipeline.py): with PREPROCESS_WORKERS > 0, uploads are decoded and
+# turned into model inputs by that many worker processes, into PREPROCESS_SLOTS shared-memory
+# slots (default: two per worker; a request waits for a free slot), and the models run on a
+# single inference thread, so decoding overlaps inference across requests. Queue depths per
+# stage are in /metrics. The workers are forked here, before any model is loaded.
+PREPROCESS_WORKERS = int(os.environ.get("PREPROCESS_WORKERS", thread_config.get('preprocess_workers', 0)))
+PREPROCESS_SLOTS = int(os.environ.get("PREPROCESS_SLOTS", "0")) or 2 * PREPROCESS_WORKERS
+pipeline = Pipeline(PREPROCESS_WORKERS, PREPROCESS_SLOTS) if PREPROCESS_WORKERS > 0 else None
+
+# Optional two-stage cascade: a small, fast model (e.g. a student distilled with
+# train.py --teacher_checkpoint) answers first and the request escalates to the main
+# model only when the fast model's calibrated max probability is below CASCADE_THRESHOLD.
+# Disabled unless CASCADE_MODEL_PATH is set.
+CASCADE_MODEL_PATH = os.environ.get("CASCADE_MODEL_PATH", "")
+CASCADE_MODEL_ARCH = os.environ.get("CASCADE_MODEL_ARCH", "efficientnet_b0")
+CASCADE_INPUT_SIZE = int(os.environ.get("CASCADE_INPUT_SIZE", "224"))
+CASCADE_THRESHOLD = float(os.environ.get("CASCADE_THRESHOLD", "0.9"))
+CASCADE_TEMPERATURE = float(os.environ.get("CASCADE_TEMPERATURE", "1.0"))
+fast_model = load_model(CASCADE_MODEL_PATH, device, CASCADE_MODEL_ARCH) if CASCADE_MODEL_PATH else None
+
+# Which stage answered each request and the time spent in each stage, for /metrics
+cascade_lock = threading.Lock()
+cascade_stats = {'fast': 0, 'full': 0, 'escalated': 0, 'fast_ms': 0.0, 'full_ms': 0.0, 'total_ms': 0.0}
+
+def record_stage(stage, fast_ms, full_ms):
+    with cascade_lock:
+        cascade_stats[stage] += 1
+        if fast_ms is not None:
+            cascade_stats['fast_ms'] += fast_ms
+        if full_ms is not None:
+            cascade_stats['full_ms'] += full_ms
+        if fast_ms is not None and full_ms is not None:
+            cascade_stats['escalated'] += 1
+        cascade_stats['total_ms'] += (fast_ms or 0.0) + (full_ms or 0.0)
+
+def cascade_metrics():
+    with cascade_lock:
+        stats = dict(cascade_stats)
+    requests = stats['fast'] + stats['full']
+    runs_fast = stats['fast'] + stats['escalated']
+    mean_fast = stats['fast_ms'] / runs_fast if runs_fast else None
+    mean_full = stats['full_ms'] / stats['full'] if stats['full'] else None
+    mean_total = stats['total_ms'] / requests if requests else None
+    return {
+        'enabled': fast_model is not None,
+        'threshold': CASCADE_THRESHOLD,
+        'requests': requests,
+        'answered_fast': stats['fast'],
+        'answered_full': stats['full'],
+        'escalation_rate': stats['escalated'] / runs_fast if runs_fast else None,
+        'mean_fast_ms': mean_fast,
+        'mean_full_ms': mean_full,
+        'mean_inference_ms': mean_total,
+        # Against running the main model on every request
+        'mean_savings_ms': mean_full - mean_total if mean_full is not None and mean_total is not None else None,
+    }
+
+# Multi-resolution serving from the same weights: the main model runs at SERVE_RESOLUTION
+# (0: its full input size) and, when its calibrated max probability is below
+# RESOLUTION_ESCALATION_THRESHOLD, again at full resolution. Clients may pick one of
+# SERVE_RESOLUTIONS with a `resolution` form/query field. calibrate_resolution.py
+# recommends the two settings.
+SERVE_RESOLUTION = int(os.environ.get("SERVE_RESOLUTION", "0"))
+RESOLUTION_ESCALATION_THRESHOLD = float(os.environ.get("RESOLUTION_ESCALATION_THRESHOLD", "0"))
+SERVE_RESOLUTIONS = {int(r) for r in os.environ.get("SERVE_RESOLUTIONS", "300,380,456").split(",")}
+if SERVE_RESOLUTION:
+    SERVE_RESOLUTIONS.add(SERVE_RESOLUTION)
+resolution_stats = {'answered': {}, 'escalated': 0}
+
+def record_resolution(resolution, escalated):
+    with cascade_lock:
+        resolution_stats['answered'][resolution] = resolution_stats['answered'].get(resolution, 0) + 1
+        resolution_stats['escalated'] += int(escalated)
+
+def resolution_metrics():
+    with cascade_lock:
+        answered = dict(resolution_stats['answered'])
+        escalated = resolution_stats['escalated']
+    requests = sum(answered.values())
+    return {
+        'default': SERVE_RESOLUTION or active.input_size,
+        'full': active.input_size,
+        'escalation_threshold': RESOLUTION_ESCALATION_THRESHOLD,
+        'answered': {str(size): n for size, n in sorted(answered.items())},
+        'escalation_rate': escalated / requests if requests else None,
+    }
+
+# Lesion embeddings. REFERENCE_INDEX_PATH is an index from build_reference_index.py for
+# "similar reference cases"; uploads sent with a `lesion_id` are stored per lesion for
+# "change since last visit", in memory and, if LESION_STORE_PATH is set, on disk every
+# LESION_STORE_SAVE_EVERY additions.
+# Embeddings of different model versions are not comparable, so visits are stored per
+# version; with a registry, each version's reference index lives next to its weights.
+REFERENCE_INDEX_PATH = os.environ.get("REFERENCE_INDEX_PATH", "")
+LESION_STORE_PATH = os.environ.get("LESION_STORE_PATH", "")
+LESION_STORE_SAVE_EVERY = int(os.environ.get("LESION_STORE_SAVE_EVERY", "50"))
+MAX_SIMILAR = 50
+lesion_lock = threading.Lock()
+lesion_stores = {}
+lesion_unsaved = {}
+
+def lesion_store_path(version):
+    # lesions.npz -> lesions-<version>.npz
+    root, ext = os.path.splitext(LESION_STORE_PATH)
+    return f"{root}-{version}{ext or '.npz'}"
+
+def _lesion_store(serving):
+    # Caller holds lesion_lock
+    if serving.version not in lesion_stores:
+        path = lesion_store_path(serving.version) if LESION_STORE_PATH else None
+        if path and os.path.exists(path):
+            store = EmbeddingIndex.load(path)
+        elif serving.reference_index is not None:
+            # Same projection as the references, so visits and references are comparable
+            store = EmbeddingIndex(serving.net.num_features, mean=serving.reference_index.mean,
+                                   components=serving.reference_index.components)
+        else:
+            store = EmbeddingIndex(serving.net.num_features)
+        lesion_stores[serving.version] = store
+        lesion_unsaved[serving.version] = 0
+    return lesion_stores[serving.version]
+
+def similar_cases(serving, embedding, k):
+    return [{'image': key, 'diagnosis': meta.get('diagnosis'), 'label': meta.get('label'),
+             'similarity': round(score, 4)}
+            for key, score, meta in serving.reference_index.search(embedding, k)]
+
+def record_visit(serving, lesion_id, embedding, prediction, prob_list):
+    """Stores this upload for the lesion; returns the comparison with its previous visit (or None)."""
+    with lesion_lock:
+        lesion_store = _lesion_store(serving)
+        previous = lesion_store.latest(lesion_id)
+        change = None
+        if previous is not None:
+            row, meta = previous
+            change = {
+                'previous_visit': meta['time'],
+                'previous_prediction': meta['prediction'],
+                'similarity': round(lesion_store.similarity(row, embedding), 4),
+                'probability_change': [round(p - q, 4) for p, q in zip(prob_list, meta['probabilities'])],
+            }
+        lesion_store.add(lesion_id, embedding,
+                         {'time': time.time(), 'prediction': prediction, 'probabilities': prob_list})
+        lesion_unsaved[serving.version] += 1
+        if LESION_STORE_PATH and lesion_unsaved[serving.version] >= LESION_STORE_SAVE_EVERY:
+            lesion_store.save(lesion_store_path(serving.version))
+            lesion_unsaved[serving.version] = 0
+    return change
+
+# UNK rule: predictions whose calibrated max probability is below UNK_THRESHOLD are
+# reported as class 8. Tune both values offline with sweep_unk_threshold.py.
+UNK_THRESHOLD = float(os.environ.get("UNK_THRESHOLD", "0.5"))
+CALIBRATION_TEMPERATURE = float(os.environ.get("CALIBRATION_TEMPERATURE", "1.0"))
+
+# Test-time augmentation: number of views averaged per request (1 = off). Clients can
+# override it per request with a `tta` form/query field, up to TTA_MAX_VIEWS.
+TTA_VIEWS = int(os.environ.get("TTA_VIEWS", "1"))
+tta_engines = {}
+
+def get_tta_engine(num_views):
+    # Under memory pressure the views run in smaller forward passes (same result, lower peak)
+    key = (num_views, memory_limits()['tta_max_batch'])
+    if key not in tta_engines:
+        tta_engines[key] = BatchTTA(num_views, max_batch=key[1])
+    return tta_engines[key]
+
+# Tiled inference (tiling.py) for large images, on request (`tiled` form/query field) or for
+# every request with TILED_INFERENCE=1: the main model classifies up to TILE_MAX_TILES square
+# crops overlapping by TILE_OVERLAP (fraction of a side), TILE_BATCH per forward pass, and
+# their probabilities are averaged; the Grad-CAM is stitched from the tiles' maps. Tiles are
+# at the model's native resolution unless that would take more tiles than allowed, in which
+# case they grow. A tiled request skips the cascade, resolution escalation and ensemble.
+TILED_INFERENCE = os.environ.get("TILED_INFERENCE", "0").lower() in ('1', 'true')
+TILE_OVERLAP = float(os.environ.get("TILE_OVERLAP", "0.25"))
+TILE_MAX_TILES = int(os.environ.get("TILE_MAX_TILES", "9"))
+TILE_BATCH = int(os.environ.get("TILE_BATCH", thread_config.get('tile_batch', 4)))
+
+tile_lock = threading.Lock()
+tile_stats = {'requests': 0, 'tiles': 0, 'ms': 0.0}
+
+def record_tiles(tiles, ms):
+    with tile_lock:
+        tile_stats['requests'] += 1
+        tile_stats['tiles'] += tiles
+        tile_stats['ms'] += ms
+
+def tile_metrics():
+    with tile_lock:
+        stats = dict(tile_stats)
+    return {
+        'default': TILED_INFERENCE,
+        'max_tiles': TILE_MAX_TILES,
+        'batch': TILE_BATCH,
+        'overlap': TILE_OVERLAP,
+        'requests': stats['requests'],
+        'mean_tiles': stats['tiles'] / stats['requests'] if stats['requests'] else None,
+        'mean_ms': stats['ms'] / stats['requests'] if stats['requests'] else None,
+    }
+
+# Clients may ask for the Grad-CAMs of the top k classes (`gradcam_top_k`, up to
+# GRADCAM_MAX_TOP_K), e.g. MEL next to NV; all come from one forward and one backward pass.
+GRADCAM_MAX_TOP_K = int(os.environ.get("GRADCAM_MAX_TOP_K", "3"))
+
+# Memory governor (memory.py): RSS is checked after every request against MEMORY_BUDGET_MB
+# (0: the container's memory limit, if any; no limit disables the governor). From
+# MEMORY_REDUCED_AT of the budget, Grad-CAM overlays are capped at 256 px and TTA views and
+# tiles run two per forward pass; from MEMORY_CRITICAL_AT, Grad-CAM and ensemble members are
+# off and views and tiles run one at a time. Caches are evicted and gc forced only when a
+# level is entered.
+GRADCAM_MAX_SIDE = int(os.environ.get("GRADCAM_MAX_SIDE", "512"))
+MEMORY_BUDGET_MB = int(os.environ.get("MEMORY_BUDGET_MB", "0"))
+MEMORY_REDUCED_AT = float(os.environ.get("MEMORY_REDUCED_AT", "0.75"))
+MEMORY_CRITICAL_AT = float(os.environ.get("MEMORY_CRITICAL_AT", "0.9"))
+MEMORY_LEVEL_LIMITS = [
+    {'gradcam': True, 'gradcam_max_side': GRADCAM_MAX_SIDE, 'tta_max_batch': None, 'ensemble': True,
+     'tile_batch': TILE_BATCH},
+    {'gradcam': True, 'gradcam_max_side': min(GRADCAM_MAX_SIDE, 256), 'tta_max_batch': 2, 'ensemble': True,
+     'tile_batch': min(TILE_BATCH, 2)},
+    {'gradcam': False, 'gradcam_max_side': 0, 'tta_max_batch': 1, 'ensemble': False, 'tile_batch': 1},
+]
+
+def relieve_memory_pressure(level):
+    """Drops what is rebuilt on demand: TTA engines, pooled buffers and idle preprocessing
+    slots, visit stores of inactive model versions, CUDA cache."""
+    tta_engines.clear()
+    buffer_pool.clear()
+    if pipeline is not None:
+        pipeline.trim()
+    with lesion_lock:
+        for version in [v for v in lesion_stores if v != active.version]:
+            if LESION_STORE_PATH and lesion_unsaved[version]:
+                lesion_stores[version].save(lesion_store_path(version))
+            del lesion_stores[version], lesion_unsaved[version]
+    if device.type == "cuda":
+        torch.cuda.empty_cache()
+
+memory_governor = MemoryGovernor(MEMORY_BUDGET_MB * 2**20 or container_memory_limit(),
+                                 thresholds=(MEMORY_REDUCED_AT, MEMORY_CRITICAL_AT),
+                                 on_pressure=relieve_memory_pressure)
+
+def memory_limits():
+    return MEMORY_LEVEL_LIMITS[memory_governor.level]
+
+# Transform pipeline for EfficientNet. The serving path uses fill_input, which computes the
+# same values into a reused tensor
+def make_transform(size):
+    return transforms.Compose([
+        transforms.Lambda(lambda img: img.convert('RGB')),
+        transforms.Resize((size, size)),
+        transforms.ToTensor(),
+        transforms.Normalize([0.485,0.456,0.406],[0.229,0.224,0.225])
+    ])
+
+# Model inputs and Grad-CAM arrays are borrowed from a pool (buffers.py) instead of being
+# allocated for every request
+buffer_pool = BufferPool()
+NORMALIZE_MEAN = torch.tensor([0.485, 0.456, 0.406]).view(3, 1, 1)
+NORMALIZE_STD = torch.tensor([0.229, 0.224, 0.225]).view(3, 1, 1)
+
+def fill_input(image, size, out):
+    """Writes make_transform(size)(image) into the (1, 3, size, size) float tensor `out`."""
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    resized = image.resize((size, size), Image.BILINEAR)
+    # np.asarray of a PIL image is read-only, which torch.from_numpy does not accept
+    with buffer_pool.array((size, size, 3), np.uint8) as pixels:
+        np.copyto(pixels, np.asarray(resized))
+        out[0].copy_(torch.from_numpy(pixels).permute(2, 0, 1))
+    return out.div_(255.0).sub_(NORMALIZE_MEAN).div_(NORMALIZE_STD)
+
+@contextmanager
+def model_input(image, size):
+    """The model input of `image` at `size` on the serving device, valid inside the block."""
+    if isinstance(image, PreparedImage):
+        # Computed by a preprocessing worker, read in place from shared memory
+        yield torch.from_numpy(image.input(size)).unsqueeze(0).to(device)
+        return
+    with buffer_pool.tensor((1, 3, size, size)) as buffer:
+        yield fill_input(image, size, buffer).to(device)
+
+def load_version(version):
+    meta = registry.get(version)
+    return ServingModel(version, meta['path'], meta['arch'], meta['input_size'], meta['reference_index'])
+
+if registry is not None:
+    active = load_version(registry.active_version()).prepare(WARMUP_RUNS)
+else:
+    active = ServingModel(MODEL_VERSION or file_version(MODEL_PATH), MODEL_PATH, MODEL_ARCH, MODEL_INPUT_SIZE,
+                          REFERENCE_INDEX_PATH or None).prepare(WARMUP_RUNS)
+model = active.net
+
+swap_lock = threading.Lock()
+swap_state = {'status': 'idle', 'version': None, 'error': None, 'seconds': None}
+
+def swap_to(version):
+    """Loads and warms up `version` off the request path, then makes it the active model."""
+    global active, model
+    start = time.perf_counter()
+    try:
+        candidate = load_version(version).prepare(WARMUP_RUNS)
+        # One reference assignment: new requests get the new version, requests in flight
+        # keep the instance they started with
+        active, model = candidate, candidate.net
+        registry.set_active(version)
+        with swap_lock:
+            swap_state.update(status='ready', error=None, seconds=round(time.perf_counter() - start, 2))
+    except Exception as e:
+        with swap_lock:
+            swap_state.update(status='failed', error=str(e), seconds=round(time.perf_counter() - start, 2))
+
+def predict_probs(net, input_tensor, tta_views, temperature, features=None):
+    """Calibrated class probabilities of `net`, averaged over `tta_views` views.
+
+    With a `features` list, the classifier inputs (pooled features) of this pass are appended to it.
+    """
+    forward = net
+    if features is not None:
+        # Captured by this call, not by a hook: concurrent passes of the same net cannot interfere
+        def forward(x):
+            pooled = net.forward_head(net.forward_features(x), pre_logits=True)
+            features.append(pooled)
+            return net.get_classifier()(pooled)
+    if tta_views > 1:
+        # All views in one enlarged forward pass, probabilities averaged over views
+        view_logits = get_tta_engine(tta_views).logits(forward, input_tensor)
+        return torch.softmax(view_logits / temperature, dim=-1).mean(dim=0)
+    return torch.softmax(forward(input_tensor) / temperature, dim=-1)
+
+@torch.inference_mode()
+def run_main(serving, image, resolution, tta_views, features=None):
+    """Main model probabilities at `resolution`, rerun at full size when not confident enough.
+    Returns (probs, resolution used, escalated); `features` gets the pooled features of the
+    pass that answered (see predict_probs)."""
+    with model_input(image, resolution) as input_tensor:
+        probs = predict_probs(serving.net, input_tensor, tta_views, CALIBRATION_TEMPERATURE, features)
+    escalated = resolution < serving.input_size and probs.max().item() < RESOLUTION_ESCALATION_THRESHOLD
+    if escalated:
+        resolution = serving.input_size
+        if features is not None:
+            features.clear()
+        with model_input(image, resolution) as input_tensor:
+            probs = predict_probs(serving.net, input_tensor, tta_views, CALIBRATION_TEMPERATURE, features)
+    return probs, resolution, escalated
+
+def tile_layout(image, size):
+    """Tile boxes of `image` for tiles of model input `size` (see tiling.tile_grid)."""
+    if isinstance(image, PreparedImage):
+        return image.meta['tiles']
+    boxes, grid, tile_px = tile_grid(image.width, image.height, size, TILE_OVERLAP, TILE_MAX_TILES)
+    return {'boxes': boxes, 'grid': grid, 'tile_px': tile_px, 'width': image.width, 'height': image.height,
+            'size': size}
+
+@contextmanager
+def tile_inputs(image, layout, start, stop):
+    """Model inputs of tiles start to stop as one batch on the serving device, valid inside the block."""
+    boxes, size = layout['boxes'][start:stop], layout['size']
+    if isinstance(image, PreparedImage):
+        yield torch.from_numpy(image.tiles(start, stop)).to(device)
+        return
+    with buffer_pool.tensor((len(boxes), 3, size, size)) as buffer:
+        for i, box in enumerate(boxes):
+            fill_input(image.crop(box), size, buffer[i:i + 1])
+        yield buffer.to(device)
+
+@torch.inference_mode()
+def run_tiled(serving, image, layout, tta_views, batch):
+    """Main model probabilities averaged over the tiles, `batch` tiles per forward pass."""
+    probs = []
+    for start in range(0, len(layout['boxes']), batch):
+        with tile_inputs(image, layout, start, start + batch) as input_tensor:
+            probs.append(predict_probs(serving.net, input_tensor, tta_views, CALIBRATION_TEMPERATURE))
+    return torch.cat(probs).mean(dim=0, keepdim=True)
+
+# Optional ensemble: ENSEMBLE_MODELS adds members to the main model, as comma-separated
+# name=arch:input_size:weights_path[:weight] entries (any timm model, e.g. a ViT). The main
+# model is member "main" with weight ENSEMBLE_MAIN_WEIGHT. Members run concurrently on a
+# thread pool and their calibrated probabilities are averaged with the weights.
+# With ENSEMBLE_BUDGET_MS set, a request waits at most that long for each member: late
+# members are left out of the average, members whose recent latency is over the budget are
+# not started, and if no member makes the deadline the first one to finish answers alone.
+# Grad-CAM comes from ENSEMBLE_GRADCAM_MEMBER, which needs a conv_head (EfficientNet).
+ENSEMBLE_MODELS = os.environ.get("ENSEMBLE_MODELS", "")
+ENSEMBLE_MAIN_WEIGHT = float(os.environ.get("ENSEMBLE_MAIN_WEIGHT", "1.0"))
+ENSEMBLE_BUDGET_MS = float(os.environ.get("ENSEMBLE_BUDGET_MS", "0"))
+ENSEMBLE_GRADCAM_MEMBER = os.environ.get("ENSEMBLE_GRADCAM_MEMBER", "main")
+# A member skipped for being over budget is tried again after this many skips, so it can
+# rejoin once it is fast enough (e.g. after a load spike)
+ENSEMBLE_RETRY_EVERY = 20
+LATENCY_EWMA_ALPHA = 0.2
+
+class EnsembleMember:
+    def __init__(self, spec):
+        name, _, fields = spec.strip().partition('=')
+        fields = fields.split(':')
+        if len(fields) not in (3, 4):
+            raise ValueError(f"ENSEMBLE_MODELS entry {spec!r} is not name=arch:input_size:path[:weight]")
+        self.name = name
+        self.path = fields[2]
+        self.input_size = int(fields[1])
+        self.weight = float(fields[3]) if len(fields) == 4 else 1.0
+        self.net = load_model(fields[2], device, fields[0])
+
+    @torch.inference_mode()
+    def probs(self, image, tta_views):
+        with model_input(image, self.input_size) as input_tensor:
+            return predict_probs(self.net, input_tensor, tta_views, CALIBRATION_TEMPERATURE)
+
+ensemble_members = {}
+for spec in filter(str.strip, ENSEMBLE_MODELS.split(',')):
+    member = EnsembleMember(spec)
+    if member.name == 'main' or member.name in ensemble_members:
+        raise ValueError(f"duplicate ensemble member name {member.name!r}")
+    ensemble_members[member.name] = member
+if ensemble_members and ENSEMBLE_GRADCAM_MEMBER != 'main' and ENSEMBLE_GRADCAM_MEMBER not in ensemble_members:
+    raise ValueError(f"ENSEMBLE_GRADCAM_MEMBER {ENSEMBLE_GRADCAM_MEMBER!r} is not an ensemble member")
+ensemble_pool = ThreadPoolExecutor(max_workers=len(ensemble_members) + 1) if ensemble_members else None
+
+# Per member: latency (moving average), how often it was used, late, skipped or failed
+ensemble_lock = threading.Lock()
+ensemble_stats = {name: {'latency_ms': None, 'runs': 0, 'used': 0, 'late': 0, 'skipped': 0, 'failed': 0,
+                         'skipped_in_row': 0}
+                  for name in ['main', *ensemble_members]}
+
+def timed_member(name, fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    ms = (time.perf_counter() - start) * 1000
+    with ensemble_lock:
+        stats = ensemble_stats[name]
+        stats['runs'] += 1
+        previous = stats['latency_ms']
+        stats['latency_ms'] = ms if previous is None else previous + LATENCY_EWMA_ALPHA * (ms - previous)
+    return result
+
+def run_ensemble(serving, image, resolution, tta_views, features=None):
+    """Weighted average of the main model and the ensemble members within the latency budget.
+
+    Returns the probabilities, the main model's run_main result (None if it was left out),
+    a summary for the response and the futures of late members that are still running.
+    `features` is passed on to run_main.
+    """
+    jobs = {'main': (ENSEMBLE_MAIN_WEIGHT, run_main, (serving, image, resolution, tta_views, features))}
+    for name, member in ensemble_members.items():
+        jobs[name] = (member.weight, member.probs, (image, tta_views))
+
+    skipped = []
+    if ENSEMBLE_BUDGET_MS:
+        with ensemble_lock:
+            skipped = [name for name in jobs
+                       if (ensemble_stats[name]['latency_ms'] or 0.0) > ENSEMBLE_BUDGET_MS
+                       and ensemble_stats[name]['skipped_in_row'] < ENSEMBLE_RETRY_EVERY]
+            if len(skipped) == len(jobs):
+                # Every member is over budget: degrade to the fastest one
+                skipped.remove(min(skipped, key=lambda name: ensemble_stats[name]['latency_ms']))
+            for name in jobs:
+                stats = ensemble_stats[name]
+                stats['skipped'] += name in skipped
+                stats['skipped_in_row'] = stats['skipped_in_row'] + 1 if name in skipped else 0
+
+    futures = {ensemble_pool.submit(timed_member, name, fn, *args): name
+               for name, (_, fn, args) in jobs.items() if name not in skipped}
+    done, pending = wait(futures, timeout=ENSEMBLE_BUDGET_MS / 1000 if ENSEMBLE_BUDGET_MS else None)
+    finished, failed = [], []
+    while True:
+        for future in done:
+            (failed if future.exception() is not None else finished).append(future)
+        if finished or not pending:
+            break
+        # No member made the deadline: the first one to finish answers alone
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+    for future in failed:
+        print(f"Ensemble member {futures[future]} failed: {future.exception()}")
+    if not finished:
+        raise failed[0].exception()
+
+    results = {futures[future]: future.result() for future in finished}
+    late = {futures[future]: future for future in pending}
+    with ensemble_lock:
+        for name in results:
+            ensemble_stats[name]['used'] += 1
+        for name in late:
+            ensemble_stats[name]['late'] += 1
+        for future in failed:
+            ensemble_stats[futures[future]]['failed'] += 1
+
+    main_result = results.get('main')
+    if main_result is not None:
+        results['main'] = main_result[0]
+    total_weight = sum(jobs[name][0] for name in results)
+    probs = sum(jobs[name][0] / total_weight * member_probs for name, member_probs in results.items())
+    summary = {'members': sorted(results), 'late': sorted(late), 'skipped': sorted(skipped),
+               'failed': sorted(futures[future] for future in failed)}
+    return probs, main_result, summary, late
+
+def ensemble_metrics():
+    with ensemble_lock:
+        stats = {name: dict(s) for name, s in ensemble_stats.items()}
+    members = {}
+    for name, s in stats.items():
+        s.pop('skipped_in_row')
+        if name == 'main':
+            s.update(weight=ENSEMBLE_MAIN_WEIGHT, input_size=active.input_size)
+        else:
+            s.update(weight=ensemble_members[name].weight, input_size=ensemble_members[name].input_size)
+        members[name] = s
+    return {
+        'enabled': bool(ensemble_members),
+        'budget_ms': ENSEMBLE_BUDGET_MS or None,
+        'gradcam_member': ENSEMBLE_GRADCAM_MEMBER,
+        'members': members if ensemble_members else {},
+    }
+
+# Live camera stream over the /stream WebSocket. The client sends downscaled frames (JPEG
+# or PNG bytes, one per binary message) and gets back rolling predictions as JSON. Only the
+# newest frame is classified: frames arriving while one is in the model replace each other,
+# so a slow model never builds a backlog. A frame whose 32x32 grayscale thumbnail differs
+# from the last classified one by less than STREAM_DIFF_THRESHOLD (mean absolute
+# difference, 0-1) is skipped. Frames run on the cascade's fast model if there is one,
+# otherwise on the main model at STREAM_RESOLUTION (0: the smallest serving resolution),
+# without TTA or Grad-CAM. Predictions are averaged over the last STREAM_WINDOW classified
+# frames; `stable` means they all agree with at least STREAM_STABLE_CONFIDENCE.
+STREAM_RESOLUTION = int(os.environ.get("STREAM_RESOLUTION", "0"))
+STREAM_DIFF_THRESHOLD = float(os.environ.get("STREAM_DIFF_THRESHOLD", "0.02"))
+STREAM_WINDOW = int(os.environ.get("STREAM_WINDOW", "5"))
+STREAM_STABLE_CONFIDENCE = float(os.environ.get("STREAM_STABLE_CONFIDENCE", "0.6"))
+STREAM_MAX_FRAME_BYTES = 2 * 1024 * 1024
+STREAM_THUMB_SIZE = 32
+
+class LatestFrame:
+    """Single-slot mailbox: put() replaces a frame that was not taken yet, get() waits for the newest."""
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.frame = None
+        self.closed = False
+        self.received = 0
+        self.dropped = 0
+
+    def put(self, frame):
+        with self.cond:
+            self.received += 1
+            if self.frame is not None:
+                self.dropped += 1
+            self.frame = frame
+            self.cond.notify()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+
+    def get(self):
+        """The newest frame, or None once the client is gone."""
+        with self.cond:
+            while self.frame is None and not self.closed:
+                self.cond.wait()
+            frame, self.frame = self.frame, None
+            return frame
+
+stream_lock = threading.Lock()
+stream_stats = {'connections': 0, 'open': 0, 'received': 0, 'classified': 0, 'skipped': 0, 'dropped': 0}
+
+def record_stream(**counts):
+    with stream_lock:
+        for key, n in counts.items():
+            stream_stats[key] += n
+
+def stream_metrics():
+    with stream_lock:
+        return dict(stream_stats)
 
-# Transform pipeline for EfficientNet
-val_transform = transforms.Compose([
-    transforms.Lambda(lambda img: img.convert('RGB')),
-    transforms.Resize((456,456)),
-    transforms.ToTensor(),
-    transforms.Normalize([0.485,0.456,0.406],[0.229,0.224,0.225])
-])
+def frame_thumbnail(image):
+    gray = image.convert('L').resize((STREAM_THUMB_SIZE, STREAM_THUMB_SIZE), Image.BILINEAR)
+    return np.asarray(gray, dtype=np.float32) / 255.0
 
 def _resize_keep_aspect(width: int, height: int, max_side: int) -> tuple[int, int]:
     if max_side <= 0:
@@ -82,82 +704,245 @@ def _resize_keep_aspect(width: int, height: int, max_side: int) -> tuple[int, in
     scale = max_side / float(longest)
     return max(1, int(round(width * scale))), max(1, int(round(height * scale)))
 
-def generate_gradcam(input_tensor, class_idx, original_image, max_side: int = 512):
-    """Generate Grad-CAM heatmap for the given class."""
-    global gradients, activations, enable_gradcam
+def class_activation_maps(net, input_tensor, classes):
+    """Unnormalized Grad-CAMs of each of `classes` for a batch, shape (len(classes), B, h, w),
+    from one forward and one backward pass."""
+    # EfficientNet's forward, spelled out to keep the output of the last conv layer (conv_head).
+    # No hook and no global state: concurrent passes of the same net (other requests, /stream,
+    # late ensemble members) cannot touch this one's activations. The parameters require grad,
+    # so the graph reaches conv_head
+    x = net.blocks(net.bn1(net.conv_stem(input_tensor)))
+    activations = net.conv_head(x)
+    outputs = net.forward_head(net.bn2(activations))
+    # Gradient of the target class scores w.r.t. the conv_head output only: backpropagates
+    # through the classifier head, not the backbone, and allocates no parameter .grad.
+    # Images of a batch are independent, so the summed score gives each its own gradient
+    if len(classes) == 1:
+        grads, = torch.autograd.grad(outputs[:, classes[0]].sum(), activations)
+        grads = grads.unsqueeze(0)
+    else:
+        # One vector-Jacobian product per class (its one-hot row), batched in a single backward
+        one_hot = torch.zeros(len(classes), *outputs.shape, device=outputs.device, dtype=outputs.dtype)
+        for i, class_idx in enumerate(classes):
+            one_hot[i, :, class_idx] = 1
+        grads, = torch.autograd.grad(outputs, activations, grad_outputs=one_hot, is_grads_batched=True)
+    acts = activations.detach()
     
-    # Enable Grad-CAM mode
-    enable_gradcam = True
+    # Global average pooling of gradients
+    weights = torch.mean(grads, dim=[3, 4], keepdim=True)
     
-    try:
-        # Enable gradients for this forward pass
-        try:
-            model.zero_grad(set_to_none=True)
-        except TypeError:
-            model.zero_grad()
-        input_tensor.requires_grad_(True)
-        
-        # Forward pass
-        outputs = model(input_tensor)
-        
-        # Backward pass for the target class (no need to retain the graph)
-        score = outputs[0, class_idx]
-        score.backward()
-        
-        # Get gradients and activations
-        if gradients is None or activations is None:
-            raise ValueError("Gradients or activations not captured")
-        
-        grads = gradients
-        acts = activations
-        
-        # Global average pooling of gradients
-        weights = torch.mean(grads, dim=[2, 3], keepdim=True)
-        
-        # Weighted combination of activation maps
-        cam = torch.sum(weights * acts, dim=1, keepdim=True)
-        cam = torch.relu(cam)  # ReLU to keep only positive contributions
-        
-        # Normalize
-        cam = cam - cam.min()
-        if cam.max() > 0:
-            cam = cam / cam.max()
-        
-        # Resize to a bounded output size to keep payload + memory under control
-        target_w, target_h = _resize_keep_aspect(original_image.width, original_image.height, max_side)
-        cam = cam.squeeze().cpu().numpy()
-        cam = cv2.resize(cam, (target_w, target_h))
-        
-        # Apply colormap
-        heatmap = cv2.applyColorMap(np.uint8(255 * cam), cv2.COLORMAP_JET)
-        heatmap = cv2.cvtColor(heatmap, cv2.COLOR_BGR2RGB)
-        
+    # Weighted combination of activation maps
+    cam = torch.sum(weights * acts, dim=2)
+    return torch.relu(cam)  # ReLU to keep only positive contributions
+
+def normalize_cam(cam):
+    cam = cam - cam.min()
+    if cam.max() > 0:
+        cam = cam / cam.max()
+    return cam
+
+def generate_gradcams(input_tensor, classes, original_image, max_side: int = 512, net=None):
+    """Grad-CAM heatmaps for each of `classes` (of `net`, default: the main model)."""
+    net = model if net is None else net
+    cams = class_activation_maps(net, input_tensor, classes)[:, 0]
+    return [render_overlay(normalize_cam(cam).cpu().numpy(), original_image, max_side) for cam in cams]
+
+def generate_gradcam(input_tensor, class_idx, original_image, max_side: int = 512, net=None):
+    """Generate Grad-CAM heatmap for the given class (of `net`, default: the main model)."""
+    return generate_gradcams(input_tensor, [class_idx], original_image, max_side, net)[0]
+
+def tiled_gradcams(net, image, layout, classes, original_image, max_side, batch):
+    """Grad-CAMs of a tiled request: for each class, the tiles' maps stitched over the whole image."""
+    maps = []
+    for start in range(0, len(layout['boxes']), batch):
+        with tile_inputs(image, layout, start, start + batch) as input_tensor:
+            maps.append(class_activation_maps(net, input_tensor, classes).cpu().numpy())
+    maps = np.concatenate(maps, axis=1)
+    # Normalized over the whole image, so tiles keep their relative strength
+    return [render_overlay(normalize_cam(stitch(class_maps, layout['boxes'], layout['width'], layout['height'],
+                                                layout['tile_px'])), original_image, max_side)
+            for class_maps in maps]
+
+def render_overlay(cam, original_image, max_side):
+    """Base64 PNG of the [0, 1] CAM as a heatmap over the image, longest side at most `max_side`.
+
+    Works in BGR (OpenCV's order, which the PNG encoder expects) on pooled arrays with
+    in-place ops; per call only the resized original and the PNG itself are allocated.
+    """
+    # Resize to a bounded output size to keep payload + memory under control
+    target_w, target_h = _resize_keep_aspect(original_image.width, original_image.height, max_side)
+    original = original_image.resize((target_w, target_h))
+    if original.mode != 'RGB':
+        original = original.convert('RGB')
+    with buffer_pool.array((target_h, target_w), np.float32) as cam_resized, \
+            buffer_pool.array((target_h, target_w), np.uint8) as cam_u8, \
+            buffer_pool.array((target_h, target_w, 3), np.uint8) as heatmap, \
+            buffer_pool.array((target_h, target_w, 3), np.uint8) as overlay:
+        cv2.resize(cam, (target_w, target_h), dst=cam_resized)
+        np.multiply(cam_resized, 255, out=cam_resized)
+        np.copyto(cam_u8, cam_resized, casting='unsafe')
+        cv2.applyColorMap(cam_u8, cv2.COLORMAP_JET, dst=heatmap)
         # Overlay on original image
-        original_np = np.array(original_image.resize((target_w, target_h)))
-        if len(original_np.shape) == 2:
-            original_np = cv2.cvtColor(original_np, cv2.COLOR_GRAY2RGB)
-        
-        overlay = cv2.addWeighted(original_np, 0.6, heatmap, 0.4, 0)
+        cv2.cvtColor(np.asarray(original), cv2.COLOR_RGB2BGR, dst=overlay)
+        cv2.addWeighted(overlay, 0.6, heatmap, 0.4, 0, dst=overlay)
+        _, buffer = cv2.imencode('.png', overlay)
+    return base64.b64encode(buffer).decode('utf-8')
+
+# Conditional requests and compression. A /predict response carries a weak ETag derived from
+# the image bytes, the model version, the request's options and the serving settings that
+# shape the answer; a client that sends it back in If-None-Match gets 304 Not Modified without
+# the image being scored again. Requests with a lesion_id record a visit, so they are always
+# scored. Responses of COMPRESS_MIN_BYTES or more are compressed with brotli or gzip,
+# whichever the client accepts (brotli first). These are patient images: by default only the
+# browser may keep a response (PREDICT_CACHE_CONTROL), and it must revalidate it.
+PREDICT_CACHE_CONTROL = os.environ.get("PREDICT_CACHE_CONTROL", "private, no-cache")
+COMPRESS_MIN_BYTES = int(os.environ.get("COMPRESS_MIN_BYTES", "1024"))
+# Fast levels: the top ones cost many times the CPU for a few percent on a base64 PNG
+BROTLI_QUALITY = 5
+GZIP_LEVEL = 6
+COMPRESSIBLE_MIMETYPES = {'application/json', 'text/plain', 'text/html'}
+
+# Changes when the server restarts with settings or auxiliary models that change answers
+serving_fingerprint = hashlib.sha256(json.dumps({
+    'unk_threshold': UNK_THRESHOLD,
+    'calibration_temperature': CALIBRATION_TEMPERATURE,
+    'cascade': [file_stamp(CASCADE_MODEL_PATH), CASCADE_INPUT_SIZE, CASCADE_THRESHOLD, CASCADE_TEMPERATURE]
+               if fast_model is not None else None,
+    'resolution_escalation_threshold': RESOLUTION_ESCALATION_THRESHOLD,
+    'ensemble': [ENSEMBLE_MODELS, ENSEMBLE_MAIN_WEIGHT, ENSEMBLE_BUDGET_MS, ENSEMBLE_GRADCAM_MEMBER,
+                 [file_stamp(member.path) for member in ensemble_members.values()]],
+    'tiles': [TILE_OVERLAP, TILE_MAX_TILES],
+    'gradcam_max_side': GRADCAM_MAX_SIDE,
+}, sort_keys=True).encode()).hexdigest()
+
+http_lock = threading.Lock()
+http_stats = {'not_modified': 0, 'compressed': {'br': 0, 'gzip': 0}, 'bytes_uncompressed': 0, 'bytes_sent': 0}
+
+def prediction_etag(img_bytes, serving, options):
+    h = hashlib.sha256(img_bytes)
+    # The memory mode decides whether there is a Grad-CAM and how large it is
+    h.update(json.dumps([serving.version, serving.reference_index_stamp, serving_fingerprint,
+                         memory_governor.level, options]).encode())
+    return h.hexdigest()[:32]
+
+def http_metrics():
+    with http_lock:
+        stats = json.loads(json.dumps(http_stats))
+    stats['compression_ratio'] = (stats['bytes_sent'] / stats['bytes_uncompressed']
+                                  if stats['bytes_uncompressed'] else None)
+    return stats
+
+def input_sizes(serving, resolution, limits):
+    """Every input size a /predict request at `resolution` may run a model at."""
+    sizes = {resolution, serving.input_size}
+    if fast_model is not None:
+        sizes.add(CASCADE_INPUT_SIZE)
+    if ensemble_members and limits['ensemble']:
+        sizes.update(member.input_size for member in ensemble_members.values())
+    return sizes
+
+def infer(serving, image, resolution, tta_views, limits, need_embedding, tiled=False, gradcam_top_k=1):
+    """The model work of a /predict request: classification, embedding and Grad-CAM.
+
+    `image` is a PIL image or, with the pipeline, a PreparedImage. Returns the results as a dict.
+    """
+    full_size = serving.input_size
+    # First pass without gradients for prediction
+    stage, fast_ms, full_ms, fast_confidence = 'tiled' if tiled else 'full', None, None, None
+    ensemble_summary, late_members, layout = None, {}, None
+    # Pooled features of the main model's answering pass, for the embedding
+    main_features = [] if need_embedding else None
+    with torch.inference_mode():
+        if stage == 'tiled':
+            start = time.perf_counter()
+            layout = tile_layout(image, full_size)
+            probs = run_tiled(serving, image, layout, tta_views, limits['tile_batch'])
+            resolution = full_size
+            record_tiles(len(layout['boxes']), (time.perf_counter() - start) * 1000)
+        if fast_model is not None and stage == 'full':
+            start = time.perf_counter()
+            with model_input(image, CASCADE_INPUT_SIZE) as input_tensor:
+                probs = predict_probs(fast_model, input_tensor, tta_views, CASCADE_TEMPERATURE)
+            fast_confidence = probs.max().item()
+            fast_ms = (time.perf_counter() - start) * 1000
+            if fast_confidence >= CASCADE_THRESHOLD:
+                stage = 'fast'
+        if stage == 'full':
+            start = time.perf_counter()
+            if ensemble_members and limits['ensemble']:
+                probs, main_result, ensemble_summary, late_members = run_ensemble(
+                    serving, image, resolution, tta_views, main_features)
+                # resolution is None when the main model did not contribute
+                resolution, escalated = main_result[1:] if main_result is not None else (None, False)
+            else:
+                probs, resolution, escalated = run_main(serving, image, resolution, tta_views, main_features)
+            full_ms = (time.perf_counter() - start) * 1000
+        elif stage == 'fast':
+            resolution = CASCADE_INPUT_SIZE
+        max_prob, predicted = probs.max(1)
         
-        # Convert to base64
-        _, buffer = cv2.imencode('.png', cv2.cvtColor(overlay, cv2.COLOR_RGB2BGR))
-        gradcam_base64 = base64.b64encode(buffer).decode('utf-8')
+        # Check if the model is uncertain (max probability < UNK_THRESHOLD)
+        if max_prob.item() < UNK_THRESHOLD:
+            prediction = 8  # 8 represents "UNKNOWN"
+        else:
+            prediction = predicted.item()
         
-        return gradcam_base64
-    finally:
-        # Always disable Grad-CAM mode and clear state
-        enable_gradcam = False
-        gradients = None
-        activations = None
-        # Help Python free large temporaries promptly in constrained environments (e.g. Cloud Run).
-        gc.collect()
-        if device.type == "cuda":
-            torch.cuda.empty_cache()
+        prob_list = probs.squeeze(0).cpu().tolist()
+        # Add uncertainty class probability (initially 0)
+        prob_list.append(1.0 if max_prob.item() < UNK_THRESHOLD else 0.0)
+    if stage != 'tiled':
+        record_stage(stage, fast_ms, full_ms)
+    if stage == 'full' and resolution is not None:
+        record_resolution(resolution, escalated)
+    
+    embedding = None
+    if need_embedding:
+        if stage != 'full' or resolution != full_size:
+            # Embeddings always come from the main model on the whole image at its full input
+            # size, the space of the stores (build_reference_index.py embeds at that size). A
+            # fresh list: a late ensemble pass of the main model may still append to the other
+            main_features = []
+            with torch.inference_mode(), model_input(image, full_size) as input_tensor:
+                predict_probs(serving.net, input_tensor, 1, 1.0, main_features)
+        # Averaged over TTA views, if any
+        embedding = torch.cat(main_features).float().mean(dim=0).cpu().numpy()
+    
+    # Generate Grad-CAM for the predicted class (or top class if uncertain), and the runner-up
+    # classes if asked, from the model that answered (the designated member of an ensemble)
+    gradcam_classes = [predicted.item()]
+    gradcam_classes += [c for c in probs[0].topk(gradcam_top_k).indices.tolist() if c != gradcam_classes[0]]
+    gradcam_classes = gradcam_classes[:gradcam_top_k]
+    gradcams = None
+    if stage == 'fast':
+        gradcam_net, gradcam_size = fast_model, CASCADE_INPUT_SIZE
+    elif ensemble_summary is not None and ENSEMBLE_GRADCAM_MEMBER != 'main':
+        member = ensemble_members[ENSEMBLE_GRADCAM_MEMBER]
+        gradcam_net, gradcam_size = member.net, member.input_size
+    else:
+        gradcam_net, gradcam_size = serving.net, resolution or full_size
+    
+    try:
+        if limits['gradcam']:
+            # Need to reload tensor for gradient computation
+            overlay_image = image.overlay if isinstance(image, PreparedImage) else image
+            if stage == 'tiled':
+                gradcams = tiled_gradcams(gradcam_net, image, layout, gradcam_classes, overlay_image,
+                                          limits['gradcam_max_side'], limits['tile_batch'])
+            else:
+                with model_input(image, gradcam_size) as input_tensor:
+                    gradcams = generate_gradcams(input_tensor, gradcam_classes, overlay_image,
+                                                 max_side=limits['gradcam_max_side'], net=gradcam_net)
+    except Exception as e:
+        print(f"Grad-CAM generation failed: {e}")
+        gradcams = None
+    
+    return {'prediction': prediction, 'prob_list': prob_list, 'max_confidence': max_prob.item(),
+            'stage': stage, 'resolution': resolution, 'fast_confidence': fast_confidence,
+            'ensemble_summary': ensemble_summary, 'late_members': late_members, 'tiles': layout,
+            'embedding': embedding, 'gradcam_classes': gradcam_classes, 'gradcams': gradcams}
 
 @app.route('/predict', methods=['POST'])
 def predict():
-    global gradients, activations
-    
     print("Received request with files:", list(request.files.keys()))
     print("Received request with form:", list(request.form.keys()))
     if 'file' not in request.files:
@@ -166,57 +951,320 @@ def predict():
     file = request.files['file']
     img_bytes = file.read()
     try:
-        original_image = Image.open(io.BytesIO(img_bytes))
-        # Normalize orientation (EXIF) and ensure a consistent 3-channel RGB image for
-        # both inference and Grad-CAM overlay generation.
-        original_image = ImageOps.exif_transpose(original_image).convert("RGB")
-    except Exception as e:
-        return jsonify({'error': f'Invalid or unsupported image file: {e}'}), 400
-    input_tensor = val_transform(original_image).unsqueeze(0).to(device)
-    
-    # First pass without gradients for prediction
-    with torch.inference_mode():
-        outputs = model(input_tensor)
-        probs = torch.softmax(outputs, dim=-1)
-        max_prob, predicted = probs.max(1)
-        
-        # Check if the model is uncertain (max probability < 0.5)
-        if max_prob.item() < 0.5:
-            prediction = 8  # 8 represents "UNKNOWN"
-        else:
-            prediction = predicted.item()
-        
-        prob_list = probs.squeeze(0).cpu().tolist()
-        # Add uncertainty class probability (initially 0)
-        prob_list.append(1.0 if max_prob.item() < 0.5 else 0.0)
+        tta_views = int(request.form.get('tta', request.args.get('tta', TTA_VIEWS)))
+    except ValueError:
+        return jsonify({'error': 'tta must be an integer'}), 400
+    tta_views = min(max(tta_views, 1), TTA_MAX_VIEWS)
+    # This request runs on the model version active now, even if a swap completes meanwhile
+    serving = active
+    full_size = serving.input_size
+    limits = memory_limits()
+    try:
+        resolution = int(request.form.get('resolution', request.args.get('resolution', SERVE_RESOLUTION or full_size)))
+    except ValueError:
+        return jsonify({'error': 'resolution must be an integer'}), 400
+    allowed_resolutions = sorted(SERVE_RESOLUTIONS | {full_size})
+    if resolution not in allowed_resolutions:
+        return jsonify({'error': f'resolution must be one of {allowed_resolutions}'}), 400
+    return_embedding = request.form.get('embedding', request.args.get('embedding', '0')).lower() in ('1', 'true')
+    try:
+        num_similar = int(request.form.get('similar', request.args.get('similar', 0)))
+    except ValueError:
+        return jsonify({'error': 'similar must be an integer'}), 400
+    num_similar = min(max(num_similar, 0), MAX_SIMILAR)
+    if num_similar and serving.reference_index is None:
+        return jsonify({'error': 'similar cases are not available (no REFERENCE_INDEX_PATH)'}), 400
+    lesion_id = request.form.get('lesion_id', request.args.get('lesion_id'))
+    need_embedding = bool(return_embedding or num_similar or lesion_id)
+    try:
+        gradcam_top_k = int(request.form.get('gradcam_top_k', request.args.get('gradcam_top_k', 1)))
+    except ValueError:
+        return jsonify({'error': 'gradcam_top_k must be an integer'}), 400
+    gradcam_top_k = min(max(gradcam_top_k, 1), GRADCAM_MAX_TOP_K)
+    tiled = request.form.get('tiled', request.args.get('tiled', str(int(TILED_INFERENCE)))).lower() in ('1', 'true')
     
-    # Generate Grad-CAM for the predicted class (or top class if uncertain)
-    gradcam_class = predicted.item()
-    gradcam_base64 = None
+    etag = None
+    if not lesion_id:
+        etag = prediction_etag(img_bytes, serving,
+                               [tta_views, resolution, return_embedding, num_similar, tiled, gradcam_top_k])
+        if request.if_none_match.contains_weak(etag):
+            # The client still has this answer
+            with http_lock:
+                http_stats['not_modified'] += 1
+            response = app.response_class(status=304)
+            response.set_etag(etag, weak=True)
+            response.headers['Cache-Control'] = PREDICT_CACHE_CONTROL
+            return response
     
     try:
-        # Need to reload tensor for gradient computation
-        input_tensor = val_transform(original_image).unsqueeze(0).to(device)
-        gradcam_max_side = int(os.environ.get("GRADCAM_MAX_SIDE", "512"))
-        gradcam_base64 = generate_gradcam(input_tensor, gradcam_class, original_image, max_side=gradcam_max_side)
+        image = None
+        if pipeline is not None:
+            # Decoded and preprocessed by a worker process, into shared memory (None if the
+            # workers are gone)
+            image = pipeline.decode(img_bytes, input_sizes(serving, resolution, limits),
+                                    limits['gradcam_max_side'] if limits['gradcam'] else None,
+                                    (full_size, TILE_OVERLAP, TILE_MAX_TILES) if tiled else None)
+        if image is None:
+            image = Image.open(io.BytesIO(img_bytes))
+            # Normalize orientation (EXIF) and ensure a consistent 3-channel RGB image for
+            # both inference and Grad-CAM overlay generation.
+            image = ImageOps.exif_transpose(image).convert("RGB")
     except Exception as e:
-        print(f"Grad-CAM generation failed: {e}")
-        gradcam_base64 = None
+        return jsonify({'error': f'Invalid or unsupported image file: {e}'}), 400
+    
+    if pipeline is not None:
+        result = None
+        try:
+            result = pipeline.infer(infer, serving, image, resolution, tta_views, limits, need_embedding, tiled,
+                                    gradcam_top_k)
+        finally:
+            if isinstance(image, PreparedImage):
+                # Late ensemble members may still be reading the slot
+                image.release(after=result['late_members'].values() if result is not None else ())
+    else:
+        result = infer(serving, image, resolution, tta_views, limits, need_embedding, tiled, gradcam_top_k)
+    prediction, prob_list, embedding = result['prediction'], result['prob_list'], result['embedding']
     
     response_data = {
         'prediction': prediction,
         'probabilities': prob_list,
-        'max_confidence': max_prob.item()
+        'max_confidence': result['max_confidence'],
+        'tta_views': tta_views,
+        'stage': result['stage'],
+        'resolution': result['resolution'],
+        'model_version': serving.version
     }
+    if memory_governor.level:
+        response_data['memory_mode'] = memory_governor.mode
+    if result['fast_confidence'] is not None:
+        response_data['fast_confidence'] = result['fast_confidence']
+    if result['ensemble_summary'] is not None:
+        response_data['ensemble'] = result['ensemble_summary']
+    if result['tiles'] is not None:
+        response_data['tiles'] = {'count': len(result['tiles']['boxes']), 'grid': list(result['tiles']['grid']),
+                                  'tile_px': result['tiles']['tile_px']}
+    if return_embedding:
+        response_data['embedding'] = embedding.tolist()
+    if num_similar:
+        response_data['similar_cases'] = similar_cases(serving, embedding, num_similar)
+    if lesion_id:
+        response_data['lesion_id'] = lesion_id
+        response_data['change_since_last_visit'] = record_visit(serving, lesion_id, embedding, prediction, prob_list)
     
-    if gradcam_base64:
-        response_data['gradcam'] = gradcam_base64
+    if result['gradcams']:
+        response_data['gradcam'] = result['gradcams'][0]
+        if gradcam_top_k > 1:
+            response_data['gradcams'] = [
+                {'class': c, 'probability': prob_list[c], 'gradcam': gradcam}
+                for c, gradcam in zip(result['gradcam_classes'], result['gradcams'])]
     
-    return jsonify(response_data)
+    response = jsonify(response_data)
+    summary = result['ensemble_summary']
+    if ((limits['gradcam'] and not result['gradcams'])
+            or (summary is not None and (summary['late'] or summary['skipped'] or summary['failed']))):
+        # A degraded answer (failed Grad-CAM, incomplete ensemble): the client must not keep it
+        etag = None
+    if etag is not None:
+        response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = PREDICT_CACHE_CONTROL
+    return response
+
+@torch.inference_mode()
+def classify_frame(net, image, size, temperature):
+    with model_input(image, size) as input_tensor:
+        return predict_probs(net, input_tensor, 1, temperature).squeeze(0).cpu().numpy()
+
+@sock.route('/stream')
+def stream(ws):
+    frames = LatestFrame()
+
+    def receive():
+        try:
+            while True:
+                data = ws.receive()
+                if isinstance(data, (bytes, bytearray)):
+                    frames.put(bytes(data))
+        except ConnectionClosed:
+            pass
+        finally:
+            frames.close()
+
+    threading.Thread(target=receive, daemon=True).start()
+    record_stream(connections=1, open=1)
+    serving = active
+    if fast_model is not None:
+        stage, net, size, temperature = 'fast', fast_model, CASCADE_INPUT_SIZE, CASCADE_TEMPERATURE
+    else:
+        stage, net, temperature = 'full', serving.net, CALIBRATION_TEMPERATURE
+        size = STREAM_RESOLUTION or min(SERVE_RESOLUTIONS | {serving.input_size})
+    window = deque(maxlen=STREAM_WINDOW)
+    last_thumbnail = None
+    classified = skipped = 0
+    reported = {'received': 0, 'dropped': 0}
+    try:
+        while True:
+            data = frames.get()
+            if data is None:
+                break
+            if len(data) > STREAM_MAX_FRAME_BYTES:
+                ws.send(json.dumps({'error': f'frame larger than {STREAM_MAX_FRAME_BYTES} bytes'}))
+                continue
+            try:
+                image = Image.open(io.BytesIO(data)).convert('RGB')
+            except Exception as e:
+                ws.send(json.dumps({'error': f'Invalid or unsupported image frame: {e}'}))
+                continue
+            thumbnail = frame_thumbnail(image)
+            motion = float(np.abs(thumbnail - last_thumbnail).mean()) if last_thumbnail is not None else None
+            if motion is not None and motion < STREAM_DIFF_THRESHOLD:
+                skipped += 1
+                record_stream(skipped=1)
+                continue
+            last_thumbnail = thumbnail
+
+            start = time.perf_counter()
+            if pipeline is not None:
+                # On the inference thread with /predict, which keeps the models to one pass at a time
+                frame_probs = pipeline.infer(classify_frame, net, image, size, temperature)
+            else:
+                frame_probs = classify_frame(net, image, size, temperature)
+            latency_ms = (time.perf_counter() - start) * 1000
+            window.append(frame_probs)
+            classified += 1
+            memory_governor.update()
+
+            rolling = np.mean(window, axis=0)
+            top = int(rolling.argmax())
+            max_prob = float(rolling[top])
+            prediction = 8 if max_prob < UNK_THRESHOLD else top
+            stable = (len(window) == STREAM_WINDOW and max_prob >= STREAM_STABLE_CONFIDENCE
+                      and all(int(p.argmax()) == top for p in window))
+            received, dropped = frames.received, frames.dropped
+            record_stream(classified=1, received=received - reported['received'],
+                          dropped=dropped - reported['dropped'])
+            reported.update(received=received, dropped=dropped)
+            ws.send(json.dumps({
+                'prediction': prediction,
+                'probabilities': rolling.tolist() + [1.0 if max_prob < UNK_THRESHOLD else 0.0],
+                'max_confidence': max_prob,
+                'frame_confidence': float(frame_probs.max()),
+                'stable': stable,
+                'motion': motion,
+                'window': len(window),
+                'latency_ms': latency_ms,
+                'stage': stage,
+                'resolution': size,
+                'model_version': serving.version,
+                'frames': {'received': received, 'classified': classified, 'skipped': skipped, 'dropped': dropped},
+            }))
+    except ConnectionClosed:
+        pass
+    finally:
+        record_stream(open=-1, received=frames.received - reported['received'],
+                      dropped=frames.dropped - reported['dropped'])
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    serving = active
+    with lesion_lock:
+        lesion_store = _lesion_store(serving)
+        stored_visits, dims = len(lesion_store), lesion_store.dim
+    return jsonify({
+        'model_version': serving.version,
+        'cascade': cascade_metrics(),
+        'resolution': resolution_metrics(),
+        'ensemble': ensemble_metrics(),
+        'stream': stream_metrics(),
+        'tiling': tile_metrics(),
+        'memory': memory_governor.stats(),
+        'buffers': buffer_pool.stats(),
+        'pipeline': pipeline.stats() if pipeline is not None else {'enabled': False},
+        'http': http_metrics(),
+        'threads': {
+            'config': THREAD_CONFIG_PATH if thread_config else None,
+            'applied': thread_settings,
+            'intra_op': torch.get_num_threads(),
+            'inter_op': torch.get_num_interop_threads(),
+            'cv2': cv2.getNumThreads(),
+            'tuned': thread_config.get('tuned'),
+        },
+        'embeddings': {
+            'reference_cases': len(serving.reference_index) if serving.reference_index is not None else 0,
+            'stored_visits': stored_visits,
+            'dims': dims,
+        },
+    })
+
+def admin_authorized():
+    # Admin endpoints are disabled unless ADMIN_TOKEN is set
+    if not ADMIN_TOKEN:
+        return False
+    return hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {ADMIN_TOKEN}')
+
+@app.route('/admin/models', methods=['GET'])
+def admin_models():
+    if not admin_authorized():
+        return jsonify({'error': 'Forbidden'}), 403
+    with swap_lock:
+        swap = dict(swap_state)
+    return jsonify({
+        'active': {'version': active.version, 'arch': active.arch, 'input_size': active.input_size},
+        'versions': registry.versions() if registry is not None else [],
+        'swap': swap,
+    })
+
+@app.route('/admin/models/activate', methods=['POST'])
+def admin_activate():
+    """Starts loading a registered version; it replaces the active model once warmed up."""
+    if not admin_authorized():
+        return jsonify({'error': 'Forbidden'}), 403
+    if registry is None:
+        return jsonify({'error': 'No model registry configured (MODEL_REGISTRY_DIR)'}), 400
+    version = (request.get_json(silent=True) or {}).get('version', request.form.get('version'))
+    if not isinstance(version, str):
+        return jsonify({'error': 'version is required'}), 400
+    try:
+        registry.get(version)
+    except KeyError as e:
+        return jsonify({'error': str(e.args[0])}), 404
+    with swap_lock:
+        if swap_state['status'] == 'loading':
+            return jsonify({'error': f"version {swap_state['version']} is still loading"}), 409
+        swap_state.update(status='loading', version=version, error=None, seconds=None)
+    threading.Thread(target=swap_to, args=(version,), daemon=True).start()
+    return jsonify({'status': 'loading', 'version': version}), 202
+
+@app.after_request
+def govern_memory(response):
+    memory_governor.update()
+    return response
+
+@app.after_request
+def compress_response(response):
+    if (response.status_code in (204, 304) or response.direct_passthrough or response.is_streamed
+            or 'Content-Encoding' in response.headers or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+        return response
+    response.vary.add('Accept-Encoding')
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_BYTES:
+        return response
+    if request.accept_encodings.quality('br') > 0:
+        encoding, body = 'br', brotli.compress(data, quality=BROTLI_QUALITY)
+    elif request.accept_encodings.quality('gzip') > 0:
+        encoding, body = 'gzip', gzip.compress(data, compresslevel=GZIP_LEVEL)
+    else:
+        return response
+    response.set_data(body)
+    response.headers['Content-Encoding'] = encoding
+    with http_lock:
+        http_stats['compressed'][encoding] += 1
+        http_stats['bytes_uncompressed'] += len(data)
+        http_stats['bytes_sent'] += len(body)
+    return response
 
 @app.route('/health', methods=['GET'])
 def health():
-    return jsonify({'status': 'healthy'})
+    return jsonify({'status': 'healthy', 'model_version': active.version})
 
 if __name__ == '__main__':
     # Get port from environment variable or default to 5000
@@ -0,0 +1,133 @@
+"""Per-request allocations and latency of the /predict hot path, before and after buffer pooling.
+
+Runs the prediction and Grad-CAM path of app.py in-process on one image, in
+two variants:
+
+- before: a fresh input tensor from the torchvision transform for each pass,
+  and an overlay built from new arrays (the code as it was before the buffer
+  pool);
+- after: the pooled path of app.py (``model_input``, ``generate_gradcam``).
+
+Both compute the CAM itself with ``app.class_activation_maps``, so the
+comparison measures buffer reuse only, not the Grad-CAM gradient.
+
+The variants alternate in rounds, so both see the same machine state. For each
+request, the benchmark counts the minor page faults, i.e. freshly touched memory pages;
+steady-state reuse shows up as near zero. It also records the peak of the
+allocations traced by tracemalloc (NumPy and Python objects; torch tensors are
+not traced) and the latency percentiles.
+
+The model is configured as for the server (MODEL_PATH, MODEL_ARCH, MODEL_INPUT_SIZE):
+
+    MODEL_PATH=model.pth python benchmark_buffers.py --image ISIC-images/ISIC_4117381.jpg
+"""
+
+import argparse
+import base64
+import resource
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+import torch
+from PIL import Image, ImageOps
+
+import app
+
+parser = argparse.ArgumentParser(description='Allocation and tail-latency benchmark of the /predict hot path')
+parser.add_argument('--image', type=str, default='ISIC-images/ISIC_4117381.jpg', help='Path to test image')
+parser.add_argument('--requests', type=int, default=200, help='Measured requests per variant')
+parser.add_argument('--rounds', type=int, default=4, help='Alternating rounds the requests are split into')
+parser.add_argument('--warmup', type=int, default=5, help='Unmeasured requests per variant')
+parser.add_argument('--max_side', type=int, default=app.GRADCAM_MAX_SIDE, help='Grad-CAM overlay size')
+parser.add_argument('--threads', type=int, default=None, help='torch intra-op threads (match the server)')
+args = parser.parse_args()
+
+if args.threads:
+    torch.set_num_threads(args.threads)
+image = ImageOps.exif_transpose(Image.open(args.image)).convert('RGB')
+net, size = app.active.net, app.active.input_size
+transform = app.make_transform(size)
+
+
+def legacy_overlay(cam, original_image, max_side):
+    target_w, target_h = app._resize_keep_aspect(original_image.width, original_image.height, max_side)
+    cam = cv2.resize(cam, (target_w, target_h))
+    heatmap = cv2.applyColorMap(np.uint8(255 * cam), cv2.COLORMAP_JET)
+    heatmap = cv2.cvtColor(heatmap, cv2.COLOR_BGR2RGB)
+    original_np = np.array(original_image.resize((target_w, target_h)))
+    overlay = cv2.addWeighted(original_np, 0.6, heatmap, 0.4, 0)
+    _, buffer = cv2.imencode('.png', cv2.cvtColor(overlay, cv2.COLOR_RGB2BGR))
+    return base64.b64encode(buffer).decode('utf-8')
+
+
+def legacy_gradcam(input_tensor, class_idx):
+    # Same gradient as the pooled path; only the overlay is built the old way
+    cam = app.normalize_cam(app.class_activation_maps(net, input_tensor, [class_idx])[0, 0])
+    return legacy_overlay(cam.cpu().numpy(), image, args.max_side)
+
+
+def before():
+    with torch.inference_mode():
+        probs = app.predict_probs(net, transform(image).unsqueeze(0).to(app.device), 1, 1.0)
+    return legacy_gradcam(transform(image).unsqueeze(0).to(app.device), probs.argmax().item())
+
+
+def after():
+    with torch.inference_mode(), app.model_input(image, size) as input_tensor:
+        probs = app.predict_probs(net, input_tensor, 1, 1.0)
+    with app.model_input(image, size) as input_tensor:
+        return app.generate_gradcam(input_tensor, probs.argmax().item(), image, max_side=args.max_side, net=net)
+
+
+def measure(fn, n, traced):
+    latencies, faults, peaks = [], [], []
+    for _ in range(n):
+        if traced:
+            tracemalloc.reset_peak()
+            start_traced = tracemalloc.get_traced_memory()[0]
+        start_faults = resource.getrusage(resource.RUSAGE_SELF).ru_minflt
+        start = time.perf_counter()
+        fn()
+        latencies.append((time.perf_counter() - start) * 1000)
+        faults.append(resource.getrusage(resource.RUSAGE_SELF).ru_minflt - start_faults)
+        if traced:
+            peaks.append((tracemalloc.get_traced_memory()[1] - start_traced) / 1024)
+    return latencies, faults, peaks
+
+
+# Same Grad-CAM either way (the pooled path is meant to change allocations, not results)
+with torch.inference_mode():
+    probs = app.predict_probs(net, transform(image).unsqueeze(0), 1, 1.0)
+with app.model_input(image, size) as pooled:
+    input_matches = torch.allclose(pooled.cpu(), transform(image).unsqueeze(0), atol=1e-6)
+outputs_match = before() == after()
+
+variants = {'before': before, 'after': after}
+for fn in variants.values():
+    for _ in range(args.warmup):
+        fn()
+results = {name: ([], [], []) for name in variants}
+per_round = max(1, args.requests // args.rounds)
+for _ in range(args.rounds):
+    for name, fn in variants.items():
+        for collected, new in zip(results[name], measure(fn, per_round, traced=False)):
+            collected.extend(new)
+# Tracing slows every allocation down, so it gets its own (untimed) pass
+tracemalloc.start()
+for name, fn in variants.items():
+    results[name][2].extend(measure(fn, min(per_round, 20), traced=True)[2])
+tracemalloc.stop()
+
+print("\n===== Hot Path Allocations =====")
+print(f"Image: {args.image} ({image.width}x{image.height}), model: {app.active.arch} @ {size}, "
+      f"Grad-CAM max side: {args.max_side}, threads: {torch.get_num_threads()}")
+print(f"Identical model input: {input_matches}, identical Grad-CAM PNG: {outputs_match}")
+print(f"{'variant':<8} {'page faults':>12} {'traced KiB':>11} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+for name, (latencies, faults, peaks) in results.items():
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    print(f"{name:<8} {np.mean(faults):>12.0f} {np.mean(peaks):>11.0f} {p50:>8.1f} {p95:>8.1f} {p99:>8.1f} "
+          f"{max(latencies):>8.1f}")
+print(f"Buffer pool: {app.buffer_pool.stats()}")
+print("================================")
@@ -0,0 +1,82 @@
+"""Pool of reusable NumPy arrays and torch tensors for the request hot path.
+
+Steady-state traffic sees the same few shapes (the model input sizes, the
+Grad-CAM overlay size of a given camera), so buffers are kept per
+(kind, shape, dtype) and handed out again instead of being allocated for
+every request. A borrowed buffer holds stale data and must be completely
+overwritten by the borrower. Buffers of the least recently used shapes are
+dropped beyond ``max_shapes``.
+"""
+
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+import torch
+
+
+class BufferPool:
+    def __init__(self, max_shapes=32, max_per_shape=4):
+        self.max_shapes = max_shapes
+        # Concurrent requests each need their own buffer of a shape
+        self.max_per_shape = max_per_shape
+        self.free = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _take(self, key):
+        with self.lock:
+            buffers = self.free.get(key)
+            if buffers:
+                self.free.move_to_end(key)
+                self.hits += 1
+                return buffers.pop()
+            self.misses += 1
+            return None
+
+    def _give(self, key, buffer):
+        with self.lock:
+            buffers = self.free.setdefault(key, [])
+            self.free.move_to_end(key)
+            if len(buffers) < self.max_per_shape:
+                buffers.append(buffer)
+            while len(self.free) > self.max_shapes:
+                self.free.popitem(last=False)
+
+    @contextmanager
+    def array(self, shape, dtype=np.uint8):
+        key = ('array', tuple(shape), np.dtype(dtype).str)
+        buffer = self._take(key)
+        if buffer is None:
+            buffer = np.empty(shape, dtype=dtype)
+        try:
+            yield buffer
+        finally:
+            self._give(key, buffer)
+
+    @contextmanager
+    def tensor(self, shape, dtype=torch.float32):
+        key = ('tensor', tuple(shape), dtype)
+        buffer = self._take(key)
+        if buffer is None:
+            # A tensor created under inference mode could not be written outside of it later
+            with torch.inference_mode(False):
+                buffer = torch.empty(shape, dtype=dtype)
+        try:
+            yield buffer
+        finally:
+            self._give(key, buffer)
+
+    def clear(self):
+        with self.lock:
+            self.free.clear()
+
+    def stats(self):
+        with self.lock:
+            pooled = [b for buffers in self.free.values() for b in buffers]
+            pooled_bytes = sum(b.nbytes if isinstance(b, np.ndarray) else b.numel() * b.element_size()
+                               for b in pooled)
+            return {'hits': self.hits, 'misses': self.misses, 'shapes': len(self.free),
+                    'pooled_mb': round(pooled_bytes / 2**20, 1)}
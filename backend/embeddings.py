@@ -0,0 +1,115 @@
+"""Lesion embedding store with a vectorized cosine-similarity index.
+
+Embeddings are the pooled features of the main model (the input of its
+classifier). An index keeps them L2-normalized in one float16 matrix that
+grows by doubling, so a search is a single float16 matrix-vector product
+(``torch.mv`` on a zero-copy view, no float32 copy of the matrix) and an
+``argpartition``, with no per-entry Python work. Optionally the features
+are first reduced with a PCA projection fitted offline
+(build_reference_index.py), which makes the matrix several times smaller and
+the search proportionally faster.
+
+Two indexes are used by app.py: the read-only reference set (ISIC images with
+known diagnoses, for "similar reference cases") and the per-lesion visit
+history (for "change since last visit").
+"""
+
+import json
+import os
+
+import numpy as np
+import torch
+
+
+class EmbeddingIndex:
+    """Append-only float16 cosine index with string keys and per-row metadata."""
+
+    def __init__(self, dim, capacity=1024, mean=None, components=None):
+        # Optional PCA projection: features -> (features - mean) @ components.T
+        self.mean = None if mean is None else np.asarray(mean, dtype=np.float32)
+        self.components = None if components is None else np.asarray(components, dtype=np.float32)
+        self.dim = dim if self.components is None else self.components.shape[0]
+        self.vectors = np.zeros((capacity, self.dim), dtype=np.float16)
+        self.keys = []
+        self.meta = []
+        self.rows_by_key = {}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def project(self, features):
+        """Normalized (projected) embedding(s) as float32."""
+        x = np.asarray(features, dtype=np.float32)
+        if self.components is not None:
+            x = (x - self.mean) @ self.components.T
+        norm = np.linalg.norm(x, axis=-1, keepdims=True)
+        return x / np.maximum(norm, 1e-12)
+
+    def add(self, key, features, meta=None):
+        """Appends one embedding; returns its row."""
+        row = len(self.keys)
+        if row == len(self.vectors):
+            grown = np.zeros((2 * len(self.vectors), self.dim), dtype=np.float16)
+            grown[:row] = self.vectors
+            self.vectors = grown
+        self.vectors[row] = self.project(features)
+        self.keys.append(key)
+        self.meta.append(meta or {})
+        self.rows_by_key.setdefault(key, []).append(row)
+        return row
+
+    def latest(self, key):
+        """(row, meta) of the most recent embedding stored under ``key``, or None."""
+        rows = self.rows_by_key.get(key)
+        if not rows:
+            return None
+        return rows[-1], self.meta[rows[-1]]
+
+    def similarity(self, row, features):
+        """Cosine similarity between a stored row and new features."""
+        # Clipped: float16 rounding can put an identical pair slightly above 1
+        return float(np.clip(self.vectors[row].astype(np.float32) @ self.project(features), -1.0, 1.0))
+
+    def scores(self, features):
+        """Cosine similarity of ``features`` to every stored embedding, (N,) float32."""
+        query = torch.from_numpy(self.project(features)).half()
+        vectors = torch.from_numpy(self.vectors[:len(self.keys)])
+        return torch.mv(vectors, query).float().numpy()
+
+    def search(self, features, k=5):
+        """Top-``k`` entries as (key, similarity, meta), most similar first."""
+        scores = self.scores(features)
+        k = min(k, len(scores))
+        if k <= 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(self.keys[i], float(scores[i]), self.meta[i]) for i in top]
+
+    def save(self, path):
+        n = len(self.keys)
+        arrays = {'vectors': self.vectors[:n], 'keys': np.asarray(self.keys, dtype=str),
+                  'meta': np.asarray([json.dumps(m) for m in self.meta], dtype=str)}
+        if self.components is not None:
+            arrays.update(mean=self.mean, components=self.components)
+        # Temp file + rename so a crash mid-write never leaves a torn store
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            vectors = data['vectors']
+            projected = 'components' in data.files
+            index = cls(vectors.shape[1], capacity=max(len(vectors), 1),
+                        mean=data['mean'] if projected else None,
+                        components=data['components'] if projected else None)
+            keys, meta = data['keys'].tolist(), data['meta'].tolist()
+        index.vectors[:len(vectors)] = vectors
+        index.keys = keys
+        index.meta = [json.loads(m) for m in meta]
+        for row, key in enumerate(keys):
+            index.rows_by_key.setdefault(key, []).append(row)
+        return index
+
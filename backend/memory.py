@@ -0,0 +1,115 @@
+"""Process memory governor.
+
+Watches the resident set size (RSS) of the server against a memory budget
+(by default the container's cgroup limit, e.g. on Cloud Run) and moves
+between levels as it crosses fractions of that budget. app.py maps each
+level to serving limits (Grad-CAM size or off, smaller TTA batches, no
+ensemble) and evicts its caches when the level goes up.
+
+Going up is immediate; going down happens one level at a time, once RSS is
+``hysteresis`` below the threshold, so the server does not flap around a
+threshold. A forced ``gc.collect()`` only runs when a threshold is crossed
+upwards, not on every request.
+"""
+
+import gc
+import os
+import resource
+import threading
+import time
+from collections import deque
+
+LEVELS = ('normal', 'reduced', 'critical')
+# cgroup v1 reports "no limit" as a huge number
+UNLIMITED = 1 << 60
+
+
+def process_rss():
+    """Current RSS in bytes."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        # No procfs (e.g. macOS): peak RSS, which errs on the safe side (bytes there, KiB on Linux)
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def container_memory_limit():
+    """The cgroup memory limit in bytes, or 0 if there is none."""
+    for path in ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes'):
+        try:
+            with open(path) as f:
+                value = f.read().strip()
+        except OSError:
+            continue
+        if value.isdigit() and int(value) < UNLIMITED:
+            return int(value)
+    return 0
+
+
+class MemoryGovernor:
+    """Tracks the memory level; ``update()`` after each request, ``level`` to read it."""
+
+    def __init__(self, budget, thresholds=(0.75, 0.9), hysteresis=0.05, on_pressure=None, history=20):
+        self.budget = budget
+        self.thresholds = thresholds
+        self.hysteresis = hysteresis
+        # Called with the new level whenever the level goes up, before the forced gc
+        self.on_pressure = on_pressure
+        self.level = 0
+        self.lock = threading.Lock()
+        self.rss = process_rss()
+        self.peak_rss = self.rss
+        self.entered = [0] * len(LEVELS)
+        self.forced_gc = 0
+        self.changes = deque(maxlen=history)
+
+    @property
+    def enabled(self):
+        return self.budget > 0
+
+    @property
+    def mode(self):
+        return LEVELS[self.level]
+
+    def _change(self, level, rss):
+        self.changes.append({'time': time.time(), 'from': LEVELS[self.level], 'to': LEVELS[level],
+                             'rss_mb': round(rss / 2**20, 1)})
+        self.level = level
+        self.entered[level] += 1
+
+    def update(self):
+        """Reads RSS and adjusts the level; returns the level."""
+        if not self.enabled:
+            return self.level
+        with self.lock:
+            rss = process_rss()
+            usage = rss / self.budget
+            target = sum(usage >= t for t in self.thresholds)
+            if target > self.level:
+                self._change(target, rss)
+                if self.on_pressure is not None:
+                    self.on_pressure(target)
+                gc.collect()
+                self.forced_gc += 1
+                rss = process_rss()
+            elif self.level > 0 and usage < self.thresholds[self.level - 1] - self.hysteresis:
+                self._change(self.level - 1, rss)
+            self.rss = rss
+            self.peak_rss = max(self.peak_rss, rss)
+            return self.level
+
+    def stats(self):
+        with self.lock:
+            return {
+                'enabled': self.enabled,
+                'budget_mb': round(self.budget / 2**20, 1) if self.enabled else None,
+                'rss_mb': round(self.rss / 2**20, 1),
+                'peak_rss_mb': round(self.peak_rss / 2**20, 1),
+                'mode': self.mode,
+                'thresholds': list(self.thresholds),
+                'mode_changes': sum(self.entered),
+                'entered': dict(zip(LEVELS, self.entered)),
+                'forced_gc': self.forced_gc,
+                'recent_changes': list(self.changes),
+            }
@@ -0,0 +1,357 @@
+"""Pipelined request preprocessing for /predict.
+
+Uploads are decoded, EXIF-transposed and turned into model inputs by a pool
+of worker processes, in parallel and outside the server's GIL, while a single
+inference thread runs the models: one request is in the model while the next
+ones are being decoded.
+
+Workers write into shared-memory slots owned by the server process, so the
+model inputs reach it without being pickled. A slot holds, for each requested
+input size, the normalized float32 input (the values of ``app.fill_input``),
+then the stack of tile inputs if the request is tiled (see tiling.py), and
+the image downsized for the Grad-CAM overlay. A request holds its
+slot until its response is built, so the number of slots bounds the requests
+in flight and the memory they use; further requests wait for a free slot.
+
+The workers are forked. The pool must be created before the server loads a
+model or starts threads, so they inherit neither. For the same reason a pool
+whose worker died (e.g. killed for memory) is not replaced: forking the
+running server could deadlock on a lock held by another of its threads.
+Decoding then moves into the server process; ``decode`` returns None.
+"""
+
+import atexit
+import io
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+from PIL import Image, ImageOps
+
+from tiling import tile_grid
+
+MEAN = np.array([0.485, 0.456, 0.406], dtype=np.float32).reshape(3, 1, 1)
+STD = np.array([0.229, 0.224, 0.225], dtype=np.float32).reshape(3, 1, 1)
+# Slots grow in steps of this many bytes when a request needs more room
+SLOT_GRANULARITY = 1 << 20
+
+# Worker side: shared-memory slots attached so far, by name
+_attached = {}
+
+
+def _attach(name):
+    shm = _attached.get(name)
+    if shm is None:
+        if len(_attached) >= 64:
+            # Slots that grew were replaced under a new name
+            for old in _attached.values():
+                old.close()
+            _attached.clear()
+        shm = _attached[name] = shared_memory.SharedMemory(name=name)
+    return shm
+
+
+def _overlay_size(width, height, max_side):
+    # Same as app._resize_keep_aspect
+    if max_side <= 0 or max(width, height) <= max_side:
+        return width, height
+    scale = max_side / float(max(width, height))
+    return max(1, int(round(width * scale))), max(1, int(round(height * scale)))
+
+
+def _ping():
+    return True
+
+
+def _normalize_into(image, size, out):
+    pixels = np.asarray(image.resize((size, size), Image.BILINEAR))
+    np.divide(pixels.transpose(2, 0, 1), np.float32(255.0), out=out, dtype=np.float32)
+    out -= MEAN
+    out /= STD
+
+
+def _decode(slot_name, img_bytes, sizes, overlay_side, tiles):
+    """Runs in a worker: decodes `img_bytes` into the slot. Returns where things are in it."""
+    started = time.time()
+    image = ImageOps.exif_transpose(Image.open(io.BytesIO(img_bytes))).convert('RGB')
+    shm = _attach(slot_name)
+    inputs, offset = {}, 0
+    for size in sizes:
+        out = np.ndarray((3, size, size), np.float32, shm.buf, offset)
+        _normalize_into(image, size, out)
+        inputs[size] = offset
+        offset += out.nbytes
+        del out
+    layout = None
+    if tiles is not None:
+        size, overlap, max_tiles = tiles
+        boxes, grid, tile_px = tile_grid(image.width, image.height, size, overlap, max_tiles)
+        out = np.ndarray((len(boxes), 3, size, size), np.float32, shm.buf, offset)
+        for i, box in enumerate(boxes):
+            _normalize_into(image.crop(box), size, out[i])
+        layout = {'boxes': boxes, 'grid': grid, 'tile_px': tile_px, 'width': image.width,
+                  'height': image.height, 'size': size, 'offset': offset}
+        offset += out.nbytes
+        del out
+    overlay = None
+    if overlay_side is not None:
+        width, height = _overlay_size(image.width, image.height, overlay_side)
+        pixels = np.asarray(image.resize((width, height)))
+        if offset + pixels.nbytes <= shm.size:
+            np.ndarray(pixels.shape, np.uint8, shm.buf, offset)[...] = pixels
+            overlay = (width, height, offset)
+        else:
+            # Uncapped overlay (max side 0) of a large image: returned by value instead
+            overlay = (width, height, pixels.tobytes())
+    return {'inputs': inputs, 'tiles': layout, 'overlay': overlay, 'started': started, 'finished': time.time()}
+
+
+class _Slot:
+    def __init__(self):
+        self.shm = None
+
+    def reserve(self, nbytes):
+        if self.shm is not None and self.shm.size >= nbytes:
+            return
+        self.release_memory()
+        nbytes = -(-nbytes // SLOT_GRANULARITY) * SLOT_GRANULARITY
+        self.shm = shared_memory.SharedMemory(create=True, size=nbytes)
+
+    def release_memory(self):
+        if self.shm is None:
+            return
+        self.shm.unlink()
+        try:
+            self.shm.close()
+        except BufferError:
+            # A view of it is still referenced somewhere; the mapping goes with it
+            pass
+        self.shm = None
+
+
+class PreparedImage:
+    """A decoded upload in a slot; ``input(size)`` and ``overlay`` are valid until ``release()``."""
+
+    def __init__(self, pipeline, slot, meta):
+        self.pipeline = pipeline
+        self.slot = slot
+        self.meta = meta
+        self.released = False
+
+    def input(self, size):
+        """The normalized (3, size, size) float32 input, a view of the slot."""
+        return np.ndarray((3, size, size), np.float32, self.slot.shm.buf, self.meta['inputs'][size])
+
+    def tiles(self, start, stop):
+        """Tile inputs start to stop, (stop - start, 3, size, size) float32, a view of the slot."""
+        layout = self.meta['tiles']
+        size = layout['size']
+        stack = np.ndarray((len(layout['boxes']), 3, size, size), np.float32, self.slot.shm.buf, layout['offset'])
+        return stack[start:stop]
+
+    @property
+    def overlay(self):
+        """The image at its Grad-CAM overlay size (a PIL copy)."""
+        width, height, data = self.meta['overlay']
+        if isinstance(data, bytes):
+            return Image.frombytes('RGB', (width, height), data)
+        return Image.fromarray(np.ndarray((height, width, 3), np.uint8, self.slot.shm.buf, data))
+
+    def release(self, after=()):
+        """Returns the slot, once the futures in `after` (still reading from it) are done."""
+        pending = [future for future in after if not future.done()]
+        if not pending:
+            self._release()
+            return
+        lock, remaining = threading.Lock(), [len(pending)]
+
+        def done(_):
+            with lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last:
+                self._release()
+
+        for future in pending:
+            future.add_done_callback(done)
+
+    def _release(self):
+        if not self.released:
+            self.released = True
+            self.pipeline._give(self.slot)
+
+
+class _Stage:
+    """Queue depth and timings of one pipeline stage."""
+
+    def __init__(self):
+        self.queued = 0
+        self.running = 0
+        self.max_queued = 0
+        self.completed = 0
+        self.failed = 0
+        self.wait_ms = 0.0
+        self.service_ms = 0.0
+
+    def stats(self):
+        done = self.completed + self.failed
+        return {'queued': self.queued, 'running': self.running, 'max_queued': self.max_queued,
+                'completed': self.completed, 'failed': self.failed,
+                'avg_wait_ms': round(self.wait_ms / done, 2) if done else None,
+                'avg_service_ms': round(self.service_ms / done, 2) if done else None}
+
+
+class Pipeline:
+    def __init__(self, workers, slots):
+        self.workers = workers
+        # Workers attach to the slots; a tracker of their own would unlink them when they exit
+        resource_tracker.ensure_running()
+        self.decoder = self._start_decoder()
+        self.inference = ThreadPoolExecutor(max_workers=1, thread_name_prefix='inference')
+        self.slots = [_Slot() for _ in range(slots)]
+        self.free = list(self.slots)
+        self.cond = threading.Condition()
+        self.waiting_for_slot = 0
+        self.max_waiting_for_slot = 0
+        self.decode_stage = _Stage()
+        self.inference_stage = _Stage()
+        atexit.register(self.close)
+
+    def _start_decoder(self):
+        pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('fork'))
+        # The first submit forks all the workers, now rather than under load
+        for future in [pool.submit(_ping) for _ in range(self.workers)]:
+            future.result()
+        return pool
+
+    def _take(self):
+        with self.cond:
+            if not self.free:
+                self.waiting_for_slot += 1
+                self.max_waiting_for_slot = max(self.max_waiting_for_slot, self.waiting_for_slot)
+                while not self.free:
+                    self.cond.wait()
+                self.waiting_for_slot -= 1
+            return self.free.pop()
+
+    def _give(self, slot):
+        with self.cond:
+            self.free.append(slot)
+            self.cond.notify()
+
+    def decode(self, img_bytes, sizes, overlay_side=None, tiles=None):
+        """Decodes an upload into model inputs at `sizes` (and the Grad-CAM overlay, unless
+        `overlay_side` is None) in a worker; blocks until done. Raises what decoding raised.
+        Returns None if the workers are gone: the caller decodes the upload itself.
+
+        `tiles` is (tile size, overlap, max tiles) for the tile inputs of a tiled request.
+        """
+        if self.decoder is None:
+            return None
+        sizes = sorted(set(sizes))
+        nbytes = sum(3 * size * size * 4 for size in sizes)
+        if tiles is not None:
+            nbytes += tiles[2] * 3 * tiles[0] * tiles[0] * 4
+        if overlay_side:
+            nbytes += 3 * overlay_side * overlay_side
+        slot = self._take()
+        try:
+            slot.reserve(nbytes)
+            submitted = time.time()
+            with self.cond:
+                stage = self.decode_stage
+                stage.queued += 1
+                stage.max_queued = max(stage.max_queued, stage.queued - self.workers)
+            try:
+                decoder = self.decoder
+                if decoder is None:
+                    raise BrokenProcessPool('decoder stopped')
+                meta = decoder.submit(_decode, slot.shm.name, img_bytes, sizes, overlay_side, tiles).result()
+            except BrokenProcessPool:
+                # A worker died (e.g. killed for memory): stop decoding in workers for good (see
+                # the module docstring); this request and the next ones decode in-process
+                with self.cond:
+                    stage.queued -= 1
+                    stage.failed += 1
+                    if self.decoder is decoder and decoder is not None:
+                        self.decoder = None
+                        decoder.shutdown(wait=False, cancel_futures=True)
+                self._give(slot)
+                return None
+            except Exception:
+                with self.cond:
+                    stage.queued -= 1
+                    stage.failed += 1
+                    stage.service_ms += (time.time() - submitted) * 1000
+                raise
+            with self.cond:
+                stage.queued -= 1
+                stage.completed += 1
+                stage.wait_ms += (meta['started'] - submitted) * 1000
+                stage.service_ms += (meta['finished'] - meta['started']) * 1000
+        except BaseException:
+            self._give(slot)
+            raise
+        return PreparedImage(self, slot, meta)
+
+    def infer(self, fn, *args):
+        """Runs fn(*args) on the inference thread; blocks until done and returns its result."""
+        stage = self.inference_stage
+        submitted = time.perf_counter()
+        with self.cond:
+            stage.queued += 1
+            stage.max_queued = max(stage.max_queued, stage.queued)
+
+        def run():
+            started = time.perf_counter()
+            with self.cond:
+                stage.queued -= 1
+                stage.running += 1
+                stage.wait_ms += (started - submitted) * 1000
+            ok = False
+            try:
+                result = fn(*args)
+                ok = True
+                return result
+            finally:
+                with self.cond:
+                    stage.running -= 1
+                    stage.completed += ok
+                    stage.failed += not ok
+                    stage.service_ms += (time.perf_counter() - started) * 1000
+
+        return self.inference.submit(run).result()
+
+    def trim(self):
+        """Frees the shared memory of the slots not in use (reallocated on demand)."""
+        with self.cond:
+            for slot in self.free:
+                slot.release_memory()
+
+    def stats(self):
+        with self.cond:
+            decode = self.decode_stage.stats()
+            # Requests in the decoder beyond one per worker are waiting for a worker
+            in_decoder = decode['queued']
+            decode.update(queued=max(0, in_decoder - self.workers), running=min(in_decoder, self.workers),
+                          waiting_for_slot=self.waiting_for_slot, max_waiting_for_slot=self.max_waiting_for_slot)
+            return {
+                'enabled': True,
+                'workers': self.workers,
+                'decoding': self.decoder is not None,
+                'slots': {'total': len(self.slots), 'free': len(self.free),
+                          'allocated_mb': round(sum(s.shm.size for s in self.slots if s.shm is not None) / 2**20, 1)},
+                'decode': decode,
+                'inference': self.inference_stage.stats(),
+            }
+
+    def close(self):
+        if self.decoder is not None:
+            self.decoder.shutdown(wait=False, cancel_futures=True)
+        self.inference.shutdown(wait=False)
+        for slot in self.slots:
+            slot.release_memory()
@@ -0,0 +1,106 @@
+"""Structured channel pruning of timm EfficientNets.
+
+Two kinds of channels can be removed without touching the rest of the
+network:
+
+- the expanded (hidden) channels of every MBConv (InvertedResidual) block,
+  i.e. the outputs of ``conv_pw`` / ``conv_dw`` and the inputs of ``conv_pwl``,
+  including the squeeze-excite layers in between. Block inputs and outputs,
+  and with them the residual connections, keep their width.
+- the output channels of ``conv_head``, i.e. the features the classifier sees.
+
+A pruned checkpoint stores the arch name, the kept channel count of every
+pruned layer and the state dict; ``build_pruned_model`` recreates the dense,
+smaller architecture from it (used by ``load_model`` in app.py).
+"""
+
+import copy
+
+import timm
+import torch
+import torch.nn as nn
+
+
+def _select(tensor, idx, dim):
+    return tensor.detach().index_select(dim, idx.to(tensor.device)).clone()
+
+
+def _conv(conv, out_idx=None, in_idx=None):
+    """Copy of ``conv`` restricted to the given output / input channels (same class and padding)."""
+    new = copy.deepcopy(conv)
+    weight = conv.weight
+    if out_idx is not None:
+        weight = _select(weight, out_idx, 0)
+        new.out_channels = len(out_idx)
+        if conv.bias is not None:
+            new.bias = nn.Parameter(_select(conv.bias, out_idx, 0))
+    if conv.groups > 1:
+        # Depthwise: one group per channel
+        new.in_channels = new.groups = new.out_channels
+    elif in_idx is not None:
+        weight = _select(weight, in_idx, 1)
+        new.in_channels = len(in_idx)
+    new.weight = nn.Parameter(weight.clone())
+    return new
+
+
+def _bn(bn, idx):
+    new = copy.deepcopy(bn)
+    new.num_features = len(idx)
+    new.weight = nn.Parameter(_select(bn.weight, idx, 0))
+    new.bias = nn.Parameter(_select(bn.bias, idx, 0))
+    new.running_mean = _select(bn.running_mean, idx, 0)
+    new.running_var = _select(bn.running_var, idx, 0)
+    return new
+
+
+def prunable_layers(model):
+    """Names of the prunable layers: ``blocks.<stage>.<block>`` and ``conv_head``."""
+    names = [name for name, module in model.named_modules()
+             if type(module).__name__ == 'InvertedResidual' and hasattr(module, 'conv_pwl')]
+    return names + ['conv_head']
+
+
+@torch.no_grad()
+def channel_importance(model, name):
+    """Score per channel: |BN scale| times the norm of the weights that consume the channel."""
+    if name == 'conv_head':
+        return model.bn2.weight.abs() * model.classifier.weight.norm(dim=0)
+    block = model.get_submodule(name)
+    return block.bn2.weight.abs() * block.conv_pwl.weight.flatten(1).norm(dim=0)
+
+
+def prune_layer(model, name, keep):
+    """Keeps only the channels ``keep`` (sorted indices) of one prunable layer, in place."""
+    keep = torch.as_tensor(keep, dtype=torch.long)
+    if name == 'conv_head':
+        model.conv_head = _conv(model.conv_head, out_idx=keep)
+        model.bn2 = _bn(model.bn2, keep)
+        classifier = copy.deepcopy(model.classifier)
+        classifier.weight = nn.Parameter(_select(model.classifier.weight, keep, 1))
+        classifier.in_features = len(keep)
+        model.classifier = classifier
+        model.num_features = len(keep)
+        return
+    block = model.get_submodule(name)
+    block.conv_pw = _conv(block.conv_pw, out_idx=keep)
+    block.bn1 = _bn(block.bn1, keep)
+    block.conv_dw = _conv(block.conv_dw, out_idx=keep)
+    block.bn2 = _bn(block.bn2, keep)
+    if hasattr(block.se, 'conv_reduce'):
+        block.se.conv_reduce = _conv(block.se.conv_reduce, in_idx=keep)
+        block.se.conv_expand = _conv(block.se.conv_expand, out_idx=keep)
+    block.conv_pwl = _conv(block.conv_pwl, in_idx=keep)
+
+
+def apply_channels(model, channels):
+    """Shrinks every layer in ``channels`` (name -> kept width) to its first channels, in place."""
+    for name, width in channels.items():
+        prune_layer(model, name, torch.arange(width))
+    return model
+
+
+def build_pruned_model(arch, channels, num_classes=8):
+    """Uninitialized dense model with the channel counts of a pruned checkpoint."""
+    model = timm.create_model(arch, pretrained=False, num_classes=num_classes)
+    return apply_channels(model, channels)
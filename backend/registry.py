@@ -0,0 +1,135 @@
+"""Versioned model registry in a local directory.
+
+Layout::
+
+    <root>/
+        ACTIVE                    name of the version to serve
+        <version>/
+            model.pth             weights (plain or prune_model.py checkpoint)
+            meta.json             {"arch": ..., "input_size": ..., "created": ..., ...}
+            reference_index.npz   optional, from build_reference_index.py
+
+app.py serves the ACTIVE version (or the newest one) at startup and swaps
+versions at runtime through its admin endpoint. Versions are added with:
+
+    python registry.py register models/ v2 --checkpoint model.pth --arch efficientnet_b5 --input_size 456
+    python registry.py list models/
+"""
+
+import argparse
+import json
+import os
+import re
+import shutil
+import time
+
+VERSION_PATTERN = re.compile(r'^[A-Za-z0-9][A-Za-z0-9._-]*$')
+
+
+class ModelRegistry:
+    def __init__(self, root):
+        self.root = root
+
+    def _dir(self, version):
+        if not VERSION_PATTERN.match(version):
+            raise KeyError(f"invalid model version {version!r}")
+        return os.path.join(self.root, version)
+
+    def get(self, version):
+        """Metadata of one version, with absolute file paths; KeyError if unknown."""
+        path = self._dir(version)
+        meta_path = os.path.join(path, 'meta.json')
+        if not os.path.isfile(meta_path):
+            raise KeyError(f"unknown model version {version!r}")
+        with open(meta_path) as f:
+            meta = json.load(f)
+        index_path = os.path.join(path, 'reference_index.npz')
+        meta.update(version=version, path=os.path.join(path, 'model.pth'),
+                    reference_index=index_path if os.path.isfile(index_path) else None)
+        return meta
+
+    def versions(self):
+        """All registered versions, oldest first."""
+        found = []
+        for name in os.listdir(self.root) if os.path.isdir(self.root) else []:
+            try:
+                found.append(self.get(name))
+            except KeyError:
+                continue
+        return sorted(found, key=lambda m: (m.get('created', 0), m['version']))
+
+    def active_version(self):
+        """The ACTIVE version, or the newest one if ACTIVE is missing."""
+        active_path = os.path.join(self.root, 'ACTIVE')
+        if os.path.isfile(active_path):
+            with open(active_path) as f:
+                return f.read().strip()
+        versions = self.versions()
+        if not versions:
+            raise KeyError(f"no model versions in {self.root}")
+        return versions[-1]['version']
+
+    def set_active(self, version):
+        self.get(version)
+        # Temp file + rename: a concurrent reader sees the old or the new name, never a partial one
+        tmp_path = os.path.join(self.root, 'ACTIVE.tmp')
+        with open(tmp_path, 'w') as f:
+            f.write(version + '\n')
+        os.replace(tmp_path, os.path.join(self.root, 'ACTIVE'))
+
+    def register(self, version, checkpoint, arch, input_size, reference_index=None, **extra):
+        path = self._dir(version)
+        if os.path.exists(path):
+            raise ValueError(f"model version {version!r} already exists")
+        tmp_path = path + '.tmp'
+        os.makedirs(tmp_path)
+        shutil.copyfile(checkpoint, os.path.join(tmp_path, 'model.pth'))
+        if reference_index:
+            shutil.copyfile(reference_index, os.path.join(tmp_path, 'reference_index.npz'))
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+            json.dump({'arch': arch, 'input_size': input_size, 'created': time.time(), **extra}, f, indent=2)
+        # The version only becomes visible once all of its files are in place
+        os.replace(tmp_path, path)
+        return self.get(version)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Manage the local model registry')
+    sub = parser.add_subparsers(dest='command', required=True)
+    reg = sub.add_parser('register', help='Add a new model version')
+    reg.add_argument('root', help='Registry directory')
+    reg.add_argument('version', help='Version name, e.g. v3 or 2025-06-01-b5')
+    reg.add_argument('--checkpoint', required=True, help='Weights file')
+    reg.add_argument('--arch', default='efficientnet_b5', help='timm model name')
+    reg.add_argument('--input_size', type=int, default=456, help='Full input resolution')
+    reg.add_argument('--reference_index', default=None, help='Index from build_reference_index.py')
+    reg.add_argument('--notes', default='', help='Free-form description')
+    reg.add_argument('--activate', action='store_true', help='Also make it the ACTIVE version')
+    ls = sub.add_parser('list', help='List versions')
+    ls.add_argument('root', help='Registry directory')
+    act = sub.add_parser('activate', help='Set the ACTIVE version (read at server startup)')
+    act.add_argument('root', help='Registry directory')
+    act.add_argument('version', help='Version name')
+    args = parser.parse_args()
+
+    registry = ModelRegistry(args.root)
+    if args.command == 'register':
+        os.makedirs(args.root, exist_ok=True)
+        meta = registry.register(args.version, args.checkpoint, args.arch, args.input_size,
+                                 reference_index=args.reference_index, notes=args.notes)
+        if args.activate:
+            registry.set_active(args.version)
+        print(f"Registered {meta['version']} ({meta['arch']} @ {meta['input_size']}) in {args.root}")
+    elif args.command == 'activate':
+        registry.set_active(args.version)
+        print(f"Active version: {args.version}")
+    else:
+        active = registry.active_version() if registry.versions() else None
+        for meta in registry.versions():
+            marker = '*' if meta['version'] == active else ' '
+            print(f"{marker} {meta['version']:<20} {meta['arch']:<20} {meta['input_size']:>4} "
+                  f"{time.strftime('%Y-%m-%d %H:%M', time.localtime(meta.get('created', 0)))}  {meta.get('notes', '')}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""CPU threading configuration of the serving process.
+
+By default PyTorch and OpenCV each start a thread per core of the host, not
+per core the container may use, and every concurrent request multiplies
+that, so under load they oversubscribe the CPUs. tune_threads.py benchmarks
+settings on the actual host and saves the best one as JSON; app.py applies it
+at startup with ``apply_config()``, before any model runs:
+
+    {"intra_op_threads": 4, "inter_op_threads": 1, "cv2_threads": 1,
+     "preprocess_workers": 2, "tile_batch": 4, "tuned": {...}}
+
+Every key is optional. ``preprocess_workers`` and ``tile_batch`` are defaults
+for PREPROCESS_WORKERS and TILE_BATCH. Without a config, PyTorch gets one
+intra-op thread per available CPU.
+"""
+
+import json
+import math
+import os
+
+import cv2
+import torch
+
+
+def available_cpus():
+    """CPUs this process may use: its affinity mask, capped by the cgroup CPU quota."""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        # No affinity API (macOS)
+        cpus = os.cpu_count() or 1
+    for path in ('/sys/fs/cgroup/cpu.max', '/sys/fs/cgroup/cpu/cpu.cfs_quota_us'):
+        try:
+            with open(path) as f:
+                fields = f.read().split()
+            if path.endswith('cfs_quota_us'):
+                with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as f:
+                    fields.append(f.read().strip())
+        except OSError:
+            continue
+        # "max 100000" (v2) or "-1" (v1) means no quota
+        if len(fields) == 2 and fields[0].isdigit() and fields[1].isdigit():
+            cpus = min(cpus, max(1, math.ceil(int(fields[0]) / int(fields[1]))))
+        break
+    return cpus
+
+
+def load_config(path):
+    """The saved configuration at `path`, or {} if there is none."""
+    if not path or not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def apply_config(config):
+    """Sets the thread counts of `config`; returns what was applied."""
+    applied = {'intra_op_threads': config.get('intra_op_threads') or available_cpus()}
+    torch.set_num_threads(applied['intra_op_threads'])
+    if config.get('inter_op_threads'):
+        try:
+            torch.set_num_interop_threads(config['inter_op_threads'])
+            applied['inter_op_threads'] = config['inter_op_threads']
+        except RuntimeError as e:
+            # Only possible before any inter-op parallel work has started
+            print(f"Could not set inter-op threads: {e}")
+    if config.get('cv2_threads') is not None:
+        cv2.setNumThreads(config['cv2_threads'])
+        applied['cv2_threads'] = config['cv2_threads']
+    return applied
@@ -0,0 +1,62 @@
+"""Tile layout for tiled inference on large images.
+
+Squashing a whole 6000x4000 dermoscopy image into one square model input
+distorts its aspect ratio and loses the fine structure of small lesions.
+Tiled inference classifies overlapping square crops instead, each resized to
+the model input size, and aggregates them.
+
+Tiles are ``tile_px`` source pixels wide. ``tile_px`` starts at the model
+input size (tiles at native resolution) and grows until the grid has at
+most ``max_tiles`` tiles, so the cost per image is bounded whatever its size.
+
+Used by app.py and by the preprocessing workers of pipeline.py.
+"""
+
+import math
+
+import cv2
+import numpy as np
+
+
+def tile_grid(width, height, tile_size, overlap, max_tiles):
+    """Tiles covering a width x height image.
+
+    Returns (boxes, (columns, rows), tile_px); boxes are (left, upper, right,
+    lower) source pixel boxes, in PIL's order, row by row.
+    """
+    limit = min(width, height)
+    tile_px = min(tile_size, limit)
+    while True:
+        stride = tile_px * (1 - overlap)
+        columns = math.ceil(max(0, width - tile_px) / stride) + 1
+        rows = math.ceil(max(0, height - tile_px) / stride) + 1
+        if columns * rows <= max_tiles or tile_px >= limit:
+            break
+        tile_px = min(limit, math.ceil(tile_px * 1.1))
+    if columns * rows > max_tiles:
+        # Very elongated image: fewer tiles along its long side, overlapping less (or with gaps)
+        if columns > rows:
+            columns = max(1, max_tiles // rows)
+        else:
+            rows = max(1, max_tiles // columns)
+    xs = np.linspace(0, width - tile_px, columns).round().astype(int)
+    ys = np.linspace(0, height - tile_px, rows).round().astype(int)
+    boxes = [(int(x), int(y), int(x) + tile_px, int(y) + tile_px) for y in ys for x in xs]
+    return boxes, (columns, rows), tile_px
+
+
+def stitch(maps, boxes, width, height, tile_px):
+    """Averages per-tile maps (N, h, w) into one map of the whole image, where tiles overlap.
+
+    The result keeps the maps' own resolution (h / tile_px per source pixel).
+    """
+    scale = maps.shape[1] / tile_px
+    canvas_w, canvas_h = max(1, round(width * scale)), max(1, round(height * scale))
+    total = np.zeros((canvas_h, canvas_w), np.float32)
+    count = np.zeros((canvas_h, canvas_w), np.float32)
+    for tile_map, (left, upper, right, lower) in zip(maps, boxes):
+        x0, y0 = min(round(left * scale), canvas_w - 1), min(round(upper * scale), canvas_h - 1)
+        x1, y1 = max(x0 + 1, min(round(right * scale), canvas_w)), max(y0 + 1, min(round(lower * scale), canvas_h))
+        total[y0:y1, x0:x1] += cv2.resize(tile_map.astype(np.float32), (x1 - x0, y1 - y0))
+        count[y0:y1, x0:x1] += 1
+    return np.divide(total, count, out=np.zeros_like(total), where=count > 0)
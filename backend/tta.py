@@ -0,0 +1,60 @@
+"""Batched test-time augmentation.
+
+All views of a batch are built with tensor ops on the batch's device
+(flips, 90-degree rotations and transposes, i.e. the dihedral group of the
+square, which is lossless on the 456x456 inputs) and run through the model
+in a single enlarged forward pass. Probabilities are averaged over views.
+
+Used by ``/predict`` in app.py and by the training notebook's
+``tta_predict`` (imported as ``backend.tta``), so it must not depend on
+anything else in the backend.
+"""
+
+import torch
+
+# Ordered so that the first n views are a sensible n-view policy.
+VIEWS = {
+    'identity': lambda x: x,
+    'hflip': lambda x: x.flip(-1),
+    'vflip': lambda x: x.flip(-2),
+    'rot180': lambda x: x.flip(-1, -2),
+    'rot90': lambda x: x.rot90(1, dims=(-2, -1)),
+    'rot270': lambda x: x.rot90(-1, dims=(-2, -1)),
+    'transpose': lambda x: x.transpose(-2, -1),
+    'antitranspose': lambda x: x.flip(-1, -2).transpose(-2, -1),
+}
+MAX_VIEWS = len(VIEWS)
+
+
+class BatchTTA:
+    """Averages softmax outputs over the first ``num_views`` views in ``VIEWS``.
+
+    ``max_batch`` bounds the size of a single forward pass (views x batch);
+    larger stacks are split into chunks of at most that many images.
+    """
+
+    def __init__(self, num_views=MAX_VIEWS, max_batch=None):
+        if not 1 <= num_views <= MAX_VIEWS:
+            raise ValueError(f"num_views must be between 1 and {MAX_VIEWS}, got {num_views}")
+        self.num_views = num_views
+        self.views = list(VIEWS.values())[:num_views]
+        self.max_batch = max_batch
+
+    def augment(self, x):
+        """(B, C, H, W) -> (V * B, C, H, W), view-major. Views that swap H and W need square inputs."""
+        return torch.cat([view(x) for view in self.views], dim=0)
+
+    def logits(self, model, x):
+        """Per-view logits, shape (V, B, num_classes)."""
+        stacked = self.augment(x)
+        if self.max_batch and stacked.shape[0] > self.max_batch:
+            out = torch.cat([model(chunk) for chunk in stacked.split(self.max_batch)], dim=0)
+        else:
+            out = model(stacked)
+        return out.view(self.num_views, x.shape[0], -1)
+
+    def predict(self, model, x):
+        """Mean softmax over views, shape (B, num_classes)."""
+        return self.logits(model, x).softmax(dim=-1).mean(dim=0)
+
+    __call__ = predict
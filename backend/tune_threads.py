@@ -0,0 +1,205 @@
+"""Thread autotuner: benchmarks CPU thread settings of the server on this host and saves the best.
+
+Each trial starts a fresh process with one candidate configuration (inter-op
+threads can only be set before PyTorch's first parallel work), imports app.py
+with it applied through THREAD_CONFIG_PATH, and drives /predict with
+--concurrency concurrent clients on one image, end to end: decoding, the
+model, Grad-CAM and the response. A trial reports throughput and latency
+percentiles.
+
+The search runs in three stages, each keeping the best result of the previous
+one, since the full grid would take hours with a large model:
+
+1. PyTorch intra-op x inter-op threads x OpenCV threads;
+2. preprocessing worker processes (PREPROCESS_WORKERS, 0 = decode in the request thread);
+3. tiles per forward pass (TILE_BATCH). Only tiled requests use it, so this
+   stage always benchmarks tiled requests; --tiled makes the first two do so too.
+
+The best configuration has the highest throughput among those within
+--max_p95_ms (if set). It is written to --output, which the server reads from
+THREAD_CONFIG_PATH (default thread_config.json). The model is configured as
+for the server (MODEL_PATH, MODEL_ARCH, MODEL_INPUT_SIZE, ...):
+
+    MODEL_PATH=model.pth python tune_threads.py --image ISIC-images/ISIC_4117381.jpg --concurrency 4
+"""
+
+import argparse
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from threads import available_cpus
+
+RESULT_PREFIX = 'TRIAL_RESULT '
+
+
+def run_trial(args):
+    """Runs in the trial process: the configuration is already applied by importing app."""
+    import app
+
+    with open(args.image, 'rb') as f:
+        img_bytes = f.read()
+    form = {'tiled': '1'} if args.tiled else {}
+
+    def client(n):
+        c = app.app.test_client()
+        latencies = []
+        for _ in range(n):
+            start = time.perf_counter()
+            r = c.post('/predict', data={'file': (io.BytesIO(img_bytes), 'image.jpg'), **form},
+                       content_type='multipart/form-data')
+            if r.status_code != 200:
+                raise RuntimeError(f"/predict returned {r.status_code}: {r.get_data(as_text=True)}")
+            latencies.append((time.perf_counter() - start) * 1000)
+        return latencies
+
+    per_client = [args.requests // args.concurrency + (i < args.requests % args.concurrency)
+                  for i in range(args.concurrency)]
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        list(pool.map(client, [args.warmup] * args.concurrency))
+        start = time.perf_counter()
+        latencies = [ms for result in pool.map(client, per_client) for ms in result]
+        seconds = time.perf_counter() - start
+    p50, p95 = np.percentile(latencies, [50, 95])
+    print(RESULT_PREFIX + json.dumps({'requests_per_s': len(latencies) / seconds, 'p50_ms': p50, 'p95_ms': p95,
+                                      'model': f"{app.active.arch}@{app.active.input_size}"}))
+
+
+def trial(config, tiled):
+    """Runs one configuration in a fresh process, on tiled requests or not; returns its result,
+    or None if it failed."""
+    with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as f:
+        json.dump(config, f)
+    env = dict(os.environ, THREAD_CONFIG_PATH=f.name)
+    # The configuration under test, not the environment, sets these
+    for name in ('PREPROCESS_WORKERS', 'TILE_BATCH'):
+        env.pop(name, None)
+    try:
+        argv = [arg for arg in sys.argv[1:] if arg != '--tiled'] + (['--tiled'] if tiled else [])
+        proc = subprocess.run([sys.executable, __file__, '--trial', f.name, *argv], env=env,
+                              capture_output=True, text=True)
+    finally:
+        os.unlink(f.name)
+    for line in reversed(proc.stdout.splitlines()):
+        if line.startswith(RESULT_PREFIX):
+            result = json.loads(line[len(RESULT_PREFIX):])
+            print(f"  {describe(config)}: {result['requests_per_s']:.2f} req/s, p95 {result['p95_ms']:.0f} ms")
+            return result
+    print(f"  {describe(config)}: failed\n{proc.stderr[-2000:]}")
+    return None
+
+
+def describe(config):
+    return ', '.join(f"{key}={value}" for key, value in config.items())
+
+
+def best_of(results, max_p95_ms):
+    finished = [(config, result) for config, result in results if result is not None]
+    if not finished:
+        sys.exit("Every trial failed")
+    eligible = [(config, result) for config, result in finished
+                if max_p95_ms is None or result['p95_ms'] <= max_p95_ms]
+    if not eligible:
+        # Nothing meets the latency target: the lowest p95 is the closest
+        return min(finished, key=lambda cr: cr[1]['p95_ms'])
+    return max(eligible, key=lambda cr: cr[1]['requests_per_s'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark and save the CPU thread settings of the server')
+    parser.add_argument('--image', type=str, default='ISIC-images/ISIC_4117381.jpg', help='Path to test image')
+    parser.add_argument('--concurrency', type=int, default=4, help='Concurrent clients (the expected load)')
+    parser.add_argument('--requests', type=int, default=40, help='Measured requests per trial')
+    parser.add_argument('--warmup', type=int, default=2, help='Unmeasured requests per client and trial')
+    parser.add_argument('--tiled', action='store_true', help='Benchmark tiled requests in every stage')
+    parser.add_argument('--max_p95_ms', type=float, default=None, help='Only pick configurations within this p95')
+    parser.add_argument('--max_workers', type=int, default=None, help='Most preprocessing workers to try')
+    parser.add_argument('--output', type=str, default='thread_config.json',
+                        help='Where to save the best configuration')
+    parser.add_argument('--trial', type=str, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.trial:
+        run_trial(args)
+        return
+
+    cpus = available_cpus()
+    thread_counts = sorted({n for n in (1, 2, 4, 8, 16, 32) if n < cpus} | {cpus})
+    results = []
+
+    print(f"Stage 1/3: PyTorch and OpenCV threads ({cpus} CPUs available)")
+    stage = []
+    for intra in thread_counts:
+        for inter in sorted({1, 2} & set(range(1, cpus + 1))):
+            for cv2_threads in sorted({1, intra}):
+                config = {'intra_op_threads': intra, 'inter_op_threads': inter, 'cv2_threads': cv2_threads,
+                          'preprocess_workers': 0}
+                stage.append((config, args.tiled, trial(config, args.tiled)))
+    results += stage
+    best = best_of([(config, result) for config, _, result in stage], args.max_p95_ms)
+
+    print("Stage 2/3: preprocessing workers")
+    stage = [(best[0], args.tiled, best[1])]
+    max_workers = args.max_workers if args.max_workers is not None else max(1, cpus // 2)
+    for workers in [n for n in (1, 2, 4, 8) if n <= max_workers]:
+        config = dict(best[0], preprocess_workers=workers)
+        stage.append((config, args.tiled, trial(config, args.tiled)))
+    results += stage[1:]
+    best = best_of([(config, result) for config, _, result in stage], args.max_p95_ms)
+
+    print("Stage 3/3: tiles per forward pass (tiled requests)")
+    stage = []
+    for tile_batch in (1, 2, 4, 8):
+        config = dict(best[0], tile_batch=tile_batch)
+        stage.append((config, True, trial(config, True)))
+    results += stage
+    best_batch = best_of([(config, result) for config, _, result in stage], args.max_p95_ms)
+    if args.tiled:
+        best = best_batch
+    else:
+        # The throughput reported is that of the requests benchmarked in the first two stages
+        best = (dict(best[0], tile_batch=best_batch[0]['tile_batch']), best[1])
+
+    config, result = best
+    config = dict(config, tuned={
+        'host': platform.node(),
+        'cpus': cpus,
+        'model': result['model'],
+        'concurrency': args.concurrency,
+        'tiled': args.tiled,
+        'requests_per_s': round(result['requests_per_s'], 2),
+        'p50_ms': round(result['p50_ms'], 1),
+        'p95_ms': round(result['p95_ms'], 1),
+        'time': time.time(),
+    })
+    with open(args.output, 'w') as f:
+        json.dump(config, f, indent=2)
+
+    print("\n===== Thread Autotuning =====")
+    print(f"Host: {platform.node()}, {cpus} CPUs, model: {result['model']}, concurrency: {args.concurrency}"
+          f"{', tiled' if args.tiled else ''}")
+    print(f"{'intra':>5} {'inter':>5} {'cv2':>4} {'workers':>7} {'batch':>5} {'tiled':>5} {'req/s':>7} "
+          f"{'p50 ms':>8} {'p95 ms':>8}")
+    for trial_config, tiled, trial_result in results:
+        marker = ' *' if trial_config == best[0] else ''
+        if trial_result is None:
+            stats = f"{'failed':>25}"
+        else:
+            stats = f"{trial_result['requests_per_s']:>7.2f} {trial_result['p50_ms']:>8.1f} {trial_result['p95_ms']:>8.1f}"
+        print(f"{trial_config['intra_op_threads']:>5} {trial_config['inter_op_threads']:>5} "
+              f"{trial_config['cv2_threads']:>4} {trial_config['preprocess_workers']:>7} "
+              f"{trial_config.get('tile_batch', '-'):>5} {'yes' if tiled else 'no':>5} {stats}{marker}")
+    print(f"Best: {describe(best[0])}, saved to {args.output}")
+    print("=============================")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+"""Batched tensor-space augmentation for training.
+
+The PIL ``train_transform`` in the notebook runs rotation, affine, flips,
+colour jitter and resize per image inside the DataLoader workers. Here the
+workers only decode, square-crop and resize to a uint8 tensor
+(``decode_transform``); the random policy is then applied to the whole batch
+at once on whatever device the batch lives on:
+
+- rotation, the optional small affine (translate/scale) and both flips are
+  folded into one 2x3 matrix per sample and applied with a single
+  ``affine_grid`` + ``grid_sample`` call,
+- brightness and contrast jitter are per-sample factors broadcast over the
+  batch,
+- normalization happens last, on the same tensor.
+
+Rotation is applied to the square crop rather than to the full image before
+cropping, and out-of-image pixels are filled with black for both rotation
+and affine (the PIL ``RandomAffine`` used a grey fill).
+"""
+
+import math
+
+import torch
+import torch.nn.functional as F
+from torchvision import transforms
+
+from isic_data import CenterSquareCrop, IMAGENET_MEAN, IMAGENET_STD
+
+
+def decode_transform(size=456):
+    """Worker-side transform: RGB, center square crop, resize, uint8 CHW tensor."""
+    return transforms.Compose([
+        transforms.Lambda(lambda img: img.convert('RGB')),
+        CenterSquareCrop(),
+        transforms.Resize((size, size)),
+        transforms.PILToTensor(),
+    ])
+
+
+class BatchAugment:
+    """Applies the training augmentation policy to a uint8 batch (B, 3, H, W).
+
+    Defaults mirror the notebook's ``train_transform``. Returns a normalized
+    float32 batch on the input's device.
+    """
+
+    def __init__(self, degrees=45.0, hflip_p=0.5, vflip_p=0.5,
+                 affine_p=0.5, affine_degrees=0.5, translate=(0.1, 0.1), scale=(1.0, 1.05),
+                 brightness=0.2, contrast=0.2,
+                 mean=IMAGENET_MEAN, std=IMAGENET_STD, generator=None):
+        self.degrees = degrees
+        self.hflip_p = hflip_p
+        self.vflip_p = vflip_p
+        self.affine_p = affine_p
+        self.affine_degrees = affine_degrees
+        self.translate = translate
+        self.scale = scale
+        self.brightness = brightness
+        self.contrast = contrast
+        self.mean = mean
+        self.std = std
+        self.generator = generator
+
+    def _uniform(self, n, low, high, device):
+        return torch.rand(n, generator=self.generator, device=device) * (high - low) + low
+
+    def _bernoulli(self, n, p, device):
+        return torch.rand(n, generator=self.generator, device=device) < p
+
+    def affine_matrices(self, n, device):
+        """Per-sample 2x3 matrices in the normalized coordinates used by affine_grid."""
+        angle = self._uniform(n, -self.degrees, self.degrees, device)
+        tx = torch.zeros(n, device=device)
+        ty = torch.zeros(n, device=device)
+        scale = torch.ones(n, device=device)
+
+        # RandomApply([RandomAffine(...)], p=affine_p)
+        apply = self._bernoulli(n, self.affine_p, device)
+        angle = angle + apply * self._uniform(n, -self.affine_degrees, self.affine_degrees, device)
+        # Translations are fractions of the image size; normalized coordinates span 2.
+        tx = torch.where(apply, self._uniform(n, -self.translate[0], self.translate[0], device) * 2, tx)
+        ty = torch.where(apply, self._uniform(n, -self.translate[1], self.translate[1], device) * 2, ty)
+        scale = torch.where(apply, self._uniform(n, self.scale[0], self.scale[1], device), scale)
+
+        fx = torch.where(self._bernoulli(n, self.hflip_p, device), -1.0, 1.0)
+        fy = torch.where(self._bernoulli(n, self.vflip_p, device), -1.0, 1.0)
+
+        # affine_grid maps output coordinates to input coordinates, so build the
+        # inverse transform: p_in = flip(rotate(p_out - t) / scale).
+        rad = angle * (math.pi / 180.0)
+        cos, sin = torch.cos(rad) / scale, torch.sin(rad) / scale
+        a = torch.stack([
+            torch.stack([fx * cos, -fx * sin], dim=-1),
+            torch.stack([fy * sin, fy * cos], dim=-1),
+        ], dim=1)
+        t = torch.stack([tx, ty], dim=-1).unsqueeze(-1)
+        return torch.cat([a, -(a @ t)], dim=2)
+
+    def color_jitter(self, x):
+        n = x.shape[0]
+        if self.brightness:
+            b = self._uniform(n, 1 - self.brightness, 1 + self.brightness, x.device)
+            x = (x * b.view(n, 1, 1, 1)).clamp_(0, 1)
+        if self.contrast:
+            c = self._uniform(n, 1 - self.contrast, 1 + self.contrast, x.device).view(n, 1, 1, 1)
+            # Same grayscale weights as torchvision's adjust_contrast.
+            gray = (0.299 * x[:, 0] + 0.587 * x[:, 1] + 0.114 * x[:, 2]).mean(dim=(1, 2)).view(n, 1, 1, 1)
+            x = ((x - gray) * c + gray).clamp_(0, 1)
+        return x
+
+    def normalize(self, x):
+        mean = torch.tensor(self.mean, device=x.device, dtype=x.dtype).view(1, 3, 1, 1)
+        std = torch.tensor(self.std, device=x.device, dtype=x.dtype).view(1, 3, 1, 1)
+        return (x - mean) / std
+
+    @torch.no_grad()
+    def __call__(self, images):
+        x = images.float() / 255
+        n = x.shape[0]
+        theta = self.affine_matrices(n, x.device)
+        grid = F.affine_grid(theta, list(x.shape), align_corners=False)
+        x = F.grid_sample(x, grid, mode='bilinear', padding_mode='zeros', align_corners=False)
+        x = self.color_jitter(x)
+        return self.normalize(x)
@@ -0,0 +1,119 @@
+"""Microbenchmark of ISICDataset per-item overhead.
+
+Compares the original per-sample lookup (string replace, os.path.exists per
+directory, two df.iloc calls) against the precomputed path index in
+isic_data.ISICDataset. No transform is applied and PIL only reads the image
+header, so the numbers isolate the lookup cost rather than JPEG decoding.
+
+Usage:
+    python bench_dataset.py                          # synthetic dataset in a temp dir
+    python bench_dataset.py --csv gt.csv --img_dirs dirA dirB
+"""
+
+import argparse
+import os
+import statistics
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+from PIL import Image
+
+from isic_data import ISICDataset
+
+
+class LegacyISICDataset:
+    """The original lookup logic, kept here only as the benchmark baseline."""
+
+    def __init__(self, df, img_dirs):
+        self.df = df
+        self.img_dirs = img_dirs if isinstance(img_dirs, list) else [img_dirs]
+
+    def __len__(self):
+        return len(self.df)
+
+    def __getitem__(self, idx):
+        raw_name = self.df.iloc[idx]['image']
+        base_name = raw_name.replace('.jpg', '')
+        name = base_name + '.jpg'
+
+        img = None
+        for d in self.img_dirs:
+            img_path = os.path.join(d, name)
+            if os.path.exists(img_path):
+                img = Image.open(img_path)
+                break
+
+        if img is None:
+            raise FileNotFoundError(f"Image {name} not found in any of {self.img_dirs}")
+
+        label = int(self.df.iloc[idx]['single_label'])
+        return img, label
+
+
+def make_synthetic(root, count, num_dirs):
+    img_dirs = [os.path.join(root, f'dir{i}') for i in range(num_dirs)]
+    for d in img_dirs:
+        os.makedirs(d)
+    tiny = Image.new('RGB', (8, 8), (128, 64, 32))
+    names = []
+    for i in range(count):
+        name = f'ISIC_{i:07d}'
+        # Put most images in the last directory so the legacy loop has to miss first.
+        tiny.save(os.path.join(img_dirs[-1] if i % 4 else img_dirs[0], name + '.jpg'))
+        names.append(name)
+    df = pd.DataFrame({'image': names, 'single_label': np.arange(count) % 8})
+    return df, img_dirs
+
+
+def time_items(ds, repeats):
+    per_item = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for idx in range(len(ds)):
+            img, _ = ds[idx]
+            img.close()
+        per_item.append((time.perf_counter() - start) / len(ds))
+    return per_item
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Per-item overhead of ISICDataset lookups')
+    parser.add_argument('--csv', type=str, default=None, help='Ground truth CSV with image and single_label columns')
+    parser.add_argument('--img_dirs', type=str, nargs='+', default=None, help='Image directories, searched in order')
+    parser.add_argument('--count', type=int, default=2000, help='Number of synthetic images')
+    parser.add_argument('--num_dirs', type=int, default=2, help='Number of synthetic image directories')
+    parser.add_argument('--repeats', type=int, default=3, help='Passes over the dataset per variant')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.csv:
+            df = pd.read_csv(args.csv)
+            if 'single_label' not in df.columns:
+                df['single_label'] = df.iloc[:, 1:9].values.argmax(axis=1)
+            img_dirs = args.img_dirs
+        else:
+            df, img_dirs = make_synthetic(tmp, args.count, args.num_dirs)
+
+        start = time.perf_counter()
+        indexed = ISICDataset(df, img_dirs)
+        build_time = time.perf_counter() - start
+        legacy = LegacyISICDataset(df, img_dirs)
+
+        legacy_times = time_items(legacy, args.repeats)
+        indexed_times = time_items(indexed, args.repeats)
+
+    legacy_us = statistics.median(legacy_times) * 1e6
+    indexed_us = statistics.median(indexed_times) * 1e6
+    print("\n===== ISICDataset Per-Item Overhead =====")
+    print(f"Items: {len(df)}, directories: {len(img_dirs)}")
+    print(f"Index build time: {build_time*1000:.2f}ms (one-off)")
+    print(f"Legacy lookup   : {legacy_us:.1f}us/item")
+    print(f"Indexed lookup  : {indexed_us:.1f}us/item")
+    print(f"Speedup         : {legacy_us / indexed_us:.2f}x")
+    print("=========================================")
+
+
+if __name__ == '__main__':
+    main()
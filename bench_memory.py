@@ -0,0 +1,125 @@
+"""Peak training memory per batch size / accumulation / checkpointing configuration.
+
+Runs a few optimizer steps of train.train_one_epoch on synthetic 456x456 uint8
+batches for every combination of the given options, each in a fresh process
+so peaks don't leak between configurations. Reports peak GPU memory
+(``torch.cuda.max_memory_allocated``) on CUDA or peak RSS on CPU, the part of
+it added by training on top of the built model, and the time per image.
+
+Usage:
+    python bench_memory.py --batch_sizes 8 16 32 --accum_steps 1 4 --grad_checkpointing both
+    python bench_memory.py --model efficientnet_b0 --img_size 224 --device cpu --output memory.json
+"""
+
+import argparse
+import itertools
+import json
+import multiprocessing as mp
+import resource
+import time
+
+import timm
+import torch
+import torch.optim as optim
+from focal_loss.focal_loss import FocalLoss
+from torch.utils.data import DataLoader, TensorDataset
+
+from batch_augment import BatchAugment
+from train import NUM_CLASSES, train_one_epoch
+
+
+def peak_rss_mib():
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_config(config, queue):
+    torch.manual_seed(0)
+    device = torch.device('cuda' if torch.cuda.is_available() and config['device'] != 'cpu' else 'cpu')
+    model = timm.create_model(config['model'], pretrained=False, num_classes=NUM_CLASSES)
+    if config['grad_checkpointing']:
+        model.set_grad_checkpointing(True)
+    model = model.to(device)
+    optimizer = optim.AdamW(model.parameters(), lr=1e-4)
+    scaler = torch.cuda.amp.GradScaler(enabled=device.type == 'cuda')
+    criterion = FocalLoss(gamma=2.0, reduction='mean')
+
+    n = config['batch_size'] * config['accum_steps'] * config['steps']
+    size = config['img_size']
+    images = torch.randint(0, 256, (n, 3, size, size), dtype=torch.uint8)
+    labels = torch.randint(0, NUM_CLASSES, (n,))
+    loader = DataLoader(TensorDataset(images, labels), batch_size=config['batch_size'])
+
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        base = torch.cuda.memory_allocated(device) / 2**20
+    else:
+        base = peak_rss_mib()
+
+    try:
+        start = time.perf_counter()
+        train_one_epoch(model, loader, optimizer, criterion, scaler, device, augment=BatchAugment(),
+                        show_progress=False, accum_steps=config['accum_steps'])
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        elapsed = time.perf_counter() - start
+        peak = torch.cuda.max_memory_allocated(device) / 2**20 if device.type == 'cuda' else peak_rss_mib()
+        queue.put({**config, 'device': device.type, 'peak_mib': peak, 'training_mib': peak - base,
+                   'ms_per_image': elapsed / n * 1000, 'error': None})
+    except RuntimeError as e:
+        # Typically an out-of-memory error: report it as a result, not a crash
+        queue.put({**config, 'device': device.type, 'peak_mib': None, 'training_mib': None,
+                   'ms_per_image': None, 'error': str(e).splitlines()[0]})
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Peak training memory per memory-saving configuration')
+    parser.add_argument('--model', type=str, default='efficientnet_b5', help='timm model name')
+    parser.add_argument('--img_size', type=int, default=456, help='Input resolution')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[8, 16, 32], help='Micro-batch sizes')
+    parser.add_argument('--accum_steps', type=int, nargs='+', default=[1], help='Accumulation steps')
+    parser.add_argument('--grad_checkpointing', type=str, default='both', choices=['off', 'on', 'both'],
+                        help='Gradient checkpointing settings to try')
+    parser.add_argument('--steps', type=int, default=2, help='Optimizer steps per configuration')
+    parser.add_argument('--device', type=str, default='auto', choices=['auto', 'cpu'], help='Force CPU')
+    parser.add_argument('--output', type=str, default=None, help='Optional JSON file for the results')
+    args = parser.parse_args()
+
+    ckpt_options = {'off': [False], 'on': [True], 'both': [False, True]}[args.grad_checkpointing]
+    ctx = mp.get_context('spawn')
+    results = []
+    for batch_size, accum_steps, ckpt in itertools.product(args.batch_sizes, args.accum_steps, ckpt_options):
+        config = {'model': args.model, 'img_size': args.img_size, 'batch_size': batch_size,
+                  'accum_steps': accum_steps, 'grad_checkpointing': ckpt, 'steps': args.steps, 'device': args.device}
+        queue = ctx.Queue()
+        proc = ctx.Process(target=run_config, args=(config, queue))
+        proc.start()
+        proc.join()
+        result = queue.get() if not queue.empty() else {**config, 'peak_mib': None, 'training_mib': None,
+                                                         'ms_per_image': None, 'error': f'exit code {proc.exitcode}'}
+        results.append(result)
+        print(f"batch {batch_size} x accum {accum_steps}, checkpointing {'on' if ckpt else 'off'}: "
+              + (f"peak {result['peak_mib']:.0f} MiB" if result['error'] is None else f"failed ({result['error']})"))
+
+    print("\n===== Peak Training Memory =====")
+    print(f"Model: {args.model} @ {args.img_size}x{args.img_size}, device: {results[0]['device']}")
+    print(f"{'micro':>6} {'accum':>6} {'effective':>10} {'ckpt':>5} {'peak MiB':>10} {'training MiB':>13} {'ms/img':>8}")
+    for r in results:
+        effective = r['batch_size'] * r['accum_steps']
+        if r['error'] is None:
+            print(f"{r['batch_size']:>6} {r['accum_steps']:>6} {effective:>10} {'on' if r['grad_checkpointing'] else 'off':>5} "
+                  f"{r['peak_mib']:>10.0f} {r['training_mib']:>13.0f} {r['ms_per_image']:>8.1f}")
+        else:
+            print(f"{r['batch_size']:>6} {r['accum_steps']:>6} {effective:>10} {'on' if r['grad_checkpointing'] else 'off':>5} "
+                  f"{'failed':>10}")
+    print("================================")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Results saved to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
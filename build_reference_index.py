@@ -0,0 +1,102 @@
+"""Builds the reference embedding index served by the backend's "similar cases" lookup.
+
+Runs the serving checkpoint over a labelled ISIC image set, preprocessed as the
+backend does (whole image resized, no crop), takes the pooled features (the
+classifier's input) of every image, fits a PCA projection to
+``--dim`` dimensions and stores the projected, normalized embeddings as a
+float16 backend/embeddings.py index together with each image's diagnosis.
+The same projection is applied to query embeddings in the backend, so the
+index file is all it needs (``REFERENCE_INDEX_PATH``).
+
+Usage:
+    python build_reference_index.py --checkpoint model.pth --csv ISIC_2019_Training_GroundTruth.csv \\
+        --img_dirs ISIC_2019_Training_Input --dim 256 --output backend/reference_index.npz
+"""
+
+import argparse
+import time
+
+import numpy as np
+import timm
+import torch
+from torch.utils.data import DataLoader
+from tqdm import tqdm
+
+from backend.embeddings import EmbeddingIndex
+from isic_data import ISICDataset, build_serving_transform, load_ground_truth
+from train import NUM_CLASSES, load_weights
+
+
+@torch.inference_mode()
+def pooled_features(model, loader, device):
+    features = []
+    for inputs, _ in tqdm(loader, desc="Embedding"):
+        x = model.forward_features(inputs.to(device, non_blocking=True))
+        features.append(model.forward_head(x, pre_logits=True).float().cpu().numpy())
+    return np.concatenate(features)
+
+
+def fit_pca(features, dim):
+    """Mean and the top ``dim`` principal directions (rows) of ``features``."""
+    mean = features.mean(axis=0)
+    _, _, vt = np.linalg.svd(features - mean, full_matrices=False)
+    return mean, vt[:dim]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the reference embedding index for similar-case lookups')
+    parser.add_argument('--checkpoint', type=str, default='model.pth', help='Serving weights')
+    parser.add_argument('--arch', type=str, default='efficientnet_b5', help='timm model name')
+    parser.add_argument('--img_size', type=int, default=456, help='Input resolution')
+    parser.add_argument('--csv', type=str, required=True, help='Ground truth CSV of the reference images')
+    parser.add_argument('--img_dirs', type=str, nargs='+', required=True, help='Image directories')
+    parser.add_argument('--dim', type=int, default=256, help='PCA dimensions (0 = keep the pooled features)')
+    parser.add_argument('--batch_size', type=int, default=32, help='Inference batch size')
+    parser.add_argument('--num_workers', type=int, default=4, help='DataLoader workers')
+    parser.add_argument('--device', type=str, default='auto', choices=['auto', 'cpu'], help='Force CPU')
+    parser.add_argument('--output', type=str, default='reference_index.npz', help='Index file')
+    args = parser.parse_args()
+
+    device = torch.device('cuda' if torch.cuda.is_available() and args.device != 'cpu' else 'cpu')
+    model = timm.create_model(args.arch, pretrained=False, num_classes=NUM_CLASSES)
+    model.load_state_dict(load_weights(args.checkpoint))
+    model = model.to(device).eval()
+
+    gt = load_ground_truth(args.csv)
+    class_names = list(gt.columns[1:1 + NUM_CLASSES])
+    dataset = ISICDataset(gt, args.img_dirs, build_serving_transform(args.img_size))
+    loader = DataLoader(dataset, batch_size=args.batch_size, shuffle=False, num_workers=args.num_workers)
+    features = pooled_features(model, loader, device)
+
+    if args.dim:
+        mean, components = fit_pca(features, args.dim)
+        centered = features - mean
+        explained = float(np.square(centered @ components.T).sum() / np.square(centered).sum())
+        index = EmbeddingIndex(features.shape[1], capacity=len(features), mean=mean, components=components)
+    else:
+        explained = 1.0
+        index = EmbeddingIndex(features.shape[1], capacity=len(features))
+    for image, label, feature in zip(gt['image'], gt['single_label'], features):
+        index.add(image, feature, {'label': int(label), 'diagnosis': class_names[label]})
+    index.save(args.output)
+
+    queries = features[:min(100, len(features))]
+    start = time.perf_counter()
+    for q in queries:
+        index.search(q, k=5)
+    search_ms = (time.perf_counter() - start) / len(queries) * 1000
+    # Leave-one-out check: how often the nearest other reference shares the diagnosis
+    hits = [index.search(q, k=2)[1][2]['label'] == label for q, label in zip(queries, gt['single_label'])]
+
+    print("\n===== Reference Embedding Index =====")
+    print(f"Images: {len(index)}, pooled features: {features.shape[1]}, stored dims: {index.dim} "
+          f"(PCA variance kept {explained:.1%})")
+    print(f"Index size: {index.vectors[:len(index)].nbytes / 2**20:.1f} MiB float16")
+    print(f"Top-5 search: {search_ms:.2f} ms per query")
+    print(f"Nearest-neighbour diagnosis agreement (first {len(queries)} images): {np.mean(hits):.1%}")
+    print(f"Saved to {args.output} (serve with REFERENCE_INDEX_PATH={args.output})")
+    print("=====================================")
+
+
+if __name__ == '__main__':
+    main()
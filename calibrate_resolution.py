@@ -0,0 +1,132 @@
+"""Accuracy vs. latency of serving one checkpoint at several input resolutions.
+
+The weights are trained at 456x456, but many uploads are classified just as
+well at a lower resolution for a fraction of the cost. For every resolution
+in ``--resolutions`` this evaluates the checkpoint on a labelled image set,
+preprocessed as the backend does (whole image resized, no crop), and times
+batch-1 forward passes. It then simulates the backend's escalation rule:
+answer at a lower resolution, and rerun at full resolution when the
+calibrated max probability is below a threshold. The expected
+latency of a setting is ``latency(low) + escalation rate x latency(full)``.
+
+The recommended setting is the fastest (resolution, threshold) whose macro F1
+is within ``--max_f1_drop`` of serving everything at full resolution, printed
+as the backend's SERVE_RESOLUTION / RESOLUTION_ESCALATION_THRESHOLD.
+
+Usage:
+    python calibrate_resolution.py --checkpoint model.pth --csv ISIC_2019_Test_GroundTruth.csv \\
+        --img_dirs ISIC_2019_Test_Input --resolutions 300 380 456
+"""
+
+import argparse
+import json
+
+import numpy as np
+import timm
+import torch
+from torch.utils.data import DataLoader
+
+from compare_models import measure_latency
+from eval_engine import f1_from_confusion, run_evaluation
+from isic_data import ISICDataset, build_serving_transform, load_ground_truth
+from sweep_unk_threshold import softmax
+from train import NUM_CLASSES, load_weights
+
+
+def score(preds, labels):
+    # UNK-labelled images (if any) have no correct class among the model's outputs
+    known = labels < NUM_CLASSES
+    preds, labels = preds[known], labels[known]
+    cm = np.bincount(labels * NUM_CLASSES + preds, minlength=NUM_CLASSES ** 2).reshape(NUM_CLASSES, NUM_CLASSES)
+    return 100. * float((preds == labels).mean()), f1_from_confusion(cm)[0]
+
+
+def escalation_curve(low_probs, full_probs, labels, thresholds):
+    """(accuracy, macro F1, escalation rate) per threshold for low-res answers escalated to full res."""
+    low_conf = low_probs.max(axis=1)
+    low_pred, full_pred = low_probs.argmax(axis=1), full_probs.argmax(axis=1)
+    rows = []
+    for threshold in thresholds:
+        escalate = low_conf < threshold
+        acc, f1 = score(np.where(escalate, full_pred, low_pred), labels)
+        rows.append((float(threshold), acc, f1, float(escalate.mean())))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Calibrate serving resolution and full-resolution escalation')
+    parser.add_argument('--checkpoint', type=str, default='model.pth', help='Weights to serve')
+    parser.add_argument('--arch', type=str, default='efficientnet_b5', help='timm model name')
+    parser.add_argument('--csv', type=str, required=True, help='Ground truth CSV of the labelled images')
+    parser.add_argument('--img_dirs', type=str, nargs='+', required=True, help='Image directories')
+    parser.add_argument('--resolutions', type=int, nargs='+', default=[300, 380, 456],
+                        help='Input resolutions; the largest is the full resolution')
+    parser.add_argument('--temperature', type=float, default=1.0, help='CALIBRATION_TEMPERATURE of the backend')
+    parser.add_argument('--num_thresholds', type=int, default=21, help='Escalation thresholds in [0, 1]')
+    parser.add_argument('--max_f1_drop', type=float, default=0.01, help='Allowed macro F1 loss vs. full resolution')
+    parser.add_argument('--batch_size', type=int, default=16, help='Evaluation batch size')
+    parser.add_argument('--num_workers', type=int, default=4, help='DataLoader workers')
+    parser.add_argument('--latency_runs', type=int, default=30, help='Timed batch-1 forward passes per resolution')
+    parser.add_argument('--threads', type=int, default=None, help='torch intra-op threads (match the server)')
+    parser.add_argument('--device', type=str, default='auto', choices=['auto', 'cpu'], help='Force CPU')
+    parser.add_argument('--output', type=str, default='resolution_calibration.json', help='Results JSON')
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    device = torch.device('cuda' if torch.cuda.is_available() and args.device != 'cpu' else 'cpu')
+    model = timm.create_model(args.arch, pretrained=False, num_classes=NUM_CLASSES)
+    model.load_state_dict(load_weights(args.checkpoint))
+    model = model.to(device).eval()
+    # UNK rows of a test CSV are kept as label 8 and left out by score()
+    gt = load_ground_truth(args.csv, include_unk=True)
+
+    resolutions = sorted(args.resolutions)
+    full = resolutions[-1]
+    per_res, probs = {}, {}
+    for size in resolutions:
+        # Preprocessed as /predict does, so the calibration holds for served requests
+        dataset = ISICDataset(gt, args.img_dirs, build_serving_transform(size))
+        loader = DataLoader(dataset, batch_size=args.batch_size, shuffle=False, num_workers=args.num_workers)
+        result = run_evaluation(model, loader, device, num_classes=NUM_CLASSES, desc=f"Evaluating @ {size}",
+                                store_logits=True)
+        probs[size] = softmax(result['logits'].astype(np.float64) / args.temperature)
+        labels = result['all_labels']
+        acc, f1 = score(probs[size].argmax(axis=1), labels)
+        latency = measure_latency(model, size, device, warmup=3, runs=args.latency_runs)
+        per_res[size] = {'acc': acc, 'macro_f1': f1, 'latency_ms': float(np.median(latency))}
+
+    full_f1, full_ms = per_res[full]['macro_f1'], per_res[full]['latency_ms']
+    thresholds = np.linspace(0.0, 1.0, args.num_thresholds)
+    settings = [{'resolution': full, 'threshold': 0.0, 'acc': per_res[full]['acc'], 'macro_f1': full_f1,
+                 'escalation_rate': 0.0, 'expected_ms': full_ms}]
+    for size in resolutions[:-1]:
+        for threshold, acc, f1, rate in escalation_curve(probs[size], probs[full], labels, thresholds):
+            settings.append({'resolution': size, 'threshold': threshold, 'acc': acc, 'macro_f1': f1,
+                             'escalation_rate': rate,
+                             'expected_ms': per_res[size]['latency_ms'] + rate * full_ms})
+    eligible = [s for s in settings if s['macro_f1'] >= full_f1 - args.max_f1_drop]
+    best = min(eligible, key=lambda s: (s['expected_ms'], -s['macro_f1']))
+
+    with open(args.output, 'w') as f:
+        json.dump({'checkpoint': args.checkpoint, 'arch': args.arch, 'num_images': int(len(labels)),
+                   'device': device.type, 'temperature': args.temperature, 'resolutions': per_res,
+                   'settings': settings, 'recommendation': best}, f, indent=2)
+
+    print("\n===== Resolution Calibration =====")
+    num_unk = int((labels >= NUM_CLASSES).sum())
+    print(f"Images: {len(labels)} ({num_unk} UNK, not scored), device: {device.type}, threads: {torch.get_num_threads()}")
+    print(f"{'size':>6} {'acc %':>7} {'macro F1':>9} {'p50 ms':>8}")
+    for size in resolutions:
+        r = per_res[size]
+        print(f"{size:>6} {r['acc']:>7.2f} {r['macro_f1']:>9.4f} {r['latency_ms']:>8.1f}")
+    print(f"Recommended: {best['resolution']} px, escalate below {best['threshold']:.2f} "
+          f"({best['escalation_rate']:.0%} of requests) -> acc {best['acc']:.2f}%, "
+          f"macro F1 {best['macro_f1']:.4f}, expected {best['expected_ms']:.1f} ms vs {full_ms:.1f} ms at {full} px")
+    print(f"Serve with: SERVE_RESOLUTION={best['resolution']} RESOLUTION_ESCALATION_THRESHOLD={best['threshold']:g}")
+    print(f"Results written to {args.output}")
+    print("==================================")
+
+
+if __name__ == '__main__':
+    main()
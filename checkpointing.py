@@ -0,0 +1,158 @@
+"""Resumable training checkpoints written from a background thread.
+
+A checkpoint holds everything needed to continue a run where it stopped:
+model, optimizer and GradScaler state, the position in the epoch, the best
+validation loss so far and the RNG states. Saving happens in two stages:
+
+1. ``snapshot`` copies the state to CPU on the training thread. This is the
+   only part that blocks the step loop, and it is a memory copy.
+2. ``AsyncCheckpointer`` serializes the snapshot on a writer thread, to a
+   temporary file that is atomically renamed into place, so a preemption in
+   the middle of a write never leaves a truncated checkpoint behind.
+
+If a new snapshot for the same path arrives while an older one is still
+queued, the older one is dropped: only the newest state is worth writing.
+"""
+
+import os
+import random
+import threading
+import time
+
+import numpy as np
+import torch
+
+
+def to_cpu(obj):
+    """Recursively copies every tensor in ``obj`` to CPU memory."""
+    if torch.is_tensor(obj):
+        # copy=True so CPU tensors are not aliased by the next optimizer step
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return obj
+
+
+def rng_state():
+    state = {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def snapshot(model, optimizer, scaler, epoch, step, best_val_loss, **extra):
+    """CPU copy of the full training state.
+
+    ``epoch`` and ``step`` give the resume position: ``step`` optimizer steps of
+    ``epoch`` are done. A checkpoint taken at the end of an epoch should pass
+    ``epoch + 1, 0``.
+    """
+    state = {
+        'model': to_cpu(model.state_dict()),
+        'optimizer': to_cpu(optimizer.state_dict()),
+        'scaler': scaler.state_dict(),
+        'epoch': epoch,
+        'step': step,
+        'best_val_loss': best_val_loss,
+        'rng': rng_state(),
+    }
+    state.update(extra)
+    return state
+
+
+def load_checkpoint(path, model, optimizer=None, scaler=None, restore_rng=True):
+    """Restores a checkpoint written by ``AsyncCheckpointer`` and returns the full dict."""
+    # The RNG states are plain Python/NumPy objects, so this is not a weights-only load
+    state = torch.load(path, map_location='cpu', weights_only=False)
+    model.load_state_dict(state['model'])
+    if optimizer is not None:
+        optimizer.load_state_dict(state['optimizer'])
+    if scaler is not None:
+        scaler.load_state_dict(state['scaler'])
+    if restore_rng:
+        set_rng_state(state['rng'])
+    return state
+
+
+def atomic_save(obj, path):
+    tmp_path = f'{path}.tmp'
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+
+class AsyncCheckpointer:
+    """Serializes snapshots to disk on a single background thread."""
+
+    def __init__(self):
+        self._pending = {}
+        self._busy = False
+        self._closed = False
+        self._error = None
+        self.last_save_seconds = None
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='checkpoint-writer', daemon=True)
+        self._thread.start()
+
+    def _raise_if_failed(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError(f"Background checkpoint write failed: {error}") from error
+
+    def save(self, state, path):
+        """Queues ``state`` (already on CPU) to be written to ``path``; returns immediately."""
+        with self._cond:
+            self._raise_if_failed()
+            # Replace rather than queue behind an older snapshot for the same file
+            self._pending.pop(path, None)
+            self._pending[path] = state
+            self._cond.notify_all()
+
+    def wait(self):
+        """Blocks until every queued snapshot is on disk."""
+        with self._cond:
+            while self._pending or self._busy:
+                self._cond.wait()
+            self._raise_if_failed()
+
+    def close(self):
+        self.wait()
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+                path = next(iter(self._pending))
+                state = self._pending.pop(path)
+                self._busy = True
+            start = time.perf_counter()
+            try:
+                atomic_save(state, path)
+                self.last_save_seconds = time.perf_counter() - start
+            except Exception as e:
+                self._error = e
+            finally:
+                del state
+                with self._cond:
+                    self._busy = False
+                    self._cond.notify_all()
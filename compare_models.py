@@ -0,0 +1,130 @@
+"""Accuracy / latency comparison of serving candidates, e.g. the B5 teacher and a distilled student.
+
+Every model is given as ``name=arch:img_size:weights``. All of them are
+evaluated on the same labelled images (each at its own resolution, with the
+validation transform) and timed at batch size 1, the shape /predict runs, on
+the chosen device. The first model is the reference: the report also shows
+how often every other model agrees with its predictions.
+
+Usage:
+    python compare_models.py --csv ISIC_2019_Test_GroundTruth.csv --img_dirs ISIC_2019_Test_Input \\
+        --models b5=efficientnet_b5:456:model.pth b0=efficientnet_b0:224:student_b0.pth
+    # held-out split of the training data instead of a test set
+    python compare_models.py --csv combined_groundtruth.csv --img_dirs dirA dirB --val_split ...
+"""
+
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+import timm
+import torch
+from torch.utils.data import DataLoader
+
+from eval_engine import run_evaluation
+from isic_data import ISICDataset, build_val_transform, load_ground_truth, load_group_ids, split_train_val
+from train import NUM_CLASSES, load_weights
+
+
+def parse_model_spec(spec):
+    name, rest = spec.split('=', 1)
+    arch, img_size, weights = rest.split(':', 2)
+    return {'name': name, 'arch': arch, 'img_size': int(img_size), 'weights': weights}
+
+
+def measure_latency(model, img_size, device, warmup, runs):
+    """Per-image latency in ms (batch 1) over ``runs`` timed forward passes."""
+    x = torch.randn(1, 3, img_size, img_size, device=device)
+    times = []
+    with torch.inference_mode():
+        for i in range(warmup + runs):
+            start = time.perf_counter()
+            model(x)
+            if device.type == 'cuda':
+                torch.cuda.synchronize(device)
+            if i >= warmup:
+                times.append((time.perf_counter() - start) * 1000)
+    return np.array(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare accuracy and latency of serving models')
+    parser.add_argument('--csv', type=str, required=True, help='Ground truth CSV of the evaluation images')
+    parser.add_argument('--img_dirs', type=str, nargs='+', required=True, help='Image directories')
+    parser.add_argument('--models', type=str, nargs='+', required=True,
+                        help='name=arch:img_size:weights, reference model first')
+    parser.add_argument('--val_split', action='store_true',
+                        help="Evaluate on train.py's validation split of --csv instead of all of it")
+    parser.add_argument('--groups_csv', type=str, default=None, help='Split groups, as given to train.py')
+    parser.add_argument('--seed', type=int, default=42, help='Split seed, as given to train.py')
+    parser.add_argument('--batch_size', type=int, default=32, help='Evaluation batch size')
+    parser.add_argument('--num_workers', type=int, default=4, help='DataLoader workers')
+    parser.add_argument('--latency_runs', type=int, default=50, help='Timed batch-1 forward passes per model')
+    parser.add_argument('--threads', type=int, default=None, help='torch intra-op threads (default: torch default)')
+    parser.add_argument('--device', type=str, default='auto', choices=['auto', 'cpu'], help='Force CPU')
+    parser.add_argument('--output', type=str, default=None, help='Optional JSON file for the results')
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    device = torch.device('cuda' if torch.cuda.is_available() and args.device != 'cpu' else 'cpu')
+    # Test CSVs label some images UNK (8): no class the models output is right for them, so
+    # they are left out of the metrics instead of being scored as class 0
+    gt = load_ground_truth(args.csv, include_unk=True)
+    if args.val_split:
+        groups = load_group_ids(args.groups_csv, gt) if args.groups_csv else None
+        _, gt = split_train_val(gt, seed=args.seed, groups=groups)
+
+    results, reference_preds = [], None
+    for spec in map(parse_model_spec, args.models):
+        model = timm.create_model(spec['arch'], pretrained=False, num_classes=NUM_CLASSES)
+        model.load_state_dict(load_weights(spec['weights']))
+        model = model.to(device).eval()
+
+        dataset = ISICDataset(gt, args.img_dirs, build_val_transform(spec['img_size']))
+        loader = DataLoader(dataset, batch_size=args.batch_size, shuffle=False, num_workers=args.num_workers)
+        metrics = run_evaluation(model, loader, device, num_classes=NUM_CLASSES, ignore_unk=True,
+                                 desc=f"Evaluating {spec['name']}")
+        latency = measure_latency(model, spec['img_size'], device, warmup=5, runs=args.latency_runs)
+
+        preds = metrics['preds']
+        if reference_preds is None:
+            reference_preds = preds
+        results.append({
+            **spec,
+            'params_m': sum(p.numel() for p in model.parameters()) / 1e6,
+            'weights_mib': os.path.getsize(spec['weights']) / 2**20,
+            'acc': metrics['acc'],
+            'macro_f1': metrics['macro_f1'],
+            'agreement': float((preds == reference_preds).mean() * 100),
+            'latency_p50_ms': float(np.percentile(latency, 50)),
+            'latency_p95_ms': float(np.percentile(latency, 95)),
+        })
+        del model
+        if device.type == 'cuda':
+            torch.cuda.empty_cache()
+
+    ref = results[0]
+    print("\n===== Model Comparison =====")
+    num_unk = int((gt['single_label'] >= NUM_CLASSES).sum())
+    print(f"Images: {len(gt) - num_unk} ({num_unk} UNK left out), device: {device.type}, "
+          f"threads: {torch.get_num_threads()}, batch 1 latency")
+    print(f"{'model':>10} {'arch':>22} {'size':>5} {'params M':>9} {'MiB':>6} {'acc %':>7} {'macro F1':>9} "
+          f"{'agree %':>8} {'p50 ms':>8} {'p95 ms':>8} {'speedup':>8}")
+    for r in results:
+        print(f"{r['name']:>10} {r['arch']:>22} {r['img_size']:>5} {r['params_m']:>9.1f} {r['weights_mib']:>6.0f} "
+              f"{r['acc']:>7.2f} {r['macro_f1']:>9.4f} {r['agreement']:>8.2f} {r['latency_p50_ms']:>8.1f} "
+              f"{r['latency_p95_ms']:>8.1f} {ref['latency_p50_ms'] / r['latency_p50_ms']:>7.2f}x")
+    print(f"Agreement and speedup are relative to {ref['name']}")
+    print("============================")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Results saved to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
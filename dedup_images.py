@@ -0,0 +1,162 @@
+"""Near-duplicate detection for the combined training set.
+
+``train_dirs`` merges ISIC_2019_Training_Input with similar_to_ISIC, and the
+train/val split groups by image name, so the same lesion photographed or
+re-encoded twice can land on both sides of the split. This tool:
+
+1. computes a 64-bit perceptual hash (pHash: DCT of a 32x32 grayscale
+   thumbnail, sign of the 8x8 low-frequency block against its median) for
+   every image of the ground truth CSV, in parallel worker processes,
+2. finds all pairs within ``--max_distance`` bits with a blocked, vectorized
+   Hamming-distance search (XOR + byte popcount lookup table in NumPy),
+3. merges pairs into duplicate clusters with union-find and reports them.
+
+Outputs, all in ``--output``:
+- ``clusters.csv``: image, cluster id, source directory, label, for every
+  image in a cluster of two or more,
+- ``groups.csv``: image -> group id for every image; pass it to
+  ``train.py --groups_csv`` so StratifiedGroupKFold keeps each cluster on one
+  side of the split,
+- ``dedup_groundtruth.csv``: the ground truth with one image per cluster,
+  preferring the earliest directory in ``--train_dirs``.
+
+Usage:
+    python dedup_images.py --train_csv combined_groundtruth.csv --train_dirs dirA dirB --workers 16
+"""
+
+import argparse
+import os
+import time
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+from PIL import Image
+
+from isic_data import load_ground_truth, resolve_image_paths
+
+HASH_SIZE = 8
+THUMB_SIZE = 32
+
+
+def _dct_matrix(n):
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    m = np.cos(np.pi * (2 * i + 1) * k / (2 * n))
+    m[0] *= 1 / np.sqrt(2)
+    return m * np.sqrt(2 / n)
+
+
+DCT = _dct_matrix(THUMB_SIZE)
+BIT_WEIGHTS = (1 << np.arange(HASH_SIZE * HASH_SIZE, dtype=np.uint64))
+# Number of set bits for every byte value
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def phash(path):
+    with Image.open(path) as img:
+        thumb = img.convert('L').resize((THUMB_SIZE, THUMB_SIZE), Image.LANCZOS)
+    pixels = np.asarray(thumb, dtype=np.float64)
+    low = (DCT @ pixels @ DCT.T)[:HASH_SIZE, :HASH_SIZE].ravel()
+    bits = low > np.median(low[1:])
+    return np.uint64((bits * BIT_WEIGHTS).sum(dtype=np.uint64))
+
+
+def hash_images(paths, workers, chunksize=64):
+    with Pool(workers) as pool:
+        return np.fromiter(pool.imap(phash, paths, chunksize=chunksize), dtype=np.uint64, count=len(paths))
+
+
+def hamming_pairs(hashes, max_distance, block=256):
+    """All index pairs (i < j) whose hashes differ in at most ``max_distance`` bits."""
+    n = len(hashes)
+    pairs_i, pairs_j = [], []
+    for start in range(0, n, block):
+        stop = min(start + block, n)
+        # (block, n) XOR, popcounted byte-wise through the lookup table
+        xor = hashes[start:stop, None] ^ hashes[None, :]
+        dist = POPCOUNT[xor.view(np.uint8).reshape(stop - start, n, 8)].sum(axis=2, dtype=np.uint8)
+        rows, cols = np.nonzero(dist <= max_distance)
+        rows += start
+        upper = cols > rows
+        pairs_i.append(rows[upper])
+        pairs_j.append(cols[upper])
+    return np.concatenate(pairs_i), np.concatenate(pairs_j)
+
+
+def clusters_from_pairs(n, pairs_i, pairs_j):
+    """Union-find over the pairs; returns a root index per image."""
+    parent = np.arange(n)
+
+    def find(x):
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    for i, j in zip(pairs_i.tolist(), pairs_j.tolist()):
+        ri, rj = find(i), find(j)
+        if ri != rj:
+            parent[max(ri, rj)] = min(ri, rj)
+    return np.array([find(x) for x in range(n)])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Find near-duplicate training images with perceptual hashing')
+    parser.add_argument('--train_csv', type=str, required=True, help='Combined training ground truth CSV')
+    parser.add_argument('--train_dirs', type=str, nargs='+', required=True, help='Image directories, in priority order')
+    parser.add_argument('--max_distance', type=int, default=6, help='Max Hamming distance (of 64 bits) for duplicates')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Hashing processes')
+    parser.add_argument('--output', type=str, default='dedup', help='Output directory')
+    args = parser.parse_args()
+
+    gt = load_ground_truth(args.train_csv)
+    paths = resolve_image_paths(gt['image'].tolist(), args.train_dirs)
+    # Index of the directory each image was found in (lower = preferred)
+    dir_index = {os.path.normpath(d): i for i, d in reversed(list(enumerate(args.train_dirs)))}
+    source = np.array([dir_index[os.path.normpath(os.path.dirname(p))] for p in paths])
+
+    start = time.perf_counter()
+    hashes = hash_images(paths, args.workers)
+    hash_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    pairs_i, pairs_j = hamming_pairs(hashes, args.max_distance)
+    search_time = time.perf_counter() - start
+
+    roots = clusters_from_pairs(len(gt), pairs_i, pairs_j)
+    _, group_ids, sizes = np.unique(roots, return_inverse=True, return_counts=True)
+    in_cluster = sizes[group_ids] > 1
+
+    os.makedirs(args.output, exist_ok=True)
+    groups = pd.DataFrame({'image': gt['image'], 'group': group_ids})
+    groups.to_csv(os.path.join(args.output, 'groups.csv'), index=False)
+
+    report = pd.DataFrame({
+        'image': gt['image'], 'cluster': group_ids, 'source': [args.train_dirs[s] for s in source],
+        'label': gt['single_label'], 'hash': [f'{h:016x}' for h in hashes.tolist()],
+    })[in_cluster].sort_values(['cluster', 'source', 'image'])
+    report.to_csv(os.path.join(args.output, 'clusters.csv'), index=False)
+
+    # Keep one image per group: earliest source directory, then CSV order
+    order = np.lexsort((np.arange(len(gt)), source, group_ids))
+    keep = np.zeros(len(gt), dtype=bool)
+    keep[order[np.r_[True, group_ids[order][1:] != group_ids[order][:-1]]]] = True
+    gt.loc[keep].drop(columns=['single_label']).to_csv(os.path.join(args.output, 'dedup_groundtruth.csv'), index=False)
+
+    clustered = report.groupby('cluster')
+    cross_source = int((clustered['source'].nunique() > 1).sum())
+    label_conflicts = int((clustered['label'].nunique() > 1).sum())
+    print("\n===== Near-Duplicate Report =====")
+    print(f"Images hashed: {len(gt)} in {hash_time:.1f}s with {args.workers} workers")
+    print(f"Pair search: {len(pairs_i)} pairs within {args.max_distance} bits in {search_time:.2f}s")
+    print(f"Duplicate clusters: {clustered.ngroups} covering {int(in_cluster.sum())} images")
+    print(f"Clusters spanning both sources: {cross_source}")
+    print(f"Clusters with conflicting labels: {label_conflicts}")
+    print(f"Deduplicated ground truth: {int(keep.sum())} of {len(gt)} images")
+    print(f"Reports written to {args.output}/ (use groups.csv with train.py --groups_csv)")
+    print("=================================")
+
+
+if __name__ == '__main__':
+    main()
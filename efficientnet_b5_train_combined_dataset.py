@@ -102,6 +102,9 @@ test_gt['single_label'] = test_labels.values.argmax(axis=1)
 # ============================
 
 train_gt['patient_id'] = train_gt['image']
+# To keep near-duplicates (dedup_images.py) on one side of the split, group by cluster instead:
+# from isic_data import load_group_ids
+# train_gt['patient_id'] = load_group_ids('dedup/groups.csv', train_gt)
 sgkf = StratifiedGroupKFold(n_splits=5, shuffle=True, random_state=seed)
 train_idx, val_idx = next(sgkf.split(train_gt, train_gt['single_label'], groups=train_gt['patient_id']))
 
@@ -124,12 +127,7 @@ class CircularMask:
         comp = Image.composite(img_rgba, black_bg, mask)
         return comp.convert('RGB')
 
-class CenterSquareCrop:
-    def __call__(self, img):
-        w, h = img.size
-        m = min(w, h)
-        left, top = (w-m)//2, (h-m)//2
-        return img.crop((left, top, left+m, top+m))
+from isic_data import CenterSquareCrop
 
 train_transform = transforms.Compose([
     transforms.Lambda(lambda img: img.convert('RGB')),
@@ -154,55 +152,28 @@ val_transform = transforms.Compose([
     transforms.Normalize([0.485,0.456,0.406],[0.229,0.224,0.225])
 ])
 
-# =====================
-# 6) Dataset Class
-# =====================
-
-class ISICDataset(Dataset):
-    def __init__(self, df, img_dirs, transform=None, is_test=False):
-        self.df = df
-        self.img_dirs = img_dirs if isinstance(img_dirs, list) else [img_dirs]
-        self.transform = transform
-        self.is_test = is_test
-
-    def __len__(self):
-        return len(self.df)
-
-    def __getitem__(self, idx):
-        # Strip .jpg if it exists, then append .jpg
-        raw_name = self.df.iloc[idx]['image']
-        base_name = raw_name.replace('.jpg', '')  # Remove .jpg if it's already there
-        name = base_name + '.jpg'
-
-        img = None
-        for d in self.img_dirs:
-            img_path = os.path.join(d, name)
-            if os.path.exists(img_path):
-                img = Image.open(img_path)
-                break
-
-        if img is None:
-            raise FileNotFoundError(f"Image {name} not found in any of {self.img_dirs}")
-
-        label = int(self.df.iloc[idx]['single_label'])
-        if self.transform:
-            img = self.transform(img)
-        return img, label
+# Batched augmentation: the DataLoader workers only decode, square-crop and
+# resize to uint8 (train_decode_transform), and BatchAugment applies the same
+# rotation / affine / flip / jitter policy to the whole batch on `device`.
+# Set to False to fall back to the per-image PIL train_transform above.
+from batch_augment import BatchAugment, decode_transform
 
+USE_BATCH_AUGMENT = True
+train_decode_transform = decode_transform(456)
+batch_augment = BatchAugment()
 
 # =====================
-# 7) DataLoaders
+# 6) Dataset Class
 # =====================
 
-BATCH_SIZE = 32  # adjust for 456x456
-train_ds = ISICDataset(train_df, train_dirs, train_transform)
-val_ds   = ISICDataset(val_df,   train_dirs, val_transform)
-test_ds  = ISICDataset(test_gt,  test_dir,  val_transform, is_test=True)
+# ISICDataset resolves every image path once at construction (one directory
+# listing per source instead of an os.path.exists probe per sample) and keeps
+# labels in a NumPy array. isic_data.py must sit next to this notebook.
+from isic_data import ISICDataset
 
-train_loader = DataLoader(train_ds, batch_size=BATCH_SIZE, shuffle=True, num_workers=8, pin_memory=True)
-val_loader   = DataLoader(val_ds,   batch_size=BATCH_SIZE, shuffle=False,num_workers=8, pin_memory=True)
-test_loader  = DataLoader(test_ds,  batch_size=BATCH_SIZE, shuffle=False,num_workers=8, pin_memory=True)
 
+# Stage the images into the Colab runtime before building the datasets below:
+# ISICDataset resolves all image paths when it is constructed.
 import shutil
 import os
 
@@ -222,7 +193,24 @@ shutil.copytree(src_training_combined, dst_training_combined)
 !unzip '/content/drive/My Drive/ens492/ISIC_2019_Training_Input.zip' -d /content/ens492_runtime/Training_Input_Combined/
 !unzip '/content/drive/My Drive/ens492/ISIC_2019_Test_Input.zip' -d /content/ens492_runtime/
 
-"""## Training Routine"""
+# =====================
+# 7) DataLoaders
+# =====================
+
+BATCH_SIZE = 32  # adjust for 456x456
+train_ds = ISICDataset(train_df, train_dirs, train_decode_transform if USE_BATCH_AUGMENT else train_transform)
+val_ds   = ISICDataset(val_df,   train_dirs, val_transform)
+test_ds  = ISICDataset(test_gt,  test_dir,  val_transform, is_test=True)
+
+train_loader = DataLoader(train_ds, batch_size=BATCH_SIZE, shuffle=True, num_workers=8, pin_memory=True)
+val_loader   = DataLoader(val_ds,   batch_size=BATCH_SIZE, shuffle=False,num_workers=8, pin_memory=True)
+test_loader  = DataLoader(test_ds,  batch_size=BATCH_SIZE, shuffle=False,num_workers=8, pin_memory=True)
+
+"""## Training Routine
+
+The same loop is available as a standalone script that also runs data-parallel
+under torch.distributed (multi-GPU, or gloo on CPU processes): see train.py.
+"""
 
 import timm
 import torch
@@ -261,7 +249,10 @@ def train_one_epoch(model, dataloader, optimizer):
     total_loss = 0.0  # Track total loss for the epoch
 
     for inputs, targets in tqdm(dataloader):
-        inputs, targets = inputs.to(device), targets.to(device)
+        inputs, targets = inputs.to(device, non_blocking=True), targets.to(device, non_blocking=True)
+        if inputs.dtype == torch.uint8:
+            # Decoded-only batch from train_decode_transform: augment on device
+            inputs = batch_augment(inputs)
         optimizer.zero_grad()
 
         with autocast():
@@ -284,39 +275,19 @@ def train_one_epoch(model, dataloader, optimizer):
     return 100. * correct / total, avg_loss  # Return accuracy and average loss
 
 # === Evaluate Function ===
-def evaluate(model, dataloader, criterion, is_test=False):
-    model.eval()
-    correct, total = 0, 0
-    all_preds, all_labels, all_probs = [], [], []
-    total_loss = 0.0
-
-    with torch.no_grad():
-        for inputs, targets in dataloader:
-            inputs, targets = inputs.to(device), targets.to(device)
-            outputs = model(inputs)
-            probs = torch.softmax(outputs, dim=-1)
-            loss = criterion(probs, targets)
-            total_loss += loss.item() * targets.size(0)
-
-            if is_test:
-                max_probs, predicted = probs.max(1)
-                unk_probs = 1 - max_probs
-                predicted = torch.where(unk_probs > 0.5,
-                                        torch.tensor(num_classes-1).to(device),
-                                        predicted)
-            else:
-                _, predicted = probs.max(1)
-
-            correct += predicted.eq(targets).sum().item()
-            total += targets.size(0)
-            all_preds.extend(predicted.cpu().numpy())
-            all_labels.extend(targets.cpu().numpy())
-            all_probs.extend(probs.cpu().numpy())
+# Backed by eval_engine.run_evaluation: one pass, on-device confusion matrices,
+# results copied to NumPy once at the end.
+from eval_engine import run_evaluation, misclassified_samples, UNK_LABEL
 
-    avg_loss = total_loss / total
-    macro_f1 = f1_score(all_labels, all_preds, average='macro')
-    acc = 100. * correct / total
-    return acc, avg_loss, macro_f1, all_preds, all_labels, all_probs
+def evaluate(model, dataloader, criterion, is_test=False):
+    # On the test set predictions with max_prob < 0.5 become UNK (class 8)
+    result = run_evaluation(model, dataloader, device, criterion=criterion, num_classes=num_classes,
+                            unk_thresholds=(0.5,) if is_test else ())
+    metrics = result['unk'][0.5] if is_test else result
+    preds = result['preds']
+    if is_test:
+        preds = np.where(result['probs'].max(axis=1) < 0.5, UNK_LABEL, preds)
+    return metrics['acc'], result['loss'], metrics['macro_f1'], preds, result['labels'], result['probs']
 
 # === Dataloaders ===
 #test_dataset = ISICDataset(test_ground_truth_df, test_dir, val_transform)
@@ -410,36 +381,13 @@ plt.show()
 # val_loader = DataLoader(val_dataset, batch_size=BATCH_SIZE, shuffle=False)
 
 def evaluate(model, dataloader, criterion=None, is_test=False):
-    model.eval()
-    correct, total = 0, 0
-    all_preds, all_labels = [], []
-    all_probs = []
-
-    with torch.no_grad():
-        for inputs, targets in dataloader:
-            inputs, targets = inputs.to(device), targets.to(device)
-            outputs = model(inputs)
-            probs = torch.softmax(outputs, dim=-1)
-
-            if is_test:
-                max_probs, predicted = probs.max(1)
-                unk_probs = 1 - max_probs
-                predicted = torch.where(unk_probs > 0.5,
-                                        torch.tensor(num_classes-1).to(device),
-                                        predicted)
-            else:
-                _, predicted = probs.max(1)
-
-            correct += predicted.eq(targets).sum().item()
-            total += targets.size(0)
-            all_preds.extend(predicted.cpu().numpy())
-            all_labels.extend(targets.cpu().numpy())
-            all_probs.extend(probs.cpu().numpy())
-
-    if criterion is not None:
-        return 100. * correct / total, all_preds, all_labels, all_probs
-    else:
-        return 100. * correct / total, all_preds, all_labels, all_probs
+    result = run_evaluation(model, dataloader, device, num_classes=num_classes,
+                            unk_thresholds=(0.5,) if is_test else ())
+    acc = result['unk'][0.5]['acc'] if is_test else result['acc']
+    preds = result['preds']
+    if is_test:
+        preds = np.where(result['probs'].max(axis=1) < 0.5, UNK_LABEL, preds)
+    return acc, preds, result['labels'], result['probs']
 
 # Evaluate the model on the validation set
 final_val_acc, val_preds, val_labels, _ = evaluate(model, val_loader, criterion=None)
@@ -476,7 +424,9 @@ plt.show()
 optimizer = optim.AdamW(model.parameters(), lr=base_lr, weight_decay=wd)
 
 # === Combine the Training and Validation Data ===
-combined_dataset = torch.utils.data.ConcatDataset([train_ds, val_ds])  # Combine train and val datasets
+# With batch augmentation the train half yields uint8 tensors, so the val half has to as well
+combined_val_ds = ISICDataset(val_df, train_dirs, train_decode_transform) if USE_BATCH_AUGMENT else val_ds
+combined_dataset = torch.utils.data.ConcatDataset([train_ds, combined_val_ds])  # Combine train and val datasets
 combined_loader = DataLoader(combined_dataset, batch_size=BATCH_SIZE, shuffle=True, num_workers=4)
 
 # === Fine-Tune on Combined Dataset ===
@@ -506,125 +456,35 @@ transforms = tta.Compose(
     ]
 )
 
-import torchvision.transforms as T
+# Batched TTA shared with the serving backend: all views of a batch are built on
+# the device with flips / 90-degree rotations and run in one enlarged forward pass.
+from backend.tta import BatchTTA
 
-tta_transforms = [
-    T.Compose([T.RandomRotation(degrees=10)]),            # Rotate by up to 30 degrees
-    #T.Compose([T.ColorJitter(brightness=0.2, contrast=0.2)]),  # Color jitter
-    #T.Compose([T.Resize((224, 224))]),
-]
-
-
-# Then during inference, you can apply all these transformations
+TTA_VIEWS = 8  # 1..8, trades evaluation time for accuracy
+tta_engine = BatchTTA(TTA_VIEWS)
 
 
 def tta_predict(model, inputs):
     """Applies TTA and averages the predictions."""
-    tta_preds = []
-    for tta_transform in tta_transforms:
-        augmented_inputs = torch.stack([tta_transform(img.cpu()) for img in inputs])  # Apply transform individually
-        augmented_inputs = augmented_inputs.to(device)
-        outputs = model(augmented_inputs)
-        probs = outputs.softmax(dim=-1)
-        tta_preds.append(probs)
-    avg_probs = torch.mean(torch.stack(tta_preds), dim=0)
-    return avg_probs
+    return tta_engine.predict(model, inputs)
 
 def evaluate_ignore_unk_with_tta(model, dataloader):
     """
     Evaluates the model on test set, ignoring UNK class, with TTA applied.
+    Misclassified samples are returned as (dataset index, pred, true) tuples.
     """
-    model.eval()
-    correct, total = 0, 0
-    all_preds, all_labels = [], []
-    all_probs = []
-    misclassified_images = []
-
-    with torch.no_grad():
-        for inputs, targets in tqdm(dataloader, desc="Evaluating with TTA"):  # <-- tqdm added here
-            inputs, targets = inputs.to(device), targets.to(device)
-
-            # Skip samples labeled as UNK (class 8)
-            mask = targets != 8
-            if not mask.any():
-                continue
-
-            # Filter out UNK samples
-            filtered_inputs = inputs[mask]
-            filtered_targets = targets[mask]
-
-            if len(filtered_inputs) == 0:
-                continue
-
-            # Apply TTA prediction
-            probs = tta_predict(model, filtered_inputs)
-
-            # Only consider probabilities for known classes (0-7)
-            known_probs = probs[:, :8]
-            _, predicted = known_probs.max(1)
-
-            correct += predicted.eq(filtered_targets).sum().item()
-            total += filtered_targets.size(0)
-            all_preds.extend(predicted.cpu().numpy())
-            all_labels.extend(filtered_targets.cpu().numpy())
-            all_probs.extend(known_probs.cpu().numpy())
-
-            # Collect misclassified images for visualization
-            for i in range(len(filtered_targets)):
-                if predicted[i] != filtered_targets[i]:
-                    misclassified_images.append((filtered_inputs[i].cpu(), predicted[i].cpu(), filtered_targets[i].cpu()))
-
-    accuracy = 100. * correct / total if total > 0 else 0
-    return accuracy, all_preds, all_labels, all_probs, misclassified_images
+    result = run_evaluation(model, dataloader, device, num_classes=8, ignore_unk=True,
+                            predict_fn=tta_predict, desc="Evaluating with TTA")
+    return result['acc'], result['preds'], result['labels'], result['probs'], misclassified_samples(result)
 
 def evaluate_ignore_unk(model, dataloader, device):
     """
     Evaluates the model on test set, ignoring samples that are labeled as UNK class.
     Works with a model trained on 9 classes but only evaluates on the first 8 classes.
+    Misclassified samples are returned as (dataset index, pred, true) tuples.
     """
-    model.eval()
-    correct, total = 0, 0
-    all_preds, all_labels = [], []
-    all_probs = []
-    misclassified_images = []
-
-    with torch.no_grad():
-        # Wrap dataloader with tqdm for progress bar
-        for inputs, targets in tqdm(dataloader, desc="Evaluating", ncols=100):
-            inputs, targets = inputs.to(device), targets.to(device)
-
-            # Skip samples labeled as UNK (class 8)
-            mask = targets != 8
-            if not mask.any():
-                continue
-
-            # Filter out UNK samples
-            filtered_inputs = inputs[mask]
-            filtered_targets = targets[mask]
-
-            if len(filtered_inputs) == 0:
-                continue
-
-            outputs = model(filtered_inputs)
-            probs = outputs.softmax(dim=-1)
-
-            # Only consider probabilities for known classes (0-7)
-            known_probs = probs[:, :8]
-            _, predicted = known_probs.max(1)
-
-            correct += predicted.eq(filtered_targets).sum().item()
-            total += filtered_targets.size(0)
-            all_preds.extend(predicted.cpu().numpy())
-            all_labels.extend(filtered_targets.cpu().numpy())
-            all_probs.extend(known_probs.cpu().numpy())
-
-            # Collect misclassified images for visualization
-            for i in range(len(filtered_targets)):
-                if predicted[i] != filtered_targets[i]:
-                    misclassified_images.append((filtered_inputs[i].cpu(), predicted[i].cpu(), filtered_targets[i].cpu()))
-
-    accuracy = 100. * correct / total if total > 0 else 0
-    return accuracy, all_preds, all_labels, all_probs, misclassified_images
+    result = run_evaluation(model, dataloader, device, num_classes=8, ignore_unk=True, desc="Evaluating")
+    return result['acc'], result['preds'], result['labels'], result['probs'], misclassified_samples(result)
 
 """
 # ---------------
@@ -670,7 +530,9 @@ print(f"Displaying first {len(misclassified_images)} misclassified images:")
 num_images = 5  # Change if needed
 plt.figure(figsize=(15, 10))
 
-for i, (image, pred, true) in enumerate(misclassified_images[:num_images]):
+for i, (idx, pred, true) in enumerate(misclassified_images[:num_images]):
+    # Look the image up by index instead of keeping every misclassified tensor around
+    image, _ = test_ds[idx]
     plt.subplot(1, num_images, i + 1)
     image = image.permute(1, 2, 0).cpu().numpy()
 
@@ -683,6 +545,21 @@ for i, (image, pred, true) in enumerate(misclassified_images[:num_images]):
 
 plt.show()
 
+"""## UNK threshold tuning:
+
+Persist the test-set logits once per checkpoint, then tune the UNK threshold and
+calibration temperature offline without re-running B5:
+
+    python sweep_unk_threshold.py --checkpoint best_efficientnet_model_lowest_loss.pth
+"""
+
+from logit_cache import cache_logits
+
+unk_model = timm.create_model('efficientnet_b5', pretrained=False, num_classes=8).to(device)
+unk_model.load_state_dict(torch.load('best_efficientnet_model_lowest_loss.pth', map_location=device))
+cache_logits(unk_model, test_loader, device, 'best_efficientnet_model_lowest_loss.pth',
+             test_gt['image'].tolist(), cache_dir='logit_cache')
+
 """72.99% accuracy
 0.72xx f1
 """
\ No newline at end of file
@@ -0,0 +1,208 @@
+"""Streaming evaluation shared by the notebook's evaluate variants.
+
+Everything per batch stays on the model's device: softmax outputs, labels
+and predictions are written into preallocated result tensors, the loss is
+summed without ``.item()`` syncs, and a running confusion matrix is kept for
+the plain argmax prediction and for every UNK threshold at the same time.
+Results are copied to NumPy once, at the end.
+
+Misclassified samples are reported as dataset indices (loader order, so the
+loader must not shuffle) instead of copies of the input tensors; use
+``dataset[idx]`` to look an image up for plotting.
+"""
+
+import numpy as np
+import torch
+import torch.distributed as dist
+from tqdm import tqdm
+
+UNK_LABEL = 8
+
+
+def f1_from_confusion(cm):
+    """Macro and weighted F1 from a confusion matrix (rows = true, cols = pred).
+
+    Like sklearn, the macro average only covers labels that occur in either
+    the true labels or the predictions.
+    """
+    cm = np.asarray(cm, dtype=np.float64)
+    tp = np.diag(cm)
+    support = cm.sum(axis=1)
+    predicted = cm.sum(axis=0)
+    denom = support + predicted
+    f1 = np.divide(2 * tp, denom, out=np.zeros_like(tp), where=denom > 0)
+    present = denom > 0
+    macro = float(f1[present].mean()) if present.any() else 0.0
+    weighted = float((f1 * support).sum() / support.sum()) if support.sum() > 0 else 0.0
+    return macro, weighted
+
+
+def _summarize(cm):
+    total = int(cm.sum())
+    correct = int(np.trace(cm))
+    macro_f1, weighted_f1 = f1_from_confusion(cm)
+    return {
+        'acc': 100. * correct / total if total > 0 else 0,
+        'macro_f1': macro_f1,
+        'weighted_f1': weighted_f1,
+        'confusion': cm,
+    }
+
+
+class EvalAccumulator:
+    """Accumulates one evaluation pass over ``num_samples`` samples.
+
+    ``update`` takes the per-batch softmax probabilities and targets. With
+    ``ignore_unk`` samples labeled ``unk_label`` are skipped (they still
+    advance the sample index). For every threshold in ``unk_thresholds`` a
+    second prediction is tracked where ``max_prob < threshold`` becomes
+    ``unk_label``.
+    """
+
+    def __init__(self, num_samples, num_classes, device, unk_thresholds=(), ignore_unk=False, unk_label=UNK_LABEL,
+                 store_logits=False):
+        self.num_classes = num_classes
+        self.unk_label = unk_label
+        self.ignore_unk = ignore_unk
+        self.unk_thresholds = tuple(unk_thresholds)
+        # Labels can be 0..unk_label, predictions 0..num_classes-1 or unk_label
+        self.size = max(num_classes, unk_label + 1)
+        self.device = device
+
+        self.probs = torch.empty((num_samples, num_classes), dtype=torch.float32, device=device)
+        self.logits = torch.empty((num_samples, num_classes), dtype=torch.float32, device=device) if store_logits else None
+        self.labels = torch.empty(num_samples, dtype=torch.long, device=device)
+        self.preds = torch.empty(num_samples, dtype=torch.long, device=device)
+        self.keep = torch.zeros(num_samples, dtype=torch.bool, device=device)
+        self.confusion = torch.zeros(self.size * self.size, dtype=torch.long, device=device)
+        self.unk_confusion = torch.zeros((len(self.unk_thresholds), self.size * self.size), dtype=torch.long, device=device)
+        self.loss_sum = torch.zeros((), dtype=torch.float32, device=device)
+        self.loss_count = torch.zeros((), dtype=torch.float32, device=device)
+        self.has_loss = False
+        self.pos = 0
+
+    def _bincount(self, targets, preds):
+        return torch.bincount(targets * self.size + preds, minlength=self.size * self.size)
+
+    def update(self, probs, targets, loss=None, logits=None):
+        n = targets.size(0)
+        sl = slice(self.pos, self.pos + n)
+        self.pos += n
+
+        probs = probs[:, :self.num_classes].float()
+        max_probs, predicted = probs.max(1)
+        self.probs[sl] = probs
+        self.labels[sl] = targets
+        self.preds[sl] = predicted
+        if self.logits is not None:
+            self.logits[sl] = logits[:, :self.num_classes].float()
+
+        keep = targets != self.unk_label if self.ignore_unk else torch.ones_like(targets, dtype=torch.bool)
+        self.keep[sl] = keep
+        if loss is not None:
+            # The loss is a mean over the kept samples of this batch
+            kept = keep.sum()
+            self.loss_sum += loss.detach().float() * kept
+            self.loss_count += kept
+            self.has_loss = True
+
+        kept_targets = targets[keep]
+        self.confusion += self._bincount(kept_targets, predicted[keep])
+        for i, threshold in enumerate(self.unk_thresholds):
+            unk_pred = torch.where(max_probs < threshold, torch.full_like(predicted, self.unk_label), predicted)
+            self.unk_confusion[i] += self._bincount(kept_targets, unk_pred[keep])
+
+    def all_reduce(self):
+        """Sums the confusion matrices and loss over all torch.distributed ranks.
+
+        After this, ``compute`` reports global metrics; the per-sample arrays
+        still only hold this rank's shard.
+        """
+        for t in (self.confusion, self.unk_confusion, self.loss_sum, self.loss_count):
+            dist.all_reduce(t)
+        has_loss = torch.tensor(int(self.has_loss), device=self.device)
+        dist.all_reduce(has_loss, op=dist.ReduceOp.MAX)
+        self.has_loss = bool(has_loss)
+
+    def compute(self):
+        n = self.pos
+        keep = self.keep[:n].cpu().numpy()
+        probs = self.probs[:n].cpu().numpy()
+        labels = self.labels[:n].cpu().numpy()
+        preds = self.preds[:n].cpu().numpy()
+        cm = self.confusion.view(self.size, self.size).cpu().numpy()
+
+        result = _summarize(cm)
+        result['loss'] = float(self.loss_sum / self.loss_count.clamp(min=1)) if self.has_loss else None
+        result['probs'] = probs[keep]
+        result['labels'] = labels[keep]
+        result['preds'] = preds[keep]
+        result['indices'] = np.flatnonzero(keep)
+        result['misclassified'] = np.flatnonzero(keep & (preds != labels))
+        if self.logits is not None:
+            # All samples, including ignored ones, so caches line up with the dataset
+            result['logits'] = self.logits[:n].cpu().numpy()
+            result['all_labels'] = labels
+
+        result['unk'] = {}
+        unk_cms = self.unk_confusion.view(-1, self.size, self.size).cpu().numpy()
+        for threshold, unk_cm in zip(self.unk_thresholds, unk_cms):
+            summary = _summarize(unk_cm)
+            # Fraction of samples the rule did not send to UNK
+            summary['coverage'] = 1.0 - unk_cm[:, self.unk_label].sum() / max(unk_cm.sum(), 1)
+            result['unk'][threshold] = summary
+        return result
+
+
+def misclassified_samples(result):
+    """``(dataset_index, predicted, true)`` triples for every misclassified sample."""
+    idx = result['misclassified']
+    # preds/labels only hold the kept samples; map dataset indices to their rows
+    rows = np.searchsorted(result['indices'], idx)
+    return list(zip(idx.tolist(), result['preds'][rows].tolist(), result['labels'][rows].tolist()))
+
+
+def run_evaluation(model, dataloader, device, criterion=None, num_classes=8, unk_thresholds=(),
+                   ignore_unk=False, predict_fn=None, desc=None, store_logits=False, distributed=False):
+    """Evaluates ``model`` over ``dataloader`` in one pass and returns the metrics dict.
+
+    ``predict_fn(model, inputs)`` must return softmax probabilities; pass a
+    TTA function to evaluate with test-time augmentation. ``criterion`` is
+    applied to those probabilities, as in training.
+
+    With ``store_logits`` the result also holds ``logits`` and ``all_labels``
+    for every sample in loader order. Under a custom ``predict_fn`` the
+    logits are the log of its averaged probabilities.
+
+    With ``distributed`` every rank evaluates its own shard of the data (the
+    loader's sampler) and the metrics are reduced across ranks.
+    """
+    model.eval()
+    num_samples = len(dataloader.sampler) if distributed else len(dataloader.dataset)
+    acc = EvalAccumulator(num_samples, num_classes, device,
+                          unk_thresholds=unk_thresholds, ignore_unk=ignore_unk, store_logits=store_logits)
+    batches = tqdm(dataloader, desc=desc) if desc else dataloader
+
+    with torch.no_grad():
+        for inputs, targets in batches:
+            inputs, targets = inputs.to(device, non_blocking=True), targets.to(device, non_blocking=True)
+            logits = None
+            if predict_fn is None:
+                logits = model(inputs)
+                probs = logits.softmax(dim=-1)
+            else:
+                probs = predict_fn(model, inputs)
+                if store_logits:
+                    logits = probs.clamp_min(1e-12).log()
+            loss = None
+            if criterion is not None:
+                if ignore_unk:
+                    keep = targets != acc.unk_label
+                    loss = criterion(probs[keep], targets[keep]) if keep.any() else None
+                else:
+                    loss = criterion(probs, targets)
+            acc.update(probs, targets, loss, logits)
+
+    if distributed:
+        acc.all_reduce()
+    return acc.compute()
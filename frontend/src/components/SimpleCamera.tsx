@@ -3,6 +3,11 @@
 import React, { useRef, useState, useEffect, useCallback } from 'react';
 import { Button } from '@/components/ui/button';
 import { Loader2, Camera, FlipHorizontal } from 'lucide-react';
+import { getPredictionLabel, openPredictionStream, StreamPrediction } from '@/lib/api';
+
+// Live framing guidance: downscaled frames sent to the backend's /stream
+const LIVE_FRAME_INTERVAL_MS = 300;
+const LIVE_FRAME_MAX_SIDE = 320;
 
 interface SimpleCameraProps {
   onCapture: (imageData: string) => void;
@@ -17,6 +22,7 @@ export function SimpleCamera({ onCapture }: SimpleCameraProps) {
   const [isFrontCamera, setIsFrontCamera] = useState(true);
   const [videoDevices, setVideoDevices] = useState<MediaDeviceInfo[]>([]);
   const streamRef = useRef<MediaStream | null>(null);
+  const [livePrediction, setLivePrediction] = useState<StreamPrediction | null>(null);
   
   // Store stream in ref to avoid circular dependencies
   useEffect(() => {
@@ -124,6 +130,33 @@ export function SimpleCamera({ onCapture }: SimpleCameraProps) {
     }
   }, []); // Remove stream dependency to avoid re-running this effect when stream changes
   
+  // Stream frames for rolling predictions while the camera is live
+  useEffect(() => {
+    if (!ready) return;
+
+    const liveStream = openPredictionStream(setLivePrediction, (message) =>
+      console.warn('SimpleCamera: live prediction error', message)
+    );
+    const canvas = document.createElement('canvas');
+    const interval = setInterval(() => {
+      const video = videoRef.current;
+      if (!video || video.videoWidth === 0) return;
+      const scale = Math.min(1, LIVE_FRAME_MAX_SIDE / Math.max(video.videoWidth, video.videoHeight));
+      canvas.width = Math.round(video.videoWidth * scale);
+      canvas.height = Math.round(video.videoHeight * scale);
+      const ctx = canvas.getContext('2d');
+      if (!ctx) return;
+      ctx.drawImage(video, 0, 0, canvas.width, canvas.height);
+      canvas.toBlob((blob) => blob && liveStream.sendFrame(blob), 'image/jpeg', 0.7);
+    }, LIVE_FRAME_INTERVAL_MS);
+
+    return () => {
+      clearInterval(interval);
+      liveStream.close();
+      setLivePrediction(null);
+    };
+  }, [ready]);
+
   const handleManualPlay = () => {
     if (videoRef.current) {
       videoRef.current.play()
@@ -211,8 +244,23 @@ export function SimpleCamera({ onCapture }: SimpleCameraProps) {
         
         {/* Focus target */}
         <div className="absolute inset-0 flex items-center justify-center pointer-events-none">
-          <div className="border-2 border-dashed border-white rounded-full w-24 h-24 opacity-70" />
+          <div
+            className={`border-2 border-dashed rounded-full w-24 h-24 opacity-70 ${
+              livePrediction?.stable ? 'border-green-400' : 'border-white'
+            }`}
+          />
         </div>
+
+        {/* Live framing guidance */}
+        {livePrediction && !loading && !error && (
+          <div className="absolute bottom-2 left-2 right-2 rounded bg-black/50 px-3 py-1 text-center text-sm text-white pointer-events-none">
+            {livePrediction.stable
+              ? `Hold still and capture (${getPredictionLabel(livePrediction.prediction)}, ${Math.round(
+                  livePrediction.max_confidence * 100
+                )}%)`
+              : 'Center the lesion in the circle and hold steady'}
+          </div>
+        )}
       </div>
       
       <div className="w-full">
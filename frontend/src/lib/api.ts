@@ -3,6 +3,8 @@ export type PredictionResponse = {
   prediction: number;
   probabilities: number[];
   gradcam?: string; // Base64 encoded Grad-CAM heatmap image
+  // With gradcam_top_k > 1: heatmaps of the top classes, the predicted one first
+  gradcams?: { class: number; probability: number; gradcam: string }[];
 };
 
 const DEFAULT_PREDICT_URL =
@@ -13,6 +15,58 @@ const getPredictUrl = (): string => {
   return process.env.NEXT_PUBLIC_PREDICT_URL || DEFAULT_PREDICT_URL;
 };
 
+export type StreamPrediction = {
+  prediction: number;
+  probabilities: number[];
+  max_confidence: number;
+  frame_confidence: number;
+  stable: boolean; // The last few frames agree confidently: good moment to capture
+  motion: number | null;
+  latency_ms: number;
+  frames: { received: number; classified: number; skipped: number; dropped: number };
+};
+
+const getStreamUrl = (): string => {
+  if (process.env.NEXT_PUBLIC_STREAM_URL) {
+    return process.env.NEXT_PUBLIC_STREAM_URL;
+  }
+  // Same service as /predict, over WebSocket
+  return getPredictUrl().replace(/^http/, 'ws').replace(/\/predict$/, '/stream');
+};
+
+export type PredictionStream = {
+  sendFrame: (frame: Blob) => void;
+  close: () => void;
+};
+
+export const openPredictionStream = (
+  onPrediction: (prediction: StreamPrediction) => void,
+  onError?: (error: string) => void
+): PredictionStream => {
+  const socket = new WebSocket(getStreamUrl());
+  socket.binaryType = 'arraybuffer';
+
+  socket.onmessage = (event) => {
+    const message = JSON.parse(event.data);
+    if (message.error) {
+      onError?.(message.error);
+    } else {
+      onPrediction(message as StreamPrediction);
+    }
+  };
+  socket.onerror = () => onError?.('Live prediction stream failed');
+
+  return {
+    sendFrame: (frame: Blob) => {
+      // The server only classifies the newest frame; don't pile frames up in a slow connection either
+      if (socket.readyState === WebSocket.OPEN && socket.bufferedAmount === 0) {
+        socket.send(frame);
+      }
+    },
+    close: () => socket.close(),
+  };
+};
+
 export const CLASS_LABELS = [
   'MEL', 
   'NV', 
@@ -166,6 +220,20 @@ export const normalizeImageBlob = async (
   }
 };
 
+// Recent results by image hash, with their ETag: the server answers 304 for an image it
+// already scored for us (same model and settings), and we reuse the result
+const PREDICTION_CACHE_SIZE = 10;
+const predictionCache = new Map<string, { etag: string; result: PredictionResponse }>();
+
+const hashBlob = async (blob: Blob): Promise<string | null> => {
+  if (typeof crypto === 'undefined' || !crypto.subtle) {
+    // Not a secure context
+    return null;
+  }
+  const digest = await crypto.subtle.digest('SHA-256', await blob.arrayBuffer());
+  return Array.from(new Uint8Array(digest), (b) => b.toString(16).padStart(2, '0')).join('');
+};
+
 export const getPredictionFromBlob = async (
   imageBlob: Blob,
   filename: string = 'image.jpg'
@@ -173,17 +241,32 @@ export const getPredictionFromBlob = async (
   const formData = new FormData();
   formData.append('file', imageBlob, filename);
 
+  const key = await hashBlob(imageBlob);
+  const cached = key ? predictionCache.get(key) : undefined;
   const response = await fetch(getPredictUrl(), {
     method: 'POST',
     body: formData,
+    headers: cached ? { 'If-None-Match': cached.etag } : undefined,
   });
 
+  if (response.status === 304 && cached) {
+    return cached.result;
+  }
   if (!response.ok) {
     const responseText = await response.text().catch(() => '');
     throw new Error(`API error: ${response.status} ${responseText}`);
   }
 
-  return await response.json();
+  const result: PredictionResponse = await response.json();
+  const etag = response.headers.get('ETag');
+  if (key && etag) {
+    predictionCache.delete(key);
+    predictionCache.set(key, { etag, result });
+    if (predictionCache.size > PREDICTION_CACHE_SIZE) {
+      predictionCache.delete(predictionCache.keys().next().value as string);
+    }
+  }
+  return result;
 };
 
 export const getPrediction = async (imageBase64: string): Promise<PredictionResponse> => {
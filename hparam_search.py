@@ -0,0 +1,245 @@
+"""Parallel hyperparameter search for the focal-loss gamma, weight decay and learning rate.
+
+Trials are sampled at random from the search space below and trained in
+parallel worker processes with train.train_one_epoch / train.evaluate on a
+stratified subset of the training and validation data. After every epoch a
+trial reports its val_f1 / val_loss and is pruned if it is worse than the
+median of the other trials at the same epoch (once enough of them got that
+far), so unpromising settings stop early and free their worker. val_loss is
+the plain cross-entropy, not the trial's focal loss: a larger gamma gives a
+smaller focal loss whatever the model, so those would not be comparable.
+
+All trials and their per-epoch curves live in a SQLite file. Re-running the
+same command resumes the search: finished and pruned trials are kept,
+trials that were running when the search was interrupted are retried, and
+trial parameters are derived from (seed, trial id) so they do not change.
+
+Usage:
+    python hparam_search.py --train_csv combined_groundtruth.csv --train_dirs dirA dirB \\
+        --n_trials 48 --workers 12 --threads_per_worker 4 --subset_fraction 0.2 --epochs 6
+"""
+
+import argparse
+import json
+import math
+import multiprocessing as mp
+import os
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+import timm
+import torch
+import torch.optim as optim
+from focal_loss.focal_loss import FocalLoss
+from torch.utils.data import DataLoader
+
+from batch_augment import BatchAugment, decode_transform
+from isic_data import ISICDataset, build_val_transform, load_ground_truth, load_group_ids, split_train_val
+from train import NUM_CLASSES, evaluate, seed_everything, train_one_epoch
+
+# (low, high, log scale). The defaults in train.py came out of an earlier search in this space.
+SEARCH_SPACE = {
+    'gamma': (0.5, 4.0, False),
+    'wd': (1e-4, 5e-2, True),
+    'lr': (1e-5, 5e-4, True),
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS trials (
+    trial_id INTEGER PRIMARY KEY,
+    params TEXT NOT NULL,
+    status TEXT NOT NULL,
+    best_val_loss REAL,
+    best_val_f1 REAL,
+    updated REAL
+);
+CREATE TABLE IF NOT EXISTS epochs (
+    trial_id INTEGER NOT NULL,
+    epoch INTEGER NOT NULL,
+    val_loss REAL NOT NULL,
+    val_f1 REAL NOT NULL,
+    PRIMARY KEY (trial_id, epoch)
+);
+"""
+
+
+def connect(db_path):
+    # Workers in other processes write concurrently; wait on the lock instead of failing
+    conn = sqlite3.connect(db_path, timeout=60, isolation_level=None)
+    conn.execute('PRAGMA journal_mode=WAL')
+    return conn
+
+
+def sample_params(seed, trial_id):
+    rng = np.random.default_rng([seed, trial_id])
+    params = {}
+    for name, (low, high, log) in SEARCH_SPACE.items():
+        if log:
+            params[name] = float(math.exp(rng.uniform(math.log(low), math.log(high))))
+        else:
+            params[name] = float(rng.uniform(low, high))
+    return params
+
+
+def should_prune(conn, trial_id, epoch, value, metric, min_trials, warmup_epochs):
+    """Median rule: prune if ``value`` is worse than the median of other trials at this epoch."""
+    if epoch < warmup_epochs:
+        return False
+    rows = conn.execute(f'SELECT {metric} FROM epochs WHERE epoch = ? AND trial_id != ?',
+                        (epoch, trial_id)).fetchall()
+    if len(rows) < min_trials:
+        return False
+    median = float(np.median([r[0] for r in rows]))
+    return value > median if metric == 'val_loss' else value < median
+
+
+def subset(df, fraction, seed):
+    if fraction >= 1.0:
+        return df
+    # Stratified: the same fraction of every class, at least one image each
+    parts = [g.sample(n=max(1, int(round(len(g) * fraction))), random_state=seed)
+             for _, g in df.groupby('single_label')]
+    return pd.concat(parts).reset_index(drop=True)
+
+
+def run_trial(trial_id, params, args):
+    """Trains one trial in a worker process and returns its final status."""
+    torch.set_num_threads(args.threads_per_worker)
+    seed_everything(args.seed + trial_id)
+    if torch.cuda.is_available() and args.device != 'cpu':
+        device = torch.device('cuda', trial_id % torch.cuda.device_count())
+    else:
+        device = torch.device('cpu')
+
+    conn = connect(args.db)
+    conn.execute("UPDATE trials SET status = 'running', updated = ? WHERE trial_id = ?", (time.time(), trial_id))
+
+    train_gt = load_ground_truth(args.train_csv)
+    # The same split as train.py: near-duplicate clusters stay on one side
+    groups = load_group_ids(args.groups_csv, train_gt) if args.groups_csv else None
+    train_df, val_df = split_train_val(train_gt, seed=args.seed, groups=groups)
+    train_ds = ISICDataset(subset(train_df, args.subset_fraction, args.seed), args.train_dirs,
+                           decode_transform(args.img_size))
+    val_ds = ISICDataset(subset(val_df, args.subset_fraction, args.seed), args.train_dirs,
+                         build_val_transform(args.img_size))
+    train_loader = DataLoader(train_ds, batch_size=args.batch_size, shuffle=True, num_workers=args.loader_workers)
+    val_loader = DataLoader(val_ds, batch_size=args.batch_size, shuffle=False, num_workers=args.loader_workers)
+
+    model = timm.create_model(args.model, pretrained=args.pretrained, num_classes=NUM_CLASSES).to(device)
+    criterion = FocalLoss(gamma=params['gamma'], reduction='mean')
+    # Validation loss at gamma 0 (cross-entropy), comparable between trials
+    val_criterion = FocalLoss(gamma=0.0, reduction='mean')
+    optimizer = optim.AdamW(model.parameters(), lr=params['lr'], weight_decay=params['wd'])
+    scaler = torch.cuda.amp.GradScaler(enabled=device.type == 'cuda')
+    augment = BatchAugment()
+
+    best_loss, best_f1 = float('inf'), 0.0
+    status = 'complete'
+    for epoch in range(args.epochs):
+        train_one_epoch(model, train_loader, optimizer, criterion, scaler, device, augment=augment,
+                        show_progress=False)
+        _, val_loss, val_f1 = evaluate(model, val_loader, val_criterion, device)
+        best_loss, best_f1 = min(best_loss, val_loss), max(best_f1, val_f1)
+        conn.execute('INSERT OR REPLACE INTO epochs VALUES (?, ?, ?, ?)', (trial_id, epoch, val_loss, val_f1))
+        conn.execute('UPDATE trials SET best_val_loss = ?, best_val_f1 = ?, updated = ? WHERE trial_id = ?',
+                     (best_loss, best_f1, time.time(), trial_id))
+        value = val_loss if args.prune_metric == 'val_loss' else val_f1
+        if epoch < args.epochs - 1 and should_prune(conn, trial_id, epoch, value, args.prune_metric,
+                                                    args.min_trials_for_pruning, args.warmup_epochs):
+            status = 'pruned'
+            break
+
+    conn.execute('UPDATE trials SET status = ?, updated = ? WHERE trial_id = ?', (status, time.time(), trial_id))
+    conn.close()
+    return trial_id, status, epoch + 1, best_loss, best_f1
+
+
+def pending_trials(conn, n_trials, seed):
+    """Registers missing trials and returns those still to run (new or interrupted)."""
+    known = dict(conn.execute('SELECT trial_id, status FROM trials').fetchall())
+    for trial_id in range(n_trials):
+        if trial_id not in known:
+            conn.execute('INSERT INTO trials (trial_id, params, status, updated) VALUES (?, ?, ?, ?)',
+                         (trial_id, json.dumps(sample_params(seed, trial_id)), 'queued', time.time()))
+            known[trial_id] = 'queued'
+    todo = [t for t, status in known.items() if status in ('queued', 'running') and t < n_trials]
+    # An interrupted trial starts over; drop its partial curve so it doesn't skew pruning
+    for trial_id in todo:
+        conn.execute('DELETE FROM epochs WHERE trial_id = ?', (trial_id,))
+    rows = conn.execute(f"SELECT trial_id, params FROM trials WHERE trial_id IN ({','.join('?' * len(todo))})",
+                        todo).fetchall() if todo else []
+    return [(trial_id, json.loads(params)) for trial_id, params in sorted(rows)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Parallel hyperparameter search with median pruning')
+    parser.add_argument('--train_csv', type=str, required=True, help='Combined training ground truth CSV')
+    parser.add_argument('--train_dirs', type=str, nargs='+', required=True, help='Training image directories')
+    parser.add_argument('--db', type=str, default='hparam_search.db', help='SQLite trial store (resumable)')
+    parser.add_argument('--n_trials', type=int, default=32, help='Total number of trials')
+    parser.add_argument('--workers', type=int, default=None, help='Parallel trials (default: cores / threads)')
+    parser.add_argument('--threads_per_worker', type=int, default=4, help='torch intra-op threads per trial')
+    parser.add_argument('--loader_workers', type=int, default=2, help='DataLoader workers per trial')
+    parser.add_argument('--subset_fraction', type=float, default=0.2, help='Stratified fraction of train/val data')
+    parser.add_argument('--epochs', type=int, default=6, help='Maximum epochs per trial')
+    parser.add_argument('--groups_csv', type=str, default=None,
+                        help='Split groups from dedup_images.py, as given to train.py')
+    parser.add_argument('--prune_metric', type=str, default='val_f1', choices=['val_f1', 'val_loss'])
+    parser.add_argument('--min_trials_for_pruning', type=int, default=4,
+                        help='Other trials needed at an epoch before pruning against them')
+    parser.add_argument('--warmup_epochs', type=int, default=1, help='Epochs before a trial can be pruned')
+    parser.add_argument('--model', type=str, default='efficientnet_b5', help='timm model name')
+    parser.add_argument('--pretrained', action=argparse.BooleanOptionalAction, default=True)
+    parser.add_argument('--img_size', type=int, default=456, help='Input resolution')
+    parser.add_argument('--batch_size', type=int, default=16, help='Batch size per trial')
+    parser.add_argument('--seed', type=int, default=42, help='Search seed')
+    parser.add_argument('--device', type=str, default='auto', choices=['auto', 'cpu'], help='Force CPU trials')
+    args = parser.parse_args()
+
+    workers = args.workers or max(1, (os.cpu_count() or 1) // args.threads_per_worker)
+    conn = connect(args.db)
+    conn.executescript(SCHEMA)
+    todo = pending_trials(conn, args.n_trials, args.seed)
+    done = args.n_trials - len(todo)
+    print(f"Search: {args.n_trials} trials ({done} already finished), {workers} workers x "
+          f"{args.threads_per_worker} threads, subset {args.subset_fraction:.0%}, up to {args.epochs} epochs")
+
+    # spawn: forking after torch has started threads is unsafe
+    with ProcessPoolExecutor(max_workers=workers, mp_context=mp.get_context('spawn')) as pool:
+        futures = {}
+        for trial_id, params in todo:
+            # Marked running by the worker when it starts
+            futures[pool.submit(run_trial, trial_id, params, args)] = trial_id
+        for future in as_completed(futures):
+            trial_id = futures[future]
+            try:
+                _, status, epochs, best_loss, best_f1 = future.result()
+                print(f"Trial {trial_id:3d} {status:8s} after {epochs} epoch(s): "
+                      f"best val CE {best_loss:.4f}, best val F1 {best_f1:.4f}")
+            except Exception as e:
+                conn.execute("UPDATE trials SET status = 'failed', updated = ? WHERE trial_id = ?",
+                             (time.time(), trial_id))
+                print(f"Trial {trial_id:3d} failed: {e}")
+
+    rows = conn.execute("SELECT trial_id, params, status, best_val_loss, best_val_f1 FROM trials "
+                        "WHERE best_val_f1 IS NOT NULL ORDER BY best_val_f1 DESC").fetchall()
+    counts = dict(conn.execute('SELECT status, COUNT(*) FROM trials GROUP BY status').fetchall())
+    conn.close()
+
+    print("\n===== Hyperparameter Search Results =====")
+    print(f"Trials: {counts}")
+    for trial_id, params, status, best_loss, best_f1 in rows[:10]:
+        p = json.loads(params)
+        print(f"#{trial_id:<3d} {status:8s} F1 {best_f1:.4f} CE {best_loss:.4f} "
+              f"gamma {p['gamma']:.4f} wd {p['wd']:.3g} lr {p['lr']:.3g}")
+    if rows:
+        best = json.loads(rows[0][1])
+        print(f"Best: python train.py ... --gamma {best['gamma']} --wd {best['wd']} --lr {best['lr']}")
+    print("=========================================")
+
+
+if __name__ == '__main__':
+    main()
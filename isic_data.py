@@ -0,0 +1,139 @@
+"""ISIC dataset shared by the training notebook and the training scripts.
+
+Image paths are resolved once when the dataset is built: every image
+directory is listed a single time instead of probing ``os.path.exists`` for
+each directory on every ``__getitem__`` call, which is very slow on
+network-mounted storage such as Google Drive.
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+from PIL import Image, ImageOps
+from sklearn.model_selection import StratifiedGroupKFold
+from torch.utils.data import Dataset
+from torchvision import transforms
+
+IMAGENET_MEAN = (0.485, 0.456, 0.406)
+IMAGENET_STD = (0.229, 0.224, 0.225)
+
+
+class CenterSquareCrop:
+    def __call__(self, img):
+        w, h = img.size
+        m = min(w, h)
+        left, top = (w-m)//2, (h-m)//2
+        return img.crop((left, top, left+m, top+m))
+
+
+def build_val_transform(size=456):
+    return transforms.Compose([
+        CenterSquareCrop(),
+        transforms.Lambda(lambda img: img.convert('RGB')),
+        transforms.Resize((size, size)),
+        transforms.ToTensor(),
+        transforms.Normalize(IMAGENET_MEAN, IMAGENET_STD)
+    ])
+
+
+def build_serving_transform(size=456):
+    """The backend's preprocessing: EXIF orientation, then the whole image resized, no crop."""
+    return transforms.Compose([
+        transforms.Lambda(lambda img: ImageOps.exif_transpose(img).convert('RGB')),
+        transforms.Resize((size, size)),
+        transforms.ToTensor(),
+        transforms.Normalize(IMAGENET_MEAN, IMAGENET_STD)
+    ])
+
+
+def load_ground_truth(csv_path, include_unk=False):
+    """Reads an ISIC ground truth CSV and adds the argmax ``single_label`` column.
+
+    Training CSVs have 8 one-hot class columns after ``image``; test CSVs also
+    have the UNK column, which ``include_unk`` keeps as label 8.
+    """
+    gt = pd.read_csv(csv_path)
+    labels = gt.iloc[:, 1:10] if include_unk else gt.iloc[:, 1:9]
+    gt['single_label'] = labels.values.argmax(axis=1)
+    return gt
+
+
+def split_train_val(train_gt, seed=42, n_splits=5, groups=None):
+    """Stratified group split used by the notebook; one fold is held out for validation.
+
+    Groups default to the image name, i.e. every image is its own group.
+    """
+    groups = train_gt['image'] if groups is None else groups
+    sgkf = StratifiedGroupKFold(n_splits=n_splits, shuffle=True, random_state=seed)
+    train_idx, val_idx = next(sgkf.split(train_gt, train_gt['single_label'], groups=groups))
+    return train_gt.iloc[train_idx].reset_index(drop=True), train_gt.iloc[val_idx].reset_index(drop=True)
+
+
+def load_group_ids(groups_csv, gt):
+    """Group ids for ``split_train_val`` from a groups CSV (``image``, ``group``).
+
+    Images missing from the CSV form their own group.
+    """
+    groups = pd.read_csv(groups_csv).set_index('image')['group'].astype(str)
+    mapped = gt['image'].map(groups)
+    return mapped.fillna('image:' + gt['image'])
+
+
+def image_file_name(raw_name):
+    # Strip .jpg if it exists, then append .jpg
+    return raw_name.replace('.jpg', '') + '.jpg'
+
+
+def resolve_image_paths(names, img_dirs):
+    """Map every image name to its full path, searching ``img_dirs`` in order.
+
+    Raises a FileNotFoundError listing the missing images if any name cannot be
+    found in any of the directories.
+    """
+    # One directory listing per source; earlier directories take precedence,
+    # matching the lookup order of the original per-sample loop.
+    index = {}
+    for d in img_dirs:
+        with os.scandir(d) as entries:
+            for entry in entries:
+                if entry.name not in index:
+                    index[entry.name] = entry.path
+
+    paths, missing = [], []
+    for raw_name in names:
+        name = image_file_name(raw_name)
+        path = index.get(name)
+        if path is None:
+            missing.append(name)
+        paths.append(path)
+
+    if missing:
+        preview = ', '.join(missing[:10])
+        more = f' (and {len(missing) - 10} more)' if len(missing) > 10 else ''
+        raise FileNotFoundError(
+            f"{len(missing)} of {len(paths)} images not found in any of {list(img_dirs)}: {preview}{more}"
+        )
+    return paths
+
+
+class ISICDataset(Dataset):
+    def __init__(self, df, img_dirs, transform=None, is_test=False):
+        self.df = df
+        self.img_dirs = img_dirs if isinstance(img_dirs, list) else [img_dirs]
+        self.transform = transform
+        self.is_test = is_test
+
+        # Resolved once here so the per-sample hot path is two array lookups.
+        self.paths = resolve_image_paths(df['image'].tolist(), self.img_dirs)
+        self.labels = df['single_label'].to_numpy(dtype=np.int64)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, idx):
+        img = Image.open(self.paths[idx])
+        label = int(self.labels[idx])
+        if self.transform:
+            img = self.transform(img)
+        return img, label
@@ -0,0 +1,81 @@
+"""On-disk logit cache keyed by (checkpoint hash, image id).
+
+Running EfficientNet-B5 over the test set is by far the most expensive part
+of tuning the UNK rule, so evaluation can persist the raw logits once and
+sweep_unk_threshold.py then works on the cached arrays only.
+
+Each checkpoint gets one ``<sha256>.npz`` file in the cache directory with
+``image_ids``, ``logits`` and ``labels`` arrays. New entries are merged into
+an existing file; an image id that is already present is overwritten.
+"""
+
+import hashlib
+import os
+
+import numpy as np
+
+from eval_engine import run_evaluation
+
+
+def checkpoint_hash(checkpoint_path, chunk_size=1 << 20):
+    """SHA-256 of the checkpoint file contents."""
+    h = hashlib.sha256()
+    with open(checkpoint_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def cache_path(cache_dir, ckpt_hash):
+    return os.path.join(cache_dir, f'{ckpt_hash}.npz')
+
+
+def load_logits(cache_dir, ckpt_hash):
+    """Returns ``(image_ids, logits, labels)`` or ``None`` if nothing is cached."""
+    path = cache_path(cache_dir, ckpt_hash)
+    if not os.path.exists(path):
+        return None
+    with np.load(path, allow_pickle=False) as data:
+        return data['image_ids'], data['logits'], data['labels']
+
+
+def save_logits(cache_dir, ckpt_hash, image_ids, logits, labels):
+    os.makedirs(cache_dir, exist_ok=True)
+    image_ids = np.asarray(image_ids, dtype=str)
+    logits = np.asarray(logits, dtype=np.float32)
+    labels = np.asarray(labels, dtype=np.int64)
+
+    existing = load_logits(cache_dir, ckpt_hash)
+    if existing is not None:
+        old_ids, old_logits, old_labels = existing
+        stale = ~np.isin(old_ids, image_ids)
+        image_ids = np.concatenate([old_ids[stale], image_ids])
+        logits = np.concatenate([old_logits[stale], logits])
+        labels = np.concatenate([old_labels[stale], labels])
+
+    # Write to a temp file and rename so an interrupted save never leaves a torn cache
+    path = cache_path(cache_dir, ckpt_hash)
+    tmp_path = path + '.tmp.npz'
+    np.savez(tmp_path, image_ids=image_ids, logits=logits, labels=labels)
+    os.replace(tmp_path, path)
+    return path
+
+
+def cache_logits(model, dataloader, device, checkpoint_path, image_ids, cache_dir='logit_cache',
+                 num_classes=8, predict_fn=None):
+    """Evaluates ``model`` once and persists its logits for ``image_ids`` (loader order).
+
+    Skips the forward passes entirely when every image id is already cached
+    for this checkpoint. Returns ``(image_ids, logits, labels)`` from the cache.
+    """
+    ckpt_hash = checkpoint_hash(checkpoint_path)
+    cached = load_logits(cache_dir, ckpt_hash)
+    if cached is not None and np.isin(np.asarray(image_ids, dtype=str), cached[0]).all():
+        print(f"Logits for {len(image_ids)} images already cached for checkpoint {ckpt_hash[:12]}")
+        return cached
+
+    result = run_evaluation(model, dataloader, device, num_classes=num_classes, predict_fn=predict_fn,
+                            desc="Caching logits", store_logits=True)
+    path = save_logits(cache_dir, ckpt_hash, image_ids, result['logits'], result['all_labels'])
+    print(f"Cached logits for {len(image_ids)} images to {path}")
+    return load_logits(cache_dir, ckpt_hash)
@@ -0,0 +1,184 @@
+"""Structured channel pruning of the trained classifier to a FLOPs or latency budget.
+
+Removes the least important expanded channels of the MBConv blocks and
+output channels of ``conv_head`` (see backend/pruning.py), then fine-tunes
+the smaller network briefly with train.train_one_epoch. Unlike quantization
+this shrinks the dense architecture itself, so every request needs fewer
+FLOPs and less activation memory.
+
+Channel importance is |BN scale| x norm of the consuming weights. Scores are
+normalized per layer and one global threshold decides what is kept, so
+layers with many weak channels lose more of them; every layer keeps at least
+``--min_keep`` of its channels, rounded up to a multiple of ``--round_to``.
+The threshold is found by bisection against the budget:
+
+- ``--target_flops 0.5``: at most 50% of the original multiply-accumulates,
+- ``--target_latency_ms 400``: batch-1 latency on this machine's device.
+
+The output checkpoint (arch, kept channel counts and weights) is loaded by
+backend/app.py like a regular one, e.g. ``MODEL_PATH=model_pruned.pth``.
+
+Usage:
+    python prune_model.py --checkpoint model.pth --target_flops 0.5 \\
+        --train_csv combined_groundtruth.csv --train_dirs dirA dirB --finetune_epochs 2
+"""
+
+import argparse
+import copy
+import math
+import time
+
+import timm
+import torch
+import torch.nn as nn
+import torch.optim as optim
+from focal_loss.focal_loss import FocalLoss
+from torch.utils.data import DataLoader
+
+from backend.pruning import channel_importance, prunable_layers, prune_layer
+from batch_augment import BatchAugment
+from compare_models import measure_latency
+from train import NUM_CLASSES, build_datasets, evaluate, load_weights, seed_everything, train_one_epoch
+
+
+def count_macs(model, img_size):
+    """Multiply-accumulates of one forward pass at batch size 1 (convolutions and linear layers)."""
+    macs = []
+
+    def conv_hook(module, inputs, output):
+        k = module.kernel_size[0] * module.kernel_size[1]
+        macs.append(output.numel() * (module.in_channels // module.groups) * k)
+
+    def linear_hook(module, inputs, output):
+        macs.append(output.numel() * module.in_features)
+
+    handles = [m.register_forward_hook(conv_hook if isinstance(m, nn.Conv2d) else linear_hook)
+               for m in model.modules() if isinstance(m, (nn.Conv2d, nn.Linear))]
+    device = next(model.parameters()).device
+    with torch.inference_mode():
+        model(torch.zeros(1, 3, img_size, img_size, device=device))
+    for h in handles:
+        h.remove()
+    return sum(macs)
+
+
+def plan_channels(scores, fraction, min_keep, round_to):
+    """Indices to keep per layer when a global ``fraction`` of the normalized scores survives."""
+    normalized = {name: s / s.mean().clamp_min(1e-12) for name, s in scores.items()}
+    pooled = torch.cat(list(normalized.values()))
+    threshold = torch.quantile(pooled, 1 - fraction) if fraction < 1 else pooled.min()
+    plan = {}
+    for name, s in normalized.items():
+        width = len(s)
+        n = max(int((s >= threshold).sum()), math.ceil(min_keep * width))
+        n = min(width, round_to * math.ceil(n / round_to))
+        plan[name] = torch.topk(scores[name], n).indices.sort().values
+    return plan
+
+
+def pruned_copy(model, plan):
+    pruned = copy.deepcopy(model)
+    for name, keep in plan.items():
+        prune_layer(pruned, name, keep)
+    return pruned
+
+
+def search_plan(model, scores, cost_fn, budget, args, iterations=12):
+    """Bisection for the largest kept fraction whose pruned model costs at most ``budget``."""
+    lo, hi = 0.0, 1.0
+    best = plan_channels(scores, lo, args.min_keep, args.round_to)
+    for _ in range(iterations):
+        mid = (lo + hi) / 2
+        plan = plan_channels(scores, mid, args.min_keep, args.round_to)
+        if cost_fn(pruned_copy(model, plan)) <= budget:
+            lo, best = mid, plan
+        else:
+            hi = mid
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Prune MBConv and conv_head channels to a FLOPs or latency budget')
+    parser.add_argument('--checkpoint', type=str, default='model.pth', help='Trained weights to prune')
+    parser.add_argument('--arch', type=str, default='efficientnet_b5', help='timm model name of the checkpoint')
+    parser.add_argument('--img_size', type=int, default=456, help='Input resolution')
+    budget = parser.add_mutually_exclusive_group(required=True)
+    budget.add_argument('--target_flops', type=float, help='Fraction of the original MACs to keep, e.g. 0.5')
+    budget.add_argument('--target_latency_ms', type=float, help='Batch-1 latency budget on --device')
+    parser.add_argument('--min_keep', type=float, default=0.25, help='Minimum fraction of channels kept per layer')
+    parser.add_argument('--round_to', type=int, default=8, help='Kept channel counts are multiples of this')
+    parser.add_argument('--threads', type=int, default=None, help='torch intra-op threads for latency measurements')
+    parser.add_argument('--train_csv', type=str, required=True, help='Combined training ground truth CSV')
+    parser.add_argument('--train_dirs', type=str, nargs='+', required=True, help='Training image directories')
+    parser.add_argument('--groups_csv', type=str, default=None, help='Split groups, as given to train.py')
+    parser.add_argument('--finetune_epochs', type=int, default=1, help='Fine-tuning epochs after pruning')
+    parser.add_argument('--batch_size', type=int, default=32, help='Fine-tuning batch size')
+    parser.add_argument('--lr', type=float, default=2e-5, help='Fine-tuning learning rate')
+    parser.add_argument('--wd', type=float, default=0.00859853538142981, help='AdamW weight decay')
+    parser.add_argument('--gamma', type=float, default=2.41473018656194, help='Focal loss gamma')
+    parser.add_argument('--num_workers', type=int, default=8, help='DataLoader workers')
+    parser.add_argument('--seed', type=int, default=42, help='Split and fine-tuning seed, as given to train.py')
+    parser.add_argument('--device', type=str, default='auto', choices=['auto', 'cpu'], help='Force CPU')
+    parser.add_argument('--output', type=str, default='model_pruned.pth', help='Pruned checkpoint path')
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    seed_everything(args.seed)
+    device = torch.device('cuda' if torch.cuda.is_available() and args.device != 'cpu' else 'cpu')
+    model = timm.create_model(args.arch, pretrained=False, num_classes=NUM_CLASSES)
+    model.load_state_dict(load_weights(args.checkpoint))
+    model = model.to(device).eval()
+
+    layers = prunable_layers(model)
+    scores = {name: channel_importance(model, name) for name in layers}
+    base_macs = count_macs(model, args.img_size)
+    base_latency = measure_latency(model, args.img_size, device, warmup=3, runs=10).mean()
+
+    start = time.perf_counter()
+    if args.target_flops is not None:
+        plan = search_plan(model, scores, lambda m: count_macs(m, args.img_size),
+                           args.target_flops * base_macs, args)
+    else:
+        plan = search_plan(model, scores, lambda m: measure_latency(m, args.img_size, device, 3, 10).mean(),
+                           args.target_latency_ms, args, iterations=8)
+    search_time = time.perf_counter() - start
+    pruned = pruned_copy(model, plan)
+    macs = count_macs(pruned, args.img_size)
+    latency = measure_latency(pruned, args.img_size, device, warmup=3, runs=10).mean()
+
+    train_ds, val_ds = build_datasets(args)
+    train_loader = DataLoader(train_ds, batch_size=args.batch_size, shuffle=True, num_workers=args.num_workers)
+    val_loader = DataLoader(val_ds, batch_size=args.batch_size, shuffle=False, num_workers=args.num_workers)
+    criterion = FocalLoss(gamma=args.gamma, reduction='mean')
+    _, base_loss, base_f1 = evaluate(model, val_loader, criterion, device)
+    _, pruned_loss, pruned_f1 = evaluate(pruned, val_loader, criterion, device)
+    del model
+
+    optimizer = optim.AdamW(pruned.parameters(), lr=args.lr, weight_decay=args.wd)
+    scaler = torch.cuda.amp.GradScaler(enabled=device.type == 'cuda')
+    augment = BatchAugment()
+    for epoch in range(args.finetune_epochs):
+        print(f'\nFine-tuning epoch [{epoch+1}/{args.finetune_epochs}]')
+        train_one_epoch(pruned, train_loader, optimizer, criterion, scaler, device, augment=augment)
+    _, tuned_loss, tuned_f1 = evaluate(pruned, val_loader, criterion, device)
+
+    channels = {name: len(keep) for name, keep in plan.items()}
+    torch.save({'arch': args.arch, 'channels': channels,
+                'state_dict': {k: v.cpu() for k, v in pruned.state_dict().items()}}, args.output)
+
+    print("\n===== Channel Pruning Report =====")
+    print(f"Model: {args.arch} @ {args.img_size}x{args.img_size}, device: {device.type}, "
+          f"plan search {search_time:.1f}s")
+    print(f"Prunable channels kept: {sum(channels.values())} of {sum(len(s) for s in scores.values())} "
+          f"across {len(layers)} layers (conv_head {channels['conv_head']} of {len(scores['conv_head'])})")
+    print(f"MACs: {macs / 1e9:.2f} G of {base_macs / 1e9:.2f} G ({macs / base_macs:.0%})")
+    print(f"Batch-1 latency: {latency:.1f} ms vs {base_latency:.1f} ms (speedup {base_latency / latency:.2f}x)")
+    print(f"Validation loss / macro F1: original {base_loss:.4f} / {base_f1:.4f}, "
+          f"pruned {pruned_loss:.4f} / {pruned_f1:.4f}, fine-tuned {tuned_loss:.4f} / {tuned_f1:.4f}")
+    print(f"Saved to {args.output} (serve with MODEL_PATH={args.output})")
+    print("==================================")
+
+
+if __name__ == '__main__':
+    main()
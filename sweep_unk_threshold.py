@@ -0,0 +1,179 @@
+"""Sweep the UNK threshold and calibration temperature over cached logits.
+
+Serving and test evaluation both call a prediction UNK when
+``max(softmax(logits / T)) < threshold``. This tool evaluates that rule for a
+grid of thresholds and temperatures on logits cached by logit_cache.py, with
+no model in the loop, and writes accuracy / macro F1 / coverage curves plus
+a recommended serving configuration:
+
+- the temperature is the one with the lowest NLL on samples with a known
+  (non-UNK) label,
+- the threshold is the one with the best macro F1 at that temperature,
+  subject to ``--min_coverage``.
+
+Usage:
+    python sweep_unk_threshold.py --checkpoint best_efficientnet_model_lowest_loss.pth
+    python sweep_unk_threshold.py --hash <sha256> --cache_dir logit_cache --min_coverage 0.8
+"""
+
+import argparse
+import csv
+import json
+import os
+import time
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import numpy as np
+
+from logit_cache import checkpoint_hash, load_logits
+
+UNK_LABEL = 8
+
+
+def softmax(z):
+    z = z - z.max(axis=-1, keepdims=True)
+    e = np.exp(z)
+    return e / e.sum(axis=-1, keepdims=True)
+
+
+def nll(logits, labels, temperature, num_classes):
+    known = labels < num_classes
+    z = logits[known] / temperature
+    z = z - z.max(axis=-1, keepdims=True)
+    log_probs = z - np.log(np.exp(z).sum(axis=-1, keepdims=True))
+    return float(-log_probs[np.arange(known.sum()), labels[known]].mean())
+
+
+def sweep_thresholds(max_probs, argmax, labels, thresholds, unk_label=UNK_LABEL):
+    """Metrics for every threshold at once; returns a dict of (K,) arrays."""
+    size = max(int(argmax.max()) + 1, int(labels.max()) + 1, unk_label + 1)
+    k, n = len(thresholds), len(labels)
+
+    # (K, N) predictions for all thresholds, then one bincount into K confusion matrices
+    preds = np.where(max_probs[None, :] < thresholds[:, None], unk_label, argmax[None, :])
+    flat = np.arange(k)[:, None] * size * size + labels[None, :] * size + preds
+    cm = np.bincount(flat.ravel(), minlength=k * size * size).reshape(k, size, size).astype(np.float64)
+
+    tp = np.diagonal(cm, axis1=1, axis2=2)
+    support = cm.sum(axis=2)
+    predicted = cm.sum(axis=1)
+    denom = support + predicted
+    f1 = np.divide(2 * tp, denom, out=np.zeros_like(tp), where=denom > 0)
+    present = denom > 0
+    macro_f1 = (f1 * present).sum(axis=1) / np.maximum(present.sum(axis=1), 1)
+    weighted_f1 = (f1 * support).sum(axis=1) / n
+
+    covered = n - predicted[:, unk_label]
+    correct_known = tp.sum(axis=1) - tp[:, unk_label]
+    return {
+        'acc': 100. * tp.sum(axis=1) / n,
+        'macro_f1': macro_f1,
+        'weighted_f1': weighted_f1,
+        'coverage': covered / n,
+        # Accuracy on the samples the rule did answer
+        'selective_acc': 100. * np.divide(correct_known, covered, out=np.zeros_like(covered), where=covered > 0),
+    }
+
+
+def run_sweep(logits, labels, thresholds, temperatures, unk_label=UNK_LABEL):
+    num_classes = logits.shape[1]
+    # Temperature scaling never changes the argmax, only the confidence
+    argmax = logits.argmax(axis=1)
+    curves = {}
+    for t in temperatures:
+        max_probs = softmax(logits / t).max(axis=1)
+        curves[float(t)] = sweep_thresholds(max_probs, argmax, labels, thresholds, unk_label)
+        curves[float(t)]['nll'] = nll(logits, labels, t, num_classes)
+    return curves
+
+
+def recommend(curves, thresholds, min_coverage):
+    best_t = min(curves, key=lambda t: curves[t]['nll'])
+    c = curves[best_t]
+    ok = c['coverage'] >= min_coverage
+    if not ok.any():
+        ok = np.ones_like(ok)
+    i = int(np.argmax(np.where(ok, c['macro_f1'], -np.inf)))
+    return best_t, i
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Sweep UNK threshold / temperature over cached logits')
+    parser.add_argument('--checkpoint', type=str, default=None, help='Checkpoint whose cached logits to use')
+    parser.add_argument('--hash', type=str, default=None, help='Checkpoint SHA-256 (instead of --checkpoint)')
+    parser.add_argument('--cache_dir', type=str, default='logit_cache', help='Logit cache directory')
+    parser.add_argument('--num_thresholds', type=int, default=101, help='Thresholds evenly spaced in [0, 1]')
+    parser.add_argument('--temperatures', type=float, nargs='+',
+                        default=[0.5, 0.75, 1.0, 1.25, 1.5, 1.75, 2.0, 2.5, 3.0], help='Calibration temperatures')
+    parser.add_argument('--min_coverage', type=float, default=0.0, help='Minimum fraction of non-UNK answers')
+    parser.add_argument('--output', type=str, default='unk_sweep', help='Output directory for curves and plots')
+    args = parser.parse_args()
+
+    if not args.checkpoint and not args.hash:
+        parser.error('one of --checkpoint or --hash is required')
+    ckpt_hash = args.hash or checkpoint_hash(args.checkpoint)
+    cached = load_logits(args.cache_dir, ckpt_hash)
+    if cached is None:
+        raise SystemExit(f"No cached logits for checkpoint {ckpt_hash} in {args.cache_dir}")
+    image_ids, logits, labels = cached
+
+    thresholds = np.linspace(0.0, 1.0, args.num_thresholds)
+    start = time.perf_counter()
+    curves = run_sweep(logits.astype(np.float64), labels, thresholds, args.temperatures)
+    elapsed = time.perf_counter() - start
+
+    os.makedirs(args.output, exist_ok=True)
+    with open(os.path.join(args.output, 'curves.csv'), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['temperature', 'threshold', 'acc', 'macro_f1', 'weighted_f1', 'coverage', 'selective_acc'])
+        for t, c in curves.items():
+            for i, th in enumerate(thresholds):
+                writer.writerow([t, round(float(th), 6), c['acc'][i], c['macro_f1'][i], c['weighted_f1'][i],
+                                 c['coverage'][i], c['selective_acc'][i]])
+
+    best_t, i = recommend(curves, thresholds, args.min_coverage)
+    c = curves[best_t]
+    baseline = run_sweep(logits.astype(np.float64), labels, np.array([0.5]), [1.0])[1.0]
+    recommendation = {
+        'checkpoint_hash': ckpt_hash,
+        'num_images': int(len(image_ids)),
+        'temperature': best_t,
+        'threshold': round(float(thresholds[i]), 6),
+        'acc': float(c['acc'][i]),
+        'macro_f1': float(c['macro_f1'][i]),
+        'coverage': float(c['coverage'][i]),
+        'baseline': {'temperature': 1.0, 'threshold': 0.5,
+                     **{k: float(v[0]) for k, v in baseline.items() if k != 'nll'}},
+    }
+    with open(os.path.join(args.output, 'recommendation.json'), 'w') as f:
+        json.dump(recommendation, f, indent=2)
+
+    plt.figure(figsize=(15, 5))
+    for j, (key, label) in enumerate([('acc', 'Accuracy (%)'), ('macro_f1', 'Macro F1'), ('coverage', 'Coverage')]):
+        plt.subplot(1, 3, j + 1)
+        for t, curve in curves.items():
+            plt.plot(thresholds, curve[key], label=f'T={t}', linewidth=2 if t == best_t else 1)
+        plt.axvline(thresholds[i], color='gray', linestyle='--')
+        plt.xlabel('UNK threshold')
+        plt.ylabel(label)
+        plt.grid(True)
+    plt.legend()
+    plt.tight_layout()
+    plt.savefig(os.path.join(args.output, 'curves.png'))
+
+    print("\n===== UNK Threshold Sweep =====")
+    print(f"Images: {len(image_ids)}, grid: {len(args.temperatures)} temperatures x {len(thresholds)} thresholds")
+    print(f"Sweep time: {elapsed*1000:.1f}ms")
+    print(f"Baseline (T=1.0, threshold=0.5): acc {recommendation['baseline']['acc']:.2f}%, "
+          f"macro F1 {recommendation['baseline']['macro_f1']:.4f}, coverage {recommendation['baseline']['coverage']:.3f}")
+    print(f"Recommended (T={best_t}, threshold={recommendation['threshold']}): acc {recommendation['acc']:.2f}%, "
+          f"macro F1 {recommendation['macro_f1']:.4f}, coverage {recommendation['coverage']:.3f}")
+    print(f"Serve with: UNK_THRESHOLD={recommendation['threshold']} CALIBRATION_TEMPERATURE={best_t}")
+    print(f"Curves written to {args.output}/")
+    print("===============================")
+
+
+if __name__ == '__main__':
+    main()
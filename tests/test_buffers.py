@@ -0,0 +1,63 @@
+import numpy as np
+import torch
+
+from buffers import BufferPool
+
+
+def test_released_buffers_are_handed_out_again():
+    pool = BufferPool()
+    with pool.array((4, 4, 3)) as first:
+        pass
+    with pool.array((4, 4, 3)) as second:
+        assert second is first
+    with pool.tensor((1, 3, 8, 8)) as first_tensor:
+        pass
+    with pool.tensor((1, 3, 8, 8)) as second_tensor:
+        assert second_tensor is first_tensor
+    assert pool.stats()['hits'] == 2 and pool.stats()['misses'] == 2
+
+
+def test_buffers_are_keyed_by_shape_and_dtype():
+    pool = BufferPool()
+    with pool.array((4, 4)) as first:
+        pass
+    with pool.array((4, 4), dtype=np.float32) as other_dtype, pool.array((4, 5)) as other_shape:
+        assert other_dtype is not first and other_dtype.dtype == np.float32
+        assert other_shape is not first and other_shape.shape == (4, 5)
+
+
+def test_concurrent_borrowers_get_distinct_buffers():
+    pool = BufferPool()
+    with pool.array((2, 2)) as a, pool.array((2, 2)) as b:
+        assert a is not b
+    with pool.array((2, 2)) as c, pool.array((2, 2)) as d:
+        assert {id(c), id(d)} == {id(a), id(b)}
+
+
+def test_pool_keeps_at_most_max_per_shape():
+    pool = BufferPool(max_per_shape=2)
+    with pool.array((2,)), pool.array((2,)), pool.array((2,)):
+        pass
+    assert len(pool.free[('array', (2,), np.dtype(np.uint8).str)]) == 2
+
+
+def test_least_recently_used_shapes_are_dropped():
+    pool = BufferPool(max_shapes=2)
+    for shape in [(1,), (2,), (1,), (3,)]:
+        with pool.array(shape):
+            pass
+    assert [key[1] for key in pool.free] == [(1,), (3,)]
+    assert pool.stats()['shapes'] == 2
+    pool.clear()
+    assert pool.stats()['shapes'] == 0 and pool.stats()['pooled_mb'] == 0
+
+
+def test_tensor_allocated_under_inference_mode_stays_writable():
+    pool = BufferPool()
+    with torch.inference_mode():
+        with pool.tensor((2, 2)) as buffer:
+            buffer.fill_(1)
+    with pool.tensor((2, 2)) as reused:
+        assert reused is buffer
+        reused.copy_(torch.zeros(2, 2))
+        assert not reused.is_inference()
@@ -0,0 +1,36 @@
+import numpy as np
+from PIL import Image
+
+from dedup_images import clusters_from_pairs, hamming_pairs, phash
+
+
+def test_hamming_pairs_finds_pairs_within_the_distance():
+    hashes = np.array([0b0000, 0b0001, 0b0111, 0xF << 60, (0xF << 60) | 1 << 32], dtype=np.uint64)
+    pairs_i, pairs_j = hamming_pairs(hashes, max_distance=1, block=2)
+    assert sorted(zip(pairs_i.tolist(), pairs_j.tolist())) == [(0, 1), (3, 4)]
+    pairs_i, pairs_j = hamming_pairs(hashes, max_distance=2, block=2)
+    assert sorted(zip(pairs_i.tolist(), pairs_j.tolist())) == [(0, 1), (1, 2), (3, 4)]
+
+
+def test_clusters_are_transitive_and_rooted_at_the_smallest_index():
+    roots = clusters_from_pairs(6, np.array([4, 1, 2]), np.array([5, 2, 4]))
+    # 1-2, 2-4 and 4-5 chain into one cluster; 0 and 3 stay alone
+    assert roots.tolist() == [0, 1, 1, 3, 1, 1]
+
+
+def test_clusters_without_pairs_are_singletons():
+    empty = np.array([], dtype=np.int64)
+    assert clusters_from_pairs(3, empty, empty).tolist() == [0, 1, 2]
+
+
+def test_phash_matches_a_reencoded_copy_but_not_another_image(tmp_path):
+    rng = np.random.default_rng(0)
+    # Smooth random patterns, so the low DCT frequencies carry the content
+    a, b = (Image.fromarray(rng.integers(0, 256, (8, 8, 3), dtype=np.uint8)).resize((256, 256), Image.BICUBIC)
+            for _ in range(2))
+    a.save(tmp_path / 'a.png')
+    a.resize((180, 180)).save(tmp_path / 'a_small.jpg', quality=70)
+    b.save(tmp_path / 'b.png')
+    hashes = np.array([phash(tmp_path / name) for name in ('a.png', 'a_small.jpg', 'b.png')], dtype=np.uint64)
+    pairs_i, pairs_j = hamming_pairs(hashes, max_distance=6)
+    assert list(zip(pairs_i.tolist(), pairs_j.tolist())) == [(0, 1)]
@@ -0,0 +1,106 @@
+import importlib
+import io
+import os
+import sys
+from types import SimpleNamespace
+
+import brotli
+import numpy as np
+import pytest
+import timm
+import torch
+from PIL import Image
+
+from embeddings import EmbeddingIndex
+
+
+@pytest.fixture(scope='module')
+def app_module(tmp_path_factory):
+    tmp = tmp_path_factory.mktemp('serving')
+    torch.manual_seed(0)
+    torch.save(timm.create_model('efficientnet_b0', pretrained=False, num_classes=8).state_dict(),
+               tmp / 'model.pth')
+    EmbeddingIndex(1280).save(str(tmp / 'reference.npz'))
+    env = {'MODEL_PATH': str(tmp / 'model.pth'), 'MODEL_ARCH': 'efficientnet_b0', 'MODEL_INPUT_SIZE': '64',
+           'SERVE_RESOLUTIONS': '64', 'WARMUP_RUNS': '0', 'PREPROCESS_WORKERS': '0',
+           'THREAD_CONFIG_PATH': str(tmp / 'missing.json'), 'REFERENCE_INDEX_PATH': str(tmp / 'reference.npz')}
+    with pytest.MonkeyPatch.context() as mp:
+        for key, value in env.items():
+            mp.setenv(key, value)
+        mp.chdir(tmp)
+        sys.modules.pop('app', None)
+        module = importlib.import_module('app')
+        yield module
+        sys.modules.pop('app', None)
+
+
+@pytest.fixture
+def client(app_module):
+    return app_module.app.test_client()
+
+
+def image_bytes():
+    rng = np.random.default_rng(0)
+    buffer = io.BytesIO()
+    Image.fromarray(rng.integers(0, 256, (96, 128, 3), dtype=np.uint8)).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def post(client, form=None, **kwargs):
+    data = {'file': (io.BytesIO(image_bytes()), 'lesion.png')}
+    data.update(form or {})
+    return client.post('/predict', data=data, content_type='multipart/form-data', **kwargs)
+
+
+def test_repeat_request_with_the_etag_is_not_modified(client):
+    first = post(client)
+    assert first.status_code == 200
+    etag, weak = first.get_etag()
+    assert etag and weak
+    repeat = post(client, headers={'If-None-Match': f'W/"{etag}"'})
+    assert repeat.status_code == 304 and repeat.get_etag() == (etag, True)
+    other_options = post(client, form={'tta': '2'}, headers={'If-None-Match': f'W/"{etag}"'})
+    assert other_options.status_code == 200 and other_options.get_etag()[0] != etag
+
+
+def test_etag_covers_model_version_and_reference_index(app_module):
+    serving = SimpleNamespace(version='v1', reference_index_stamp=['reference.npz', 10, 1.0])
+    base = app_module.prediction_etag(b'image', serving, [1])
+    assert app_module.prediction_etag(b'image', serving, [1]) == base
+    assert app_module.prediction_etag(b'image', SimpleNamespace(
+        version='v2', reference_index_stamp=serving.reference_index_stamp), [1]) != base
+    assert app_module.prediction_etag(b'image', SimpleNamespace(
+        version='v1', reference_index_stamp=['reference.npz', 10, 2.0]), [1]) != base
+    assert app_module.prediction_etag(b'other', serving, [1]) != base
+    assert app_module.prediction_etag(b'image', serving, [2]) != base
+
+
+def test_rebuilt_reference_index_changes_its_stamp(app_module):
+    path = os.environ['REFERENCE_INDEX_PATH']
+    stamp = app_module.file_stamp(path)
+    assert app_module.active.reference_index_stamp == stamp
+    os.utime(path, (stamp[2] + 10, stamp[2] + 10))
+    assert app_module.file_stamp(path) != stamp
+
+
+def test_visits_are_never_cached(client):
+    response = post(client, form={'lesion_id': 'patient-1'})
+    assert response.status_code == 200 and response.get_json()['lesion_id'] == 'patient-1'
+    assert response.get_etag() == (None, None)
+
+
+def test_failed_gradcam_gets_no_etag(app_module, client, monkeypatch):
+    def fail(*args, **kwargs):
+        raise RuntimeError('out of memory')
+    monkeypatch.setattr(app_module, 'generate_gradcams', fail)
+    response = post(client, form={'tta': '3'})
+    assert response.status_code == 200 and 'gradcam' not in response.get_json()
+    assert response.get_etag() == (None, None)
+
+
+def test_large_responses_are_compressed(client):
+    plain = post(client)
+    compressed = post(client, headers={'Accept-Encoding': 'br'})
+    assert compressed.headers['Content-Encoding'] == 'br'
+    assert 'Accept-Encoding' in compressed.headers['Vary']
+    assert brotli.decompress(compressed.get_data()) == plain.get_data()
@@ -0,0 +1,62 @@
+import pytest
+
+import memory
+from memory import MemoryGovernor
+
+BUDGET = 1000
+
+
+@pytest.fixture
+def rss(monkeypatch):
+    current = {'bytes': 0}
+    monkeypatch.setattr(memory, 'process_rss', lambda: current['bytes'])
+
+    def set_rss(value):
+        current['bytes'] = value
+    return set_rss
+
+
+def test_level_rises_with_the_thresholds_and_calls_on_pressure(rss):
+    pressure = []
+    governor = MemoryGovernor(BUDGET, on_pressure=pressure.append)
+    rss(500)
+    assert governor.update() == 0
+    rss(800)
+    assert governor.update() == 1 and governor.mode == 'reduced'
+    rss(950)
+    assert governor.update() == 2 and governor.mode == 'critical'
+    assert pressure == [1, 2]
+    assert governor.forced_gc == 2
+
+
+def test_level_can_jump_straight_to_critical(rss):
+    pressure = []
+    governor = MemoryGovernor(BUDGET, on_pressure=pressure.append)
+    rss(990)
+    assert governor.update() == 2
+    assert pressure == [2]
+
+
+def test_level_comes_down_one_step_at_a_time_past_the_hysteresis(rss):
+    governor = MemoryGovernor(BUDGET, thresholds=(0.75, 0.9), hysteresis=0.05)
+    rss(950)
+    governor.update()
+    # Below the critical threshold but within the hysteresis band: stays
+    rss(870)
+    assert governor.update() == 2
+    rss(100)
+    assert governor.update() == 1
+    assert governor.update() == 0
+    stats = governor.stats()
+    assert stats['entered'] == {'normal': 1, 'reduced': 1, 'critical': 1}
+    assert [change['to'] for change in stats['recent_changes']] == ['critical', 'reduced', 'normal']
+    assert stats['peak_rss_mb'] == round(950 / 2**20, 1)
+
+
+def test_no_budget_disables_the_governor(rss):
+    pressure = []
+    governor = MemoryGovernor(0, on_pressure=pressure.append)
+    rss(10**12)
+    assert governor.update() == 0
+    assert not governor.enabled and governor.stats()['budget_mb'] is None
+    assert pressure == []
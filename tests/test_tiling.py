@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+
+from tiling import stitch, tile_grid
+
+
+def coverage(boxes, width, height):
+    covered = np.zeros((height, width), bool)
+    for left, upper, right, lower in boxes:
+        covered[upper:lower, left:right] = True
+    return covered
+
+
+@pytest.mark.parametrize('width, height', [(6000, 4000), (1024, 768), (3000, 300), (380, 2000)])
+def test_grid_stays_in_bounds_and_under_the_tile_budget(width, height):
+    boxes, (columns, rows), tile_px = tile_grid(width, height, tile_size=380, overlap=0.25, max_tiles=12)
+    assert len(boxes) == columns * rows <= 12
+    assert tile_px >= min(380, width, height)
+    for left, upper, right, lower in boxes:
+        assert 0 <= left and 0 <= upper and right <= width and lower <= height
+        assert right - left == lower - upper == tile_px
+
+
+@pytest.mark.parametrize('width, height', [(6000, 4000), (1024, 768), (800, 800)])
+def test_grid_covers_the_whole_image(width, height):
+    boxes, _, _ = tile_grid(width, height, tile_size=380, overlap=0.25, max_tiles=16)
+    assert coverage(boxes, width, height).all()
+
+
+def test_small_image_is_a_single_tile():
+    boxes, grid, tile_px = tile_grid(200, 200, tile_size=380, overlap=0.25, max_tiles=16)
+    assert boxes == [(0, 0, 200, 200)] and grid == (1, 1) and tile_px == 200
+
+
+def test_tiles_shrink_to_the_short_side():
+    boxes, grid, tile_px = tile_grid(300, 200, tile_size=380, overlap=0.25, max_tiles=16)
+    assert tile_px == 200 and grid == (2, 1)
+    assert boxes == [(0, 0, 200, 200), (100, 0, 300, 200)]
+
+
+def test_stitch_of_constant_maps_is_constant():
+    boxes, _, tile_px = tile_grid(1000, 700, tile_size=300, overlap=0.25, max_tiles=16)
+    maps = np.full((len(boxes), 10, 10), 0.5, np.float32)
+    merged = stitch(maps, boxes, 1000, 700, tile_px)
+    assert merged.shape == (round(700 * 10 / tile_px), round(1000 * 10 / tile_px))
+    np.testing.assert_allclose(merged, 0.5, atol=1e-6)
+
+
+def test_stitch_averages_where_tiles_overlap():
+    boxes = [(0, 0, 100, 100), (50, 0, 150, 100)]
+    maps = np.stack([np.zeros((10, 10), np.float32), np.ones((10, 10), np.float32)])
+    merged = stitch(maps, boxes, 150, 100, 100)
+    assert merged.shape == (10, 15)
+    np.testing.assert_allclose(merged[:, :5], 0)
+    np.testing.assert_allclose(merged[:, 5:10], 0.5)
+    np.testing.assert_allclose(merged[:, 10:], 1)
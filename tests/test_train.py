@@ -0,0 +1,50 @@
+import torch
+from torch import nn
+
+from train import train_one_epoch
+
+
+class RecordingSGD(torch.optim.SGD):
+    """SGD that keeps a copy of the gradient at every step."""
+
+    def __init__(self, params, lr):
+        super().__init__(params, lr=lr)
+        self.grads = []
+
+    def step(self, closure=None):
+        self.grads.append([p.grad.clone() for group in self.param_groups for p in group['params']])
+        return super().step(closure)
+
+
+def nll(probs, targets):
+    return nn.functional.nll_loss(probs.log(), targets)
+
+
+def gradients(model, batches):
+    """Gradient of the mean loss over `batches` at the model's current weights."""
+    model.zero_grad()
+    for inputs, targets in batches:
+        (nll(torch.softmax(model(inputs), dim=1), targets) / len(batches)).backward()
+    return [p.grad.clone() for p in model.parameters()]
+
+
+def test_accumulation_averages_each_group_over_its_own_micro_batches():
+    torch.manual_seed(0)
+    batches = [(torch.randn(4, 6), torch.randint(0, 3, (4,))) for _ in range(5)]
+    model = nn.Linear(6, 3)
+    # lr 0: the weights stay put, so every group's gradient is taken at the same point
+    optimizer = RecordingSGD(model.parameters(), lr=0.0)
+    reference = nn.Linear(6, 3)
+    reference.load_state_dict(model.state_dict())
+    scaler = torch.amp.GradScaler('cuda', enabled=False)
+
+    train_one_epoch(model, batches, optimizer, nll, scaler, torch.device('cpu'), show_progress=False,
+                    accum_steps=2)
+
+    # Groups of 2, 2 and a trailing 1
+    expected = [gradients(reference, batches[0:2]), gradients(reference, batches[2:4]),
+                gradients(reference, batches[4:5])]
+    assert len(optimizer.grads) == 3
+    for got, want in zip(optimizer.grads, expected):
+        for g, w in zip(got, want):
+            torch.testing.assert_close(g, w)
@@ -0,0 +1,478 @@
+"""Training script for the skin lesion classifier, runnable under torch.distributed.
+
+Same model, focal loss, optimizer and augmentation policy as
+efficientnet_b5_train_combined_dataset.py, as a standalone script:
+
+    # single process
+    python train.py --train_csv combined_groundtruth.csv --train_dirs dirA dirB
+
+    # 4 CPU processes with the gloo backend on one machine
+    torchrun --nproc_per_node=4 train.py --backend gloo --device cpu ...
+
+    # all GPUs of a machine (nccl), or several machines
+    torchrun --nnodes=2 --nproc_per_node=8 --rdzv_backend=c10d --rdzv_endpoint=host:29500 train.py ...
+
+Every rank trains on its own DistributedSampler shard and
+DistributedDataParallel all-reduces the gradients. Train and validation
+metrics are reduced across ranks, and only rank 0 logs and writes
+checkpoints.
+
+Memory-saving mode: ``--grad_checkpointing`` recomputes the EfficientNet
+block activations during backward instead of storing them, and
+``--effective_batch_size`` (or ``--accum_steps``) accumulates gradients over
+several micro-batches of ``--batch_size``. bench_memory.py reports the peak
+memory of each combination.
+
+Rank 0 also writes a full resumable checkpoint (``<checkpoint_dir>/last.pt``)
+every ``--save_every_steps`` optimizer steps, at the end of every epoch and
+on SIGTERM, from a background thread. A restarted run resumes from it
+automatically, mid-epoch included.
+
+Distillation mode: ``--teacher_checkpoint`` trains ``--model`` (e.g.
+efficientnet_b0 at ``--img_size 224``) against the soft targets of a trained
+teacher (EfficientNet-B5 at 456 by default) as well as the labels. The
+teacher's logits are computed once per training image, on the un-augmented
+validation view, and cached on disk with logit_cache.py, so the teacher is
+never run during training. compare_models.py reports the student's accuracy
+and latency against the teacher.
+"""
+
+import argparse
+import contextlib
+import math
+import os
+import random
+import signal
+
+import numpy as np
+import timm
+import torch
+import torch.distributed as dist
+import torch.nn.functional as F
+import torch.optim as optim
+from focal_loss.focal_loss import FocalLoss
+from torch.nn.parallel import DistributedDataParallel as DDP
+from torch.utils.data import DataLoader, Dataset, Sampler
+from torch.utils.data.distributed import DistributedSampler
+from tqdm import tqdm
+
+from batch_augment import BatchAugment, decode_transform
+from checkpointing import AsyncCheckpointer, load_checkpoint, snapshot
+from eval_engine import run_evaluation
+from isic_data import ISICDataset, build_val_transform, load_ground_truth, load_group_ids, split_train_val
+from logit_cache import cache_logits, checkpoint_hash, load_logits
+
+NUM_CLASSES = 8
+
+
+class ShardSampler(Sampler):
+    """Strided shard of a dataset for evaluation.
+
+    Unlike DistributedSampler it does not pad the shards to equal length, so
+    no sample is counted twice in the reduced validation metrics.
+    """
+
+    def __init__(self, dataset, rank, world_size):
+        self.indices = list(range(rank, len(dataset), world_size))
+
+    def __iter__(self):
+        return iter(self.indices)
+
+    def __len__(self):
+        return len(self.indices)
+
+
+class ResumableSampler(DistributedSampler):
+    """DistributedSampler that can start an epoch part-way through.
+
+    The order only depends on the seed and epoch, so after a restart the
+    first ``skip_batches`` batches of the resumed epoch are skipped exactly.
+    Also used for single-process runs (one replica).
+    """
+
+    def __init__(self, dataset, batch_size, **kwargs):
+        super().__init__(dataset, **kwargs)
+        self.batch_size = batch_size
+        self.skip_batches = 0
+
+    def __iter__(self):
+        indices = list(super().__iter__())
+        return iter(indices[self.skip_batches * self.batch_size:])
+
+    def __len__(self):
+        return max(self.num_samples - self.skip_batches * self.batch_size, 0)
+
+
+class DistillDataset(Dataset):
+    """Adds each sample's cached teacher logits as a third item."""
+
+    def __init__(self, dataset, teacher_logits):
+        self.dataset = dataset
+        self.teacher_logits = torch.as_tensor(teacher_logits, dtype=torch.float32)
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        image, label = self.dataset[idx]
+        return image, label, self.teacher_logits[idx]
+
+
+def setup_distributed(backend=None):
+    """Initializes the process group when launched by torchrun.
+
+    Returns ``(rank, world_size, local_rank)``; a plain ``python train.py`` run
+    is rank 0 of a world of size 1 and does not touch torch.distributed.
+    """
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    rank = int(os.environ.get('RANK', 0))
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    if world_size > 1:
+        if backend is None:
+            backend = 'nccl' if torch.cuda.is_available() else 'gloo'
+        dist.init_process_group(backend=backend)
+    return rank, world_size, local_rank
+
+
+def get_device(requested, local_rank):
+    if requested == 'cpu' or not torch.cuda.is_available():
+        return torch.device('cpu')
+    torch.cuda.set_device(local_rank)
+    return torch.device('cuda', local_rank)
+
+
+def unwrap(model):
+    return model.module if isinstance(model, DDP) else model
+
+
+def to_cpu_state_dict(model):
+    return {k: v.detach().to('cpu', copy=True) for k, v in unwrap(model).state_dict().items()}
+
+
+def load_weights(path):
+    """State dict from a weights file, without any DataParallel/DDP 'module.' prefix."""
+    state_dict = torch.load(path, map_location='cpu')
+    if next(iter(state_dict)).startswith('module.'):
+        state_dict = {k[7:]: v for k, v in state_dict.items()}
+    return state_dict
+
+
+def seed_everything(seed):
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    torch.cuda.manual_seed_all(seed)
+
+
+def distillation_loss(student_logits, teacher_logits, temperature):
+    """KL divergence between temperature-softened teacher and student distributions.
+
+    Scaled by ``temperature**2`` so its gradients keep the same magnitude as
+    the hard-label loss when the temperature changes (Hinton et al.).
+    """
+    log_student = F.log_softmax(student_logits.float() / temperature, dim=1)
+    log_teacher = F.log_softmax(teacher_logits.float() / temperature, dim=1)
+    return F.kl_div(log_student, log_teacher, reduction='batchmean', log_target=True) * temperature ** 2
+
+
+# === Train Function ===
+def train_one_epoch(model, dataloader, optimizer, criterion, scaler, device, augment=None,
+                    distributed=False, show_progress=True, on_step=None, accum_steps=1,
+                    distill_alpha=0.5, distill_temperature=4.0):
+    """One pass over ``dataloader``; returns (accuracy %, average loss) over all ranks.
+
+    Gradients are accumulated over ``accum_steps`` micro-batches per optimizer
+    step; under DDP the all-reduce only runs on the last micro-batch of each
+    step. A shorter trailing group at the end of the epoch is still stepped.
+    ``on_step()`` is called after every optimizer step (used for mid-epoch
+    checkpoints).
+
+    Batches with a third item (teacher logits, from DistillDataset) are
+    trained on ``(1 - distill_alpha) * criterion + distill_alpha * distillation_loss``.
+    """
+    model.train()
+    total_loss = torch.zeros((), device=device)
+    correct = torch.zeros((), device=device)
+    total = torch.zeros((), device=device)
+    num_batches = len(dataloader)
+    optimizer.zero_grad(set_to_none=True)
+
+    for i, batch in enumerate(tqdm(dataloader, disable=not show_progress)):
+        inputs, targets = batch[0].to(device, non_blocking=True), batch[1].to(device, non_blocking=True)
+        teacher_logits = batch[2].to(device, non_blocking=True) if len(batch) > 2 else None
+        if augment is not None and inputs.dtype == torch.uint8:
+            inputs = augment(inputs)
+        step_now = (i + 1) % accum_steps == 0 or i == num_batches - 1
+        # A shorter trailing group is averaged over its own micro-batches
+        group_start = i - i % accum_steps
+        group_size = min(accum_steps, num_batches - group_start)
+
+        # Skip the gradient all-reduce on micro-batches that don't end a step
+        sync = contextlib.nullcontext() if step_now or not isinstance(model, DDP) else model.no_sync()
+        with sync:
+            with torch.autocast(device_type=device.type, enabled=scaler.is_enabled()):
+                logits = model(inputs)
+                outputs = torch.softmax(logits, dim=1)
+                loss = criterion(outputs, targets)
+                if teacher_logits is not None:
+                    loss = ((1 - distill_alpha) * loss
+                            + distill_alpha * distillation_loss(logits, teacher_logits, distill_temperature))
+            scaler.scale(loss / group_size).backward()
+
+        if step_now:
+            scaler.step(optimizer)
+            scaler.update()
+            optimizer.zero_grad(set_to_none=True)
+            if on_step is not None:
+                on_step()
+
+        # Accumulate on device; no per-step .item() sync
+        total_loss += loss.detach() * targets.size(0)
+        correct += outputs.detach().argmax(1).eq(targets).sum()
+        total += targets.size(0)
+
+    stats = torch.stack([total_loss, correct, total])
+    if distributed:
+        dist.all_reduce(stats)
+    total_loss, correct, total = stats.tolist()
+    return 100. * correct / total, total_loss / total
+
+
+# === Evaluate Function ===
+def evaluate(model, dataloader, criterion, device, distributed=False):
+    """Returns (accuracy %, average loss, macro F1) over all ranks' shards."""
+    # Evaluate the bare module: DDP's forward broadcasts buffers, a collective that
+    # would deadlock when the unpadded shards have different numbers of batches.
+    result = run_evaluation(unwrap(model), dataloader, device, criterion=criterion,
+                            num_classes=NUM_CLASSES, distributed=distributed)
+    return result['acc'], result['loss'], result['macro_f1']
+
+
+def build_datasets(args):
+    train_gt = load_ground_truth(args.train_csv)
+    # Near-duplicate clusters from dedup_images.py stay on one side of the split
+    groups = load_group_ids(args.groups_csv, train_gt) if args.groups_csv else None
+    train_df, val_df = split_train_val(train_gt, seed=args.seed, groups=groups)
+    train_ds = ISICDataset(train_df, args.train_dirs, decode_transform(args.img_size))
+    val_ds = ISICDataset(val_df, args.train_dirs, build_val_transform(args.img_size))
+    return train_ds, val_ds
+
+
+def load_teacher_logits(args, train_ds, device, is_main, distributed):
+    """Teacher logits for every training image, in dataset order.
+
+    Rank 0 runs the teacher over the images it has no cached logits for yet;
+    the other ranks wait and read the cache file.
+    """
+    image_ids = train_ds.df['image'].tolist()
+    if is_main:
+        teacher = timm.create_model(args.teacher_model, pretrained=False, num_classes=NUM_CLASSES)
+        teacher.load_state_dict(load_weights(args.teacher_checkpoint))
+        teacher = teacher.to(device)
+        teacher_ds = ISICDataset(train_ds.df, args.train_dirs, build_val_transform(args.teacher_img_size))
+        loader = DataLoader(teacher_ds, batch_size=args.batch_size, shuffle=False, num_workers=args.num_workers)
+        cache_logits(teacher, loader, device, args.teacher_checkpoint, image_ids, cache_dir=args.teacher_cache_dir,
+                     num_classes=NUM_CLASSES)
+        del teacher
+        if device.type == 'cuda':
+            torch.cuda.empty_cache()
+    if distributed:
+        dist.barrier()
+    cached_ids, logits, _ = load_logits(args.teacher_cache_dir, checkpoint_hash(args.teacher_checkpoint))
+    row = {image_id: i for i, image_id in enumerate(cached_ids.tolist())}
+    return logits[[row[image_id] for image_id in image_ids]]
+
+
+def build_loaders(args, train_ds, val_ds, rank, world_size):
+    distributed = world_size > 1
+    # Seeded per epoch even on one process, so a mid-epoch resume sees the same order
+    train_sampler = ResumableSampler(train_ds, args.batch_size, num_replicas=world_size, rank=rank,
+                                     shuffle=True, seed=args.seed, drop_last=distributed)
+    val_sampler = ShardSampler(val_ds, rank, world_size) if distributed else None
+    pin = torch.cuda.is_available() and args.device != 'cpu'
+    train_loader = DataLoader(train_ds, batch_size=args.batch_size, sampler=train_sampler,
+                              num_workers=args.num_workers, pin_memory=pin, drop_last=distributed)
+    val_loader = DataLoader(val_ds, batch_size=args.batch_size, shuffle=False, sampler=val_sampler,
+                            num_workers=args.num_workers, pin_memory=pin)
+    return train_loader, val_loader, train_sampler
+
+
+def resolve_accum_steps(args, world_size):
+    """Micro-batches per optimizer step, from --effective_batch_size if given."""
+    if args.effective_batch_size:
+        return max(1, math.ceil(args.effective_batch_size / (args.batch_size * world_size)))
+    return args.accum_steps
+
+
+def build_model(args, device, distributed, local_rank):
+    model = timm.create_model(args.model, pretrained=args.pretrained, num_classes=NUM_CLASSES)
+    if args.grad_checkpointing:
+        # timm checkpoints each stage of blocks; activations are recomputed in backward
+        model.set_grad_checkpointing(True)
+    model = model.to(device)
+    if distributed:
+        # Parameters are broadcast from rank 0 here, so all ranks start identical
+        model = DDP(model, device_ids=[local_rank] if device.type == 'cuda' else None)
+    return model
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Train the skin lesion classifier (optionally distributed)')
+    parser.add_argument('--train_csv', type=str, required=True, help='Combined training ground truth CSV')
+    parser.add_argument('--train_dirs', type=str, nargs='+', required=True, help='Training image directories')
+    parser.add_argument('--groups_csv', type=str, default=None,
+                        help='Split group ids (groups.csv from dedup_images.py); default: one group per image')
+    parser.add_argument('--model', type=str, default='efficientnet_b5', help='timm model name')
+    parser.add_argument('--pretrained', action=argparse.BooleanOptionalAction, default=True,
+                        help='Start from ImageNet weights')
+    parser.add_argument('--img_size', type=int, default=456, help='Input resolution')
+    parser.add_argument('--batch_size', type=int, default=32, help='Per-process (micro-)batch size')
+    parser.add_argument('--accum_steps', type=int, default=1, help='Micro-batches per optimizer step')
+    parser.add_argument('--effective_batch_size', type=int, default=None,
+                        help='Target batch size per optimizer step across all processes (sets --accum_steps)')
+    parser.add_argument('--grad_checkpointing', action='store_true',
+                        help='Recompute block activations in backward to save memory')
+    parser.add_argument('--epochs', type=int, default=15, help='Number of epochs')
+    parser.add_argument('--lr', type=float, default=0.0000839850015566498, help='AdamW learning rate')
+    parser.add_argument('--wd', type=float, default=0.00859853538142981, help='AdamW weight decay')
+    parser.add_argument('--gamma', type=float, default=2.41473018656194, help='Focal loss gamma')
+    parser.add_argument('--num_workers', type=int, default=8, help='DataLoader workers per process')
+    parser.add_argument('--seed', type=int, default=42, help='Random seed')
+    parser.add_argument('--backend', type=str, default=None, choices=['nccl', 'gloo'],
+                        help='torch.distributed backend (default: nccl with CUDA, else gloo)')
+    parser.add_argument('--device', type=str, default='auto', choices=['auto', 'cpu'], help='Force CPU training')
+    parser.add_argument('--output', type=str, default='best_efficientnet_model_lowest_loss.pth',
+                        help='Where rank 0 saves the best (lowest validation loss) weights')
+    parser.add_argument('--checkpoint_dir', type=str, default='checkpoints', help='Resumable checkpoint directory')
+    parser.add_argument('--save_every_steps', type=int, default=500,
+                        help='Mid-epoch checkpoint interval in optimizer steps (0 = end of epoch only)')
+    parser.add_argument('--resume', action=argparse.BooleanOptionalAction, default=True,
+                        help='Resume from <checkpoint_dir>/last.pt if it exists')
+    parser.add_argument('--teacher_checkpoint', type=str, default=None,
+                        help='Trained teacher weights; enables distillation of --model from the teacher')
+    parser.add_argument('--teacher_model', type=str, default='efficientnet_b5', help='Teacher timm model name')
+    parser.add_argument('--teacher_img_size', type=int, default=456, help='Teacher input resolution')
+    parser.add_argument('--teacher_cache_dir', type=str, default='logit_cache', help='Teacher logit cache directory')
+    parser.add_argument('--distill_alpha', type=float, default=0.5,
+                        help='Weight of the distillation term (1 - alpha goes to the focal loss)')
+    parser.add_argument('--distill_temperature', type=float, default=4.0, help='Softmax temperature for distillation')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    rank, world_size, local_rank = setup_distributed(args.backend)
+    distributed = world_size > 1
+    is_main = rank == 0
+    device = get_device(args.device, local_rank)
+    # Different augmentation streams per rank; DDP syncs the initial weights anyway
+    seed_everything(args.seed + rank)
+
+    train_ds, val_ds = build_datasets(args)
+    if args.teacher_checkpoint:
+        train_ds = DistillDataset(train_ds, load_teacher_logits(args, train_ds, device, is_main, distributed))
+    train_loader, val_loader, train_sampler = build_loaders(args, train_ds, val_ds, rank, world_size)
+    model = build_model(args, device, distributed, local_rank)
+    accum_steps = resolve_accum_steps(args, world_size)
+
+    criterion = FocalLoss(gamma=args.gamma, reduction='mean')
+    optimizer = optim.AdamW(model.parameters(), lr=args.lr, weight_decay=args.wd)
+    scaler = torch.cuda.amp.GradScaler(enabled=device.type == 'cuda')
+    augment = BatchAugment()
+
+    last_path = os.path.join(args.checkpoint_dir, 'last.pt')
+    start_epoch, start_step, best_val_loss = 0, 0, float('inf')
+    if args.resume and os.path.exists(last_path):
+        # Every rank loads the same state; only rank 0's RNG streams are restored
+        state = load_checkpoint(last_path, unwrap(model), optimizer, scaler, restore_rng=rank == 0)
+        start_epoch, start_step, best_val_loss = state['epoch'], state['step'], state['best_val_loss']
+        if rank != 0:
+            seed_everything(args.seed + rank + 1000 * start_epoch + start_step)
+        if is_main:
+            print(f"Resumed from {last_path}: epoch {start_epoch+1}, step {start_step}")
+
+    checkpointer = AsyncCheckpointer() if is_main else None
+    if is_main:
+        os.makedirs(args.checkpoint_dir, exist_ok=True)
+        print(f"Training {args.model} on {world_size} process(es), device {device.type}, "
+              f"{len(train_ds)} train / {len(val_ds)} val images")
+        print(f"Effective batch size {args.batch_size * world_size * accum_steps} "
+              f"({args.batch_size} x {world_size} process(es) x {accum_steps} accumulation steps), "
+              f"gradient checkpointing {'on' if args.grad_checkpointing else 'off'}")
+        if args.teacher_checkpoint:
+            print(f"Distilling from {args.teacher_model} @ {args.teacher_img_size} ({args.teacher_checkpoint}), "
+                  f"alpha {args.distill_alpha}, temperature {args.distill_temperature}")
+
+    # SIGTERM (preemption) asks for a checkpoint at the next step boundary, then exit
+    preempted = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: preempted.append(signum))
+
+    position = {'epoch': start_epoch, 'step': start_step}
+
+    def on_step():
+        position['step'] += 1
+        stop = bool(preempted)
+        if distributed:
+            # Ranks may get the signal at different steps: all stop at the first step any of them
+            # has it, or the others would block in the next gradient all-reduce
+            flag = torch.tensor(int(stop), device=device)
+            dist.all_reduce(flag, op=dist.ReduceOp.MAX)
+            stop = bool(flag.item())
+        due = args.save_every_steps and position['step'] % args.save_every_steps == 0
+        if is_main and (due or stop):
+            checkpointer.save(snapshot(unwrap(model), optimizer, scaler, position['epoch'], position['step'],
+                                       best_val_loss), last_path)
+        if stop:
+            if is_main:
+                checkpointer.close()
+                print(f"Preempted: checkpoint written at epoch {position['epoch']+1}, step {position['step']}")
+            if distributed:
+                # Exit together, once the checkpoint is on disk
+                dist.barrier()
+                dist.destroy_process_group()
+            raise SystemExit(0)
+
+    for epoch in range(start_epoch, args.epochs):
+        position['epoch'] = epoch
+        position['step'] = start_step if epoch == start_epoch else 0
+        train_sampler.set_epoch(epoch)
+        train_sampler.skip_batches = position['step'] * accum_steps
+        if is_main:
+            print(f'\nEpoch [{epoch+1}/{args.epochs}]')
+        train_acc, train_loss = train_one_epoch(model, train_loader, optimizer, criterion, scaler, device,
+                                                augment=augment, distributed=distributed, show_progress=is_main,
+                                                on_step=on_step, accum_steps=accum_steps,
+                                                distill_alpha=args.distill_alpha,
+                                                distill_temperature=args.distill_temperature)
+        val_acc, val_loss, val_f1 = evaluate(model, val_loader, criterion, device, distributed=distributed)
+
+        if is_main:
+            print(f'Train Accuracy      : {train_acc:.2f}%')
+            print(f'Validation Accuracy : {val_acc:.2f}%')
+            print(f'Train Loss          : {train_loss:.4f}')
+            print(f'Validation Loss     : {val_loss:.4f}')
+            print(f'Validation Macro F1 : {val_f1:.4f}')
+            if device.type == 'cuda':
+                print(f'Peak GPU Memory     : {torch.cuda.max_memory_allocated(device) / 2**20:.0f} MiB')
+
+        # Metrics are already reduced, so every rank takes the same branch
+        if val_loss < best_val_loss:
+            best_val_loss = val_loss
+            if is_main:
+                checkpointer.save(to_cpu_state_dict(model), args.output)
+                print(f'✅ Model saved! Best Validation Loss: {best_val_loss:.4f}')
+        if is_main:
+            checkpointer.save(snapshot(unwrap(model), optimizer, scaler, epoch + 1, 0, best_val_loss), last_path)
+
+    if is_main:
+        checkpointer.close()
+        if args.teacher_checkpoint:
+            print(f"Serve the student with MODEL_PATH={args.output} MODEL_ARCH={args.model} "
+                  f"MODEL_INPUT_SIZE={args.img_size}")
+    if distributed:
+        dist.barrier()
+        dist.destroy_process_group()
+
+
+if __name__ == '__main__':
+    main()